@@ -6,16 +6,29 @@ Taiwan Invoice Skill - BM25 Search Engine
 無外部依賴，純 Python 實現 BM25 搜索算法
 """
 
-import csv
-import math
-import re
 import os
-from typing import List, Dict, Any, Optional, Tuple
+
+from engine import (  # noqa: F401  -- 沿用舊名稱的匯出
+    BATCH_PROCESS_THRESHOLD, HAS_AHOCORASICK, MIN_RULE_MATCH, PROFILE_ENV, PROFILER, DomainIndex,
+    FileSnapshot, KeywordMatcher, KeywordRules, PrefixIndex, Profiler, QueryCache, RowStore,
+    RuleTable, SearchEngine, SparseIndex, Watcher, bm25_score, cli_field_weights, compute_idf,
+    file_snapshot, has_sparse_backend, map_batch, match_tokens, parse_field_weights,
+    parse_profile_mode, parse_simple_args, read_csv, read_rows, rule_match_score, rule_table,
+    score_index, score_index_pruned, start_profiling, tokenize,
+)
 
 # 取得 data 目錄路徑
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'data')
 
+# 編譯後的索引檔放在 data/ 旁邊，由 search.py --build-index 產生，
+# 查詢時若來源 CSV 有變動會自動重建
+INDEX_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), '.index')
+
+# 評分後端：'python'（預設，無外部依賴）或 'sparse'（需 NumPy + SciPy，
+# 適合數萬筆以上的語料與批次查詢）
+SEARCH_BACKEND = os.environ.get('TAIWAN_INVOICE_SEARCH_BACKEND', 'python')
+
 # CSV 設定：定義各域的搜索欄位和輸出欄位
 CSV_CONFIG = {
     'provider': {
@@ -27,19 +40,28 @@ CSV_CONFIG = {
         'file': 'operations.csv',
         # 逐一列出所有 provider 端點欄位，與 field 域同理
         'search_cols': ['operation', 'operation_zh', 'ecpay_b2c_endpoint', 'ecpay_b2b_endpoint', 'smilepay_endpoint', 'amego_endpoint', 'ezpay_endpoint', 'paynow_endpoint', 'opay_endpoint', 'sunpay_endpoint', 'mof_endpoint', 'notes'],
-        'output_cols': ['operation', 'operation_zh', 'ecpay_b2c_endpoint', 'ecpay_b2b_endpoint', 'smilepay_endpoint', 'amego_endpoint', 'ezpay_endpoint', 'paynow_endpoint', 'opay_endpoint', 'sunpay_endpoint', 'mof_endpoint', 'required_fields', 'notes']
+        'output_cols': ['operation', 'operation_zh', 'ecpay_b2c_endpoint', 'ecpay_b2b_endpoint', 'smilepay_endpoint', 'amego_endpoint', 'ezpay_endpoint', 'paynow_endpoint', 'opay_endpoint', 'sunpay_endpoint', 'mof_endpoint', 'required_fields', 'notes'],
+        # 輸入建議 (suggest) 的來源欄位：欄位名、端點路徑、代碼
+        'suggest_cols': ['operation', 'ecpay_b2c_endpoint', 'ecpay_b2b_endpoint', 'smilepay_endpoint', 'amego_endpoint', 'ezpay_endpoint', 'paynow_endpoint', 'opay_endpoint', 'sunpay_endpoint', 'mof_endpoint']
     },
     'error': {
         'file': 'error-codes.csv',
         'search_cols': ['provider', 'code', 'message_zh', 'message_en', 'category', 'solution'],
-        'output_cols': ['provider', 'code', 'message_zh', 'category', 'solution']
+        'output_cols': ['provider', 'code', 'message_zh', 'category', 'solution'],
+        # BM25F 預設欄位權重（未列出者為 1.0），只在 --bm25f / --boost / field_weights 時採用：
+        # 命中代碼、服務商比命中長篇說明重要；預設查詢仍為一般 BM25
+        'field_weights': {'code': 3.0, 'provider': 2.0, 'solution': 0.5},
+        # 精確查詢用的鍵：(provider, code) 與 code，見 lookup_code()
+        'key_cols': ['provider', 'code'],
+        'suggest_cols': ['code']
     },
     'field': {
         'file': 'field-mappings.csv',
         # 逐一列出所有 provider 欄位 —— 原本只涵蓋 3 家，
         # 導致搜尋其餘 provider 的欄位名時完全比對不到
         'search_cols': ['field_name', 'description', 'ecpay_name', 'smilepay_name', 'amego_name', 'ezpay_name', 'paynow_name', 'opay_name', 'sunpay_name', 'mof_name', 'notes'],
-        'output_cols': ['field_name', 'description', 'ecpay_name', 'smilepay_name', 'amego_name', 'ezpay_name', 'paynow_name', 'opay_name', 'sunpay_name', 'mof_name', 'type', 'required_b2c', 'required_b2b', 'notes']
+        'output_cols': ['field_name', 'description', 'ecpay_name', 'smilepay_name', 'amego_name', 'ezpay_name', 'paynow_name', 'opay_name', 'sunpay_name', 'mof_name', 'type', 'required_b2c', 'required_b2b', 'notes'],
+        'suggest_cols': ['field_name', 'ecpay_name', 'smilepay_name', 'amego_name', 'ezpay_name', 'paynow_name', 'opay_name', 'sunpay_name', 'mof_name']
     },
     'tax': {
         'file': 'tax-rules.csv',
@@ -69,295 +91,39 @@ DOMAIN_KEYWORDS = {
     'reasoning': ['推薦', 'recommend', '選擇', 'choose', '適合', 'suitable', '場景', 'scenario', '決策', 'decision']
 }
 
-
-def tokenize(text: str) -> List[str]:
-    """
-    將文字分詞為 token 列表，支援中英文混合。
-
-    中文採「單字 + bigram」，與 taiwan-payment / taiwan-logistics 一致。
-
-    先前此處只做 text.split()，等於中文必須整個詞完全相同才命中 ——
-    搜尋「折讓」找不到「折讓的」、搜尋「開立」找不到「開立發票」。
-    中文沒有空白分隔，以空白切詞在本專案的資料上幾乎等同關鍵字全等比對。
-    """
-    if not text:
-        return []
-
-    text = text.lower()
-
-    tokens = []
-
-    # 英數 token
-    for match in re.finditer(r'[a-z0-9]+', text):
-        tokens.append(match.group())
-
-    # 中文單字
-    chinese_chars = re.findall(r'[一-鿿]', text)
-    tokens.extend(chinese_chars)
-
-    # 中文 bigram —— 讓「折讓」能命中「折讓的」
-    for i in range(len(chinese_chars) - 1):
-        tokens.append(chinese_chars[i] + chinese_chars[i + 1])
-
-    return tokens
-
-
-# reasoning.csv 規則比對的最低匹配強度，低於此值視為雜訊不計分
-MIN_RULE_MATCH = 0.15
-
-
-def match_tokens(text: str) -> set:
-    """抽出用於規則比對的 token：英數詞 + 中文 bigram。
-
-    bigram 只在同一個中文詞塊內組合，不跨空白邊界，避免組出
-    「試避」這類跨詞的無意義片段。
-    """
-    if not text:
-        return set()
-
-    text = text.lower()
-    tokens = set(re.findall(r'[a-z0-9]+', text))
-
-    for chunk in re.findall(r'[一-鿿]+', text):
-        if len(chunk) == 1:
-            tokens.add(chunk)
-        else:
-            for i in range(len(chunk) - 1):
-                tokens.add(chunk[i:i + 2])
-
-    return tokens
-
-
-def rule_match_score(query: str, *rule_fields: str) -> float:
-    """量化查詢與規則文字的匹配強度，回傳 0.0–1.0。
-
-    取代原本「命中任一詞即給滿分」的判斷 —— 舊做法讓「開立」這類高頻
-    短詞使不相干的規則也拿到完整權重。
-
-    計分方式為「規則解釋了查詢的多少比例」，即 overlap / 查詢詞數。
-    刻意不納入 recall（overlap / 規則詞數）：規則的 use_cases 詞數多寡
-    是撰寫風格差異，用它加權會讓寫得詳細的規則反而吃虧。
-
-    另設最低命中詞數，避免單一詞偶然命中就計分；查詢本身很短時放寬，
-    否則兩字查詢將永遠無法命中任何規則。
-    """
-    q = match_tokens(query)
-    if not q:
-        return 0.0
-
-    min_overlap = 1 if len(q) <= 2 else 2
-
-    best = 0.0
-    for field in rule_fields:
-        r = match_tokens(field)
-        if not r:
-            continue
-        overlap = len(q & r)
-        if overlap < min_overlap:
-            continue
-        best = max(best, overlap / len(q))
-
-    return best
-
-
-def compute_idf(documents: List[List[str]]) -> Dict[str, float]:
-    """
-    計算 IDF (Inverse Document Frequency)
-    """
-    N = len(documents)
-    if N == 0:
-        return {}
-
-    df = {}  # document frequency
-    for doc in documents:
-        unique_terms = set(doc)
-        for term in unique_terms:
-            df[term] = df.get(term, 0) + 1
-
-    idf = {}
-    for term, freq in df.items():
-        idf[term] = math.log((N - freq + 0.5) / (freq + 0.5) + 1)
-
-    return idf
-
-
-def bm25_score(query_tokens: List[str], doc_tokens: List[str],
-               idf: Dict[str, float], avg_dl: float,
-               k1: float = 1.5, b: float = 0.75) -> float:
-    """
-    計算 BM25 分數
-    """
-    if not doc_tokens or not query_tokens:
-        return 0.0
-
-    doc_len = len(doc_tokens)
-    score = 0.0
-
-    # 計算詞頻
-    tf = {}
-    for token in doc_tokens:
-        tf[token] = tf.get(token, 0) + 1
-
-    for term in query_tokens:
-        if term not in tf:
-            continue
-
-        freq = tf[term]
-        term_idf = idf.get(term, 0)
-
-        # BM25 公式
-        numerator = freq * (k1 + 1)
-        denominator = freq + k1 * (1 - b + b * doc_len / avg_dl) if avg_dl > 0 else freq + k1
-        score += term_idf * (numerator / denominator)
-
-    return score
-
-
-def _load_csv(filepath: str) -> List[Dict[str, str]]:
-    """
-    載入 CSV 檔案
-    """
-    if not os.path.exists(filepath):
-        return []
-
-    rows = []
-    with open(filepath, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rows.append(row)
-    return rows
-
-
-def _search_csv(query: str, domain: str, max_results: int = 5) -> List[Dict[str, Any]]:
-    """
-    對指定域的 CSV 進行 BM25 搜索
-    """
-    if domain not in CSV_CONFIG:
-        return []
-
-    config = CSV_CONFIG[domain]
-    filepath = os.path.join(DATA_DIR, config['file'])
-    rows = _load_csv(filepath)
-
-    if not rows:
-        return []
-
-    # 建立文檔
-    documents = []
-    for row in rows:
-        doc_text = ' '.join(str(row.get(col, '')) for col in config['search_cols'])
-        documents.append(tokenize(doc_text))
-
-    # 計算 IDF 和平均文檔長度
-    idf = compute_idf(documents)
-    avg_dl = sum(len(doc) for doc in documents) / len(documents) if documents else 1
-
-    # 計算每個文檔的分數
-    query_tokens = tokenize(query)
-    scored_results = []
-
-    for i, (row, doc_tokens) in enumerate(zip(rows, documents)):
-        score = bm25_score(query_tokens, doc_tokens, idf, avg_dl)
-        if score > 0:
-            result = {col: row.get(col, '') for col in config['output_cols']}
-            result['_score'] = round(score, 4)
-            scored_results.append(result)
-
-    # 按分數排序
-    scored_results.sort(key=lambda x: x['_score'], reverse=True)
-
-    return scored_results[:max_results]
-
-
-def detect_domain(query: str) -> str:
-    """
-    自動偵測查詢屬於哪個域
-    """
-    query_lower = query.lower()
-
-    scores = {domain: 0 for domain in DOMAIN_KEYWORDS}
-
-    for domain, keywords in DOMAIN_KEYWORDS.items():
-        for keyword in keywords:
-            if keyword.lower() in query_lower:
-                scores[domain] += 1
-
-    # 找出最高分的域
-    best_domain = max(scores, key=scores.get)
-
-    # 如果沒有匹配，預設為 troubleshoot
-    if scores[best_domain] == 0:
-        return 'troubleshoot'
-
-    return best_domain
-
-
-def search(query: str, domain: Optional[str] = None, max_results: int = 5) -> List[Dict[str, Any]]:
-    """
-    主搜索函數
-
-    Args:
-        query: 搜索查詢
-        domain: 指定域 (provider, operation, error, field, tax, troubleshoot)
-                如果不指定，會自動偵測
-        max_results: 最大結果數
-
-    Returns:
-        搜索結果列表
-    """
-    if not domain:
-        domain = detect_domain(query)
-
-    return _search_csv(query, domain, max_results)
-
-
-def search_all(query: str, max_per_domain: int = 3) -> Dict[str, List[Dict[str, Any]]]:
-    """
-    在所有域中搜索
-
-    Args:
-        query: 搜索查詢
-        max_per_domain: 每個域的最大結果數
-
-    Returns:
-        按域分類的搜索結果
-    """
-    results = {}
-    for domain in CSV_CONFIG.keys():
-        domain_results = _search_csv(query, domain, max_per_domain)
-        if domain_results:
-            results[domain] = domain_results
-    return results
-
-
-def get_available_domains() -> List[str]:
-    """
-    取得可用的搜索域列表
-    """
-    return list(CSV_CONFIG.keys())
-
-
-def get_domain_info(domain: str) -> Optional[Dict[str, Any]]:
-    """
-    取得域的設定資訊
-    """
-    if domain not in CSV_CONFIG:
-        return None
-
-    config = CSV_CONFIG[domain]
-    filepath = os.path.join(DATA_DIR, config['file'])
-    rows = _load_csv(filepath)
-
-    return {
-        'domain': domain,
-        'file': config['file'],
-        'search_cols': config['search_cols'],
-        'output_cols': config['output_cols'],
-        'total_records': len(rows)
-    }
+# 索引、查詢快取與評分都在 engine.py（三個 skill 共用），本檔只定義此 skill 的設定
+ENGINE = SearchEngine('invoice', CSV_CONFIG, DOMAIN_KEYWORDS, DATA_DIR, INDEX_DIR,
+                      default_domain='troubleshoot', score_digits=4, tag_domain=False,
+                      backend=SEARCH_BACKEND)
+
+# 模組層級的函數介面：search.py、server.py、recommend.py 與既有程式沿用這些名稱
+_INDEX_CACHE = ENGINE.indexes
+_load_csv = read_csv
+load_csv = ENGINE.load_csv
+build_index = ENGINE.build_index
+save_index = ENGINE.save_index
+load_index = ENGINE.load_index
+build_all_indexes = ENGINE.build_all_indexes
+get_index = ENGINE.get_index
+get_sparse_index = ENGINE.get_sparse_index
+_index_path = ENGINE._index_path
+get_available_domains = ENGINE.get_available_domains
+get_domain_info = ENGINE.get_domain_info
+cache_stats = ENGINE.cache_stats
+_domain_matcher = ENGINE.domain_matcher
+detect_domain = ENGINE.detect_domain
+lookup_code = ENGINE.lookup_code
+_exact_search = ENGINE._exact_search
+resolve_domain = ENGINE.resolve_domain
+_search_csv = ENGINE.rank
+search = ENGINE.search
+search_federated = ENGINE.search_federated
+search_all = ENGINE.search_all
+suggest = ENGINE.suggest
+prefix_index = ENGINE.prefix_index
+search_batch = ENGINE.search_batch
 
 
-# CLI 測試
 if __name__ == '__main__':
     import sys
 
@@ -373,7 +139,7 @@ if __name__ == '__main__':
     if domain:
         print(f"Domain: {domain}")
     else:
-        detected = detect_domain(query)
+        detected = resolve_domain(query)
         print(f"Auto-detected domain: {detected}")
 
     print()
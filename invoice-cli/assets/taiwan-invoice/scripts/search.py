@@ -8,20 +8,57 @@ Taiwan Invoice Skill - Search CLI
     python search.py "1999 error" --domain error
     python search.py "稅額計算" --domain tax
     python search.py "綠界" --all
+    python search.py --batch < queries.jsonl > results.jsonl
+    python search.py "relate" --suggest          # 輸入建議（欄位名、端點、錯誤碼）
+    python search.py serve                       # 常駐服務，搭配 --daemon 免重新載入
 """
 
-import argparse
+import os
 import sys
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Iterable, Iterator, Optional, TextIO, Tuple
 
 from core import (
     search,
     search_all,
-    detect_domain,
+    search_batch,
+    suggest,
+    resolve_domain,
+    build_all_indexes,
     get_available_domains,
-    get_domain_info
+    get_domain_info,
+    cli_field_weights,
+    parse_field_weights,
+    parse_simple_args,
+    start_profiling,
+    CSV_CONFIG,
+    PROFILE_ENV,
+    PROFILER,
+    DATA_DIR,
+    INDEX_DIR
 )
 
+# 常駐服務位址，與 server.py 相同
+DAEMON_HOST = os.environ.get('TAIWAN_SEARCH_HOST', '127.0.0.1')
+DAEMON_PORT = int(os.environ.get('TAIWAN_SEARCH_PORT', '47310'))
+# 埠上的程式不一定是我們的服務：以 --daemon 或 TAIWAN_SEARCH_DAEMON=1 明確開啟才把查詢交給它
+DAEMON_ENV = 'TAIWAN_SEARCH_DAEMON'
+
+# 常見的單筆查詢（查詢字串加上這些選項）不經 argparse 解析，見 core.parse_simple_args()；
+# 其餘參數組合、--help 與錯誤訊息照常交給 build_parser()
+FORMATS = ('ascii', 'simple', 'json', 'markdown', 'md')
+FAST_OPTIONS = {
+    '-d': ('domain', CSV_CONFIG), '--domain': ('domain', CSV_CONFIG),
+    '-n': ('max_results', int), '--max-results': ('max_results', int),
+    '-f': ('format', FORMATS), '--format': ('format', FORMATS),
+    '-a': ('all', None), '--all': ('all', None),
+    '--fuzzy': ('fuzzy', None), '--daemon': ('daemon', None), '--no-daemon': ('no_daemon', None),
+}
+FAST_DEFAULTS = {
+    'domain': None, 'max_results': 5, 'all': False, 'list': False, 'build_index': False,
+    'batch': False, 'processes': None, 'boost': None, 'bm25f': False, 'fuzzy': False,
+    'suggest': False, 'daemon': False, 'no_daemon': False, 'format': 'ascii', 'profile': None,
+}
+
 
 def format_ascii_box(title: str, content: List[str], width: int = 80, style: str = 'double') -> str:
     """
@@ -189,7 +226,189 @@ def list_domains():
     print()
 
 
-def main():
+def build_indexes():
+    """
+    重建所有域的編譯索引檔
+    """
+    built = build_all_indexes()
+    print(f"\n索引已寫入 (Index written to): {INDEX_DIR}")
+    for domain, total in built.items():
+        print(f"  {domain:<14} {total} 筆")
+    print()
+
+
+def parse_batch_line(line: str, domain: Optional[str],
+                     max_results: int) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    解析一行 JSONL 查詢，回傳 (job, error)
+
+    每行可為 JSON 字串，或含 query（必要）、domain、max_results、id 的物件。
+    """
+    import json
+
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return None, f'invalid JSON: {e}'
+    if isinstance(item, str):
+        item = {'query': item}
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+        return None, "expected a string or an object with a string 'query'"
+
+    job_domain = item.get('domain') or domain or resolve_domain(item['query'])
+    if job_domain not in get_available_domains():
+        return None, f'unknown domain: {job_domain}'
+    job_max = item.get('max_results', max_results)
+    if not isinstance(job_max, int) or job_max < 1:
+        return None, 'max_results must be a positive integer'
+
+    job = {'query': item['query'], 'domain': job_domain, 'max_results': job_max}
+    if 'id' in item:
+        job['id'] = item['id']
+    return job, ''
+
+
+def _chunked(lines: Iterable[str], size: int) -> Iterator[List[str]]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(stream: TextIO, out: TextIO, domain: Optional[str] = None, max_results: int = 5,
+              processes: Optional[int] = None, chunk_size: int = 1000) -> int:
+    """
+    JSONL 批次模式：stdin 每行一筆查詢，stdout 每行一筆結果
+
+    每讀滿 chunk_size 行就評分並輸出一次，大檔案也能邊讀邊寫。輸出與輸入
+    逐行對應（空白行略過）；無法解析的行輸出 {"line", "error"}，不中斷整批。
+    回傳錯誤行數。
+    """
+    import json
+
+    from core import BATCH_PROCESS_THRESHOLD
+
+    if processes and processes > 1:
+        # 每段至少要達多行程門檻，子行程才派得上用場
+        chunk_size = max(chunk_size, BATCH_PROCESS_THRESHOLD * processes)
+    errors = 0
+    lines = ((n, line) for n, line in enumerate(stream, 1) if line.strip())
+    for chunk in _chunked(lines, chunk_size):
+        parsed = [(n, *parse_batch_line(line, domain, max_results)) for n, line in chunk]
+        jobs = [job for _, job, _ in parsed if job is not None]
+        results = iter(search_batch(jobs, processes=processes))
+
+        for n, job, error in parsed:
+            if job is None:
+                errors += 1
+                record = {'line': n, 'error': error}
+            else:
+                record = {k: job[k] for k in ('id', 'query', 'domain') if k in job}
+                record['results'] = next(results)
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+    return errors
+
+
+def query_daemon(path: str, payload: Dict[str, Any], host: str = DAEMON_HOST,
+                 port: int = DAEMON_PORT, timeout: float = 5.0) -> Optional[Dict[str, Any]]:
+    """
+    向常駐服務 (search.py serve) 發送請求
+
+    服務未啟動、回應非 200 或格式不符時回傳 None，呼叫端改為行程內搜索。
+    直接以 socket 送出 HTTP/1.0 請求：光是匯入 http.client 就比一次查詢還慢。
+    """
+    import socket
+
+    chunks = []
+    try:
+        # 服務未啟動時 localhost 連線會立即被拒，逾時只在服務卡住時才用到。
+        # 連上後才編碼請求：服務沒在跑（最常見的情況）時連 json 都不必匯入
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            import json
+
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            head = (f'POST {path} HTTP/1.0\r\nHost: {host}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n')
+            sock.sendall(head.encode('ascii') + body)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return None
+
+    status, _, rest = b''.join(chunks).partition(b'\r\n')
+    if status.split()[1:2] != [b'200']:
+        return None
+    try:
+        reply = json.loads(rest.partition(b'\r\n\r\n')[2])
+    except ValueError:
+        return None
+    return reply if isinstance(reply, dict) and 'results' in reply else None
+
+
+def run_search(query: str, domain: Optional[str], max_results: int,
+               all_domains: bool = False, use_daemon: bool = False,
+               field_weights: Optional[Dict[str, float]] = None, fuzzy: bool = False) -> Any:
+    """
+    執行搜索：use_daemon 時先交給常駐服務，否則在本行程內搜索
+    """
+    if use_daemon:
+        payload = {
+            'skill': 'invoice', 'query': query, 'domain': domain,
+            'max_results': max_results, 'all': all_domains, 'data_dir': DATA_DIR,
+        }
+        if field_weights is not None:
+            payload['field_weights'] = field_weights
+        if fuzzy:
+            payload['fuzzy'] = True
+        reply = query_daemon('/search', payload)
+        if reply is not None:
+            return reply['results']
+    if all_domains:
+        return search_all(query, max_results, fuzzy=fuzzy)
+    return search(query, domain, max_results, field_weights=field_weights, fuzzy=fuzzy)
+
+
+def run_suggest(prefix: str, domain: Optional[str], limit: int,
+                use_daemon: bool = False) -> List[Dict[str, Any]]:
+    """
+    輸入建議：use_daemon 時先交給常駐服務，否則在本行程內查詢
+    """
+    if use_daemon:
+        payload = {'skill': 'invoice', 'prefix': prefix, 'domain': domain,
+                   'limit': limit, 'data_dir': DATA_DIR}
+        reply = query_daemon('/suggest', payload)
+        if reply is not None:
+            return reply['results']
+    return suggest(prefix, domain, limit)
+
+
+def stream_suggestions(stream: TextIO, out: TextIO, domain: Optional[str], limit: int,
+                       use_daemon: bool = False):
+    """
+    串流輸入建議：stdin 每行一個前綴，逐行輸出 {"prefix", "suggestions"} 並立即 flush
+    """
+    import json
+
+    for line in stream:
+        prefix = line.rstrip('\n')
+        record = {'prefix': prefix, 'suggestions': run_suggest(prefix, domain, limit, use_daemon)}
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+
+def build_parser():
+    """完整的參數解析器；常見的單筆查詢由 parse_simple_args() 處理，不必建立它"""
+    import argparse
+
     parser = argparse.ArgumentParser(
         description='Taiwan Invoice Skill - BM25 Search Engine',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -201,8 +420,18 @@ Examples:
   python search.py "統編" --domain field          # Search field mappings
   python search.py "B2B 稅額" --domain tax        # Search tax rules
   python search.py "列印空白" --domain troubleshoot  # Search troubleshooting
+  python search.py "金額錯誤" -d error --bm25f     # Rank with preset BM25F field weights
+  python search.py "金額錯誤" -d error --boost solution=2  # Re-weight BM25F fields
+  python search.py "RelateNumbr" --fuzzy          # Tolerate typos in identifiers
   python search.py "ECPay" --all                  # Search all domains
   python search.py --list                         # List available domains
+  python search.py --build-index                  # Prebuild search indexes
+  python search.py --batch < queries.jsonl        # JSONL in, JSONL out
+  python search.py "relate" --suggest             # Type-ahead: fields, endpoints, codes
+  python search.py --suggest < prefixes.txt       # One prefix per line, JSONL out
+  python search.py "ecpay 折讓" --profile         # Per-stage timings on stderr
+  python search.py serve                          # Keep indexes warm in a daemon
+  python search.py "開立發票" --daemon             # Query the running daemon
         """
     )
 
@@ -215,26 +444,110 @@ Examples:
                         help='Search all domains')
     parser.add_argument('-l', '--list', action='store_true',
                         help='List available domains')
-    parser.add_argument('-f', '--format', choices=['ascii', 'simple', 'json', 'markdown', 'md'],
+    parser.add_argument('--build-index', action='store_true',
+                        help='Prebuild compiled search indexes next to data/')
+    parser.add_argument('--batch', action='store_true',
+                        help='Read JSONL queries from stdin, stream JSONL results to stdout')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='Worker processes for large --batch inputs')
+    parser.add_argument('--boost', type=parse_field_weights, metavar='COL=W[,COL=W]',
+                        help='Per-field weights for BM25F domains (e.g. code=3,solution=0.5); '
+                             'implies --bm25f')
+    parser.add_argument('--bm25f', action='store_true',
+                        help='Rank with the preset per-field weights of BM25F domains '
+                             '(default: plain BM25)')
+    parser.add_argument('--fuzzy', action='store_true',
+                        help='Correct misspelled identifiers to the closest indexed term before ranking')
+    parser.add_argument('--suggest', action='store_true',
+                        help='List field names, endpoints and codes starting with the query '
+                             '(reads prefixes from stdin when no query is given)')
+    parser.add_argument('--daemon', action='store_true',
+                        help=f'Send queries to the search daemon started by "search.py serve" '
+                             f'(or set {DAEMON_ENV}=1)')
+    parser.add_argument('--no-daemon', action='store_true',
+                        help=f'Always search in-process, even with --daemon or {DAEMON_ENV} set')
+    parser.add_argument('-f', '--format', choices=FORMATS,
                         default='ascii', help='Output format (default: ascii)')
+    parser.add_argument('--profile', nargs='?', const='table', metavar='MODE',
+                        help='Print per-stage timings to stderr: table (default), json, '
+                             'cprofile[:PATH] (also via $%s)' % PROFILE_ENV)
+    return parser
+
+
+def parser_error(message: str):
+    """以 argparse 的格式回報參數錯誤並結束 (exit code 2)"""
+    build_parser().error(message)
 
-    args = parser.parse_args()
+
+def main():
+    # 常駐服務模式：search.py serve [--host H] [--port P] [--skills ...]
+    if sys.argv[1:2] == ['serve']:
+        from server import main as serve
+        serve(sys.argv[2:])
+        return
+
+    # 常見的單筆查詢不經 argparse，見 FAST_OPTIONS
+    args = parse_simple_args(sys.argv[1:], FAST_OPTIONS, FAST_DEFAULTS) or build_parser().parse_args()
+
+    # 分階段計時：--profile 或 TAIWAN_SEARCH_PROFILE。常駐服務內的耗時量不到，一律改為行程內搜索
+    profile = args.profile or os.environ.get(PROFILE_ENV)
+    if profile:
+        try:
+            start_profiling(profile, __file__)
+        except ValueError as e:
+            parser_error(str(e))
+        PROFILER.instrument(sys.modules[__name__], [n for n in globals() if n.startswith('format_')],
+                            'format')
+        args.no_daemon = True
+    # 常駐服務須明確開啟，見 DAEMON_ENV
+    if not (args.daemon or os.environ.get(DAEMON_ENV, '') not in ('', '0')):
+        args.no_daemon = True
 
     # 列出域
     if args.list:
         list_domains()
         return
 
+    # 預先建立索引
+    if args.build_index:
+        build_indexes()
+        return
+
+    # JSONL 批次模式
+    if args.batch:
+        errors = run_batch(sys.stdin, sys.stdout, args.domain, args.max_results, args.processes)
+        sys.exit(1 if errors else 0)
+
+    # 輸入建議
+    if args.suggest:
+        if args.domain and 'suggest_cols' not in CSV_CONFIG[args.domain]:
+            parser_error(f'域 {args.domain} 不提供輸入建議')
+        if args.query is None:
+            stream_suggestions(sys.stdin, sys.stdout, args.domain, args.max_results,
+                               not args.no_daemon)
+            return
+        suggestions = run_suggest(args.query, args.domain, args.max_results, not args.no_daemon)
+        if args.format == 'json':
+            import json
+            print(json.dumps(suggestions, ensure_ascii=False, indent=2))
+        else:
+            for item in suggestions:
+                print(f"{item['text']}\t{item['domain']}\t{','.join(item['columns'])}")
+        return
+
     # 檢查查詢
     if not args.query:
-        parser.print_help()
+        build_parser().print_help()
         return
 
     query = args.query
 
     # 搜索所有域
     if args.all:
-        results = search_all(query, args.max_results)
+        if args.boost or args.bm25f:
+            parser_error('--boost/--bm25f 只適用於單域搜索')
+        results = run_search(query, None, args.max_results, True, not args.no_daemon,
+                             fuzzy=args.fuzzy)
 
         if args.format == 'json':
             import json
@@ -248,11 +561,15 @@ Examples:
     # 單域搜索
     domain = args.domain
     if not domain:
-        domain = detect_domain(query)
+        domain = resolve_domain(query)
         if args.format not in ('json', 'markdown', 'md'):
             print(f"[Auto-detected domain: {domain}]")
 
-    results = search(query, domain, args.max_results)
+    try:
+        results = run_search(query, domain, args.max_results, use_daemon=not args.no_daemon,
+                             field_weights=cli_field_weights(args), fuzzy=args.fuzzy)
+    except ValueError as e:
+        parser_error(str(e))
 
     if args.format == 'json':
         import json
@@ -9,18 +9,41 @@
 現行做法見 core.rule_match_score()：以查詢被規則解釋的比例加權，並要求
 最低命中詞數。本測試確保該行為不再退化。
 
+關鍵字規則（RECOMMENDATION_RULES / ANTI_PATTERNS）編成單一自動機
+（core.KeywordRules），命中的規則與警告須與逐條 `keyword in query` 相同。
+
+批次推薦（recommend_batch / --batch）整批只載入一次服務商資料，結果須與
+逐筆呼叫 recommend() 相同。
+
+整合推薦（stack.py）以分支定界搜尋服務商組合，結果須與列舉全部組合相同。
+
+providers.csv 與 reasoning.csv 在行程內只讀一次，變動時只重建該檔（refresh()）；
+來源檔暫時不存在時沿用上一版。
+
 使用方法:
     python test_recommend.py
 """
 
+import io
+import itertools
+import json
 import os
+import random
+import shutil
 import sys
+import tempfile
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, SCRIPT_DIR)
 
-from core import rule_match_score, MIN_RULE_MATCH  # noqa: E402
-from recommend import recommend  # noqa: E402
+from core import (  # noqa: E402
+    BATCH_PROCESS_THRESHOLD, HAS_AHOCORASICK, FileSnapshot, KeywordRules, RuleTable, read_csv, rule_match_score,
+    MIN_RULE_MATCH,
+)
+from recommend import (  # noqa: E402
+    ANTI_PATTERNS, RECOMMENDATION_RULES, recommend, recommend_batch, run_batch,
+)
+from stack import SKILLS, Candidate, StackRecommender, best_stacks, discover_skills  # noqa: E402
 
 
 # (查詢, 期望推薦的加值中心)
@@ -90,6 +113,309 @@ def test_verbose_rule_not_penalised():
     return [] if ok else [('verbose rule', short_rule, long_rule)]
 
 
+def test_rule_table():
+    """編譯後的規則表（倒排索引只為候選規則計分）與逐條 rule_match_score 相同"""
+    failures = []
+    path = os.path.join(os.path.dirname(SCRIPT_DIR), 'data', 'reasoning.csv')
+    rules = read_csv(path)
+    table = RuleTable(path)
+
+    queries = [q for q, _ in EXPECTED] + [r.get('scenario', '') for r in rules] + ['', 'xyz']
+    mismatched = []
+    for query in queries:
+        expected = []
+        for rule in rules:
+            strength = rule_match_score(query, rule.get('scenario', ''), rule.get('use_cases', ''))
+            if strength >= MIN_RULE_MATCH:
+                expected.append((rule, strength))
+        if table.match(query) != expected:
+            mismatched.append(query)
+    ok = not mismatched
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐條計分相同")
+    if not ok:
+        failures.append(('rule table', 'same as rule_match_score', mismatched[:3]))
+
+    # 整批比對（token 聯集只查一次倒排索引）與逐筆 match() 相同，含詞序不同、token 集合相同的查詢
+    batch = queries + ['電商 高交易量 穩定', '穩定，高交易量 電商', '']
+    ok = table.match_batch(batch) == [table.match(q) for q in batch]
+    print(f"   [{'PASS' if ok else 'FAIL'}] match_batch 與逐筆 match() 相同 ({len(batch)} 筆)")
+    if not ok:
+        failures.append(('rule table', 'match_batch same as match', len(batch)))
+
+    # 規則檔變動後自動重新編譯
+    tmp = tempfile.mkdtemp()
+    try:
+        copy = shutil.copy(path, tmp)
+        table = RuleTable(copy)
+        before = len(table.match('規則表失效測試 專用情境'))
+        with open(copy, 'a', encoding='utf-8') as f:
+            f.write('規則表失效測試 專用情境,ECPay,HIGH,測試用\n')
+        after = len(table.match('規則表失效測試 專用情境'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    ok = before == 0 and after == 1
+    print(f"   [{'PASS' if ok else 'FAIL'}] 規則檔變動後重新載入 (before={before} after={after})")
+    if not ok:
+        failures.append(('rule table reload', '0 -> 1', (before, after)))
+
+    return failures
+
+
+def test_keyword_rules():
+    """自動機命中的規則與警告與逐條子字串比對相同，CSV 載入的規則亦同"""
+    failures = []
+    queries = [q for q, _ in EXPECTED] + [
+        '', 'xyz', 'SDK sdk Sdk', '純B2C 48小時 AllAmount', '無技術資源 極簡整合 高交易量',
+        '市佔 社群 穩定 B2B', '新標準 API設計', '列印 作廢 折讓 載具 捐贈 統編',
+    ]
+
+    def expected(query):
+        q = query.lower()
+        rules = [(k, tuple(v)) for k, v in RECOMMENDATION_RULES.items() if k.lower() in q]
+        warnings = {p: [(k, w) for k, w in patterns if k.lower() in q] for p, patterns in ANTI_PATTERNS.items()}
+        return rules, warnings
+
+    for use_c in (False, True) if HAS_AHOCORASICK else (False,):
+        table = KeywordRules(RECOMMENDATION_RULES, ANTI_PATTERNS, use_c=use_c)
+        mismatched = [q for q in queries
+                      if (table.match(q), {p: table.warnings(q, p) for p in ANTI_PATTERNS}) != expected(q)]
+        ok = not mismatched
+        label = 'pyahocorasick' if use_c else '純 Python'
+        print(f"   [{'PASS' if ok else 'FAIL'}] {label}：{len(queries)} 筆查詢與逐條比對相同")
+        if not ok:
+            failures.append(('keyword rules', label, mismatched[:3]))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        rules_path = os.path.join(tmp, 'rules.csv')
+        anti_path = os.path.join(tmp, 'anti-patterns.csv')
+        with open(rules_path, 'w', encoding='utf-8') as f:
+            f.write('keyword,provider,weight,reason\n')
+            for keyword, entries in RECOMMENDATION_RULES.items():
+                for provider, weight, reason in entries:
+                    f.write(f'{keyword},{provider},{weight},{reason}\n')
+        with open(anti_path, 'w', encoding='utf-8') as f:
+            f.write('provider,keyword,warning\n')
+            for provider, patterns in ANTI_PATTERNS.items():
+                for keyword, warning in patterns:
+                    f.write(f'{provider},{keyword},{warning}\n')
+        loaded = KeywordRules.from_csv(rules_path, anti_path)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    compiled = KeywordRules(RECOMMENDATION_RULES, ANTI_PATTERNS)
+    ok = (loaded.rules == compiled.rules and loaded.anti_patterns == compiled.anti_patterns
+          and all(loaded.match(q) == compiled.match(q) for q in queries))
+    print(f"   [{'PASS' if ok else 'FAIL'}] 由 CSV 載入的 {len(loaded)} 條規則與 dict 定義相同")
+    if not ok:
+        failures.append(('keyword rules csv', 'same as dict', len(loaded)))
+    return failures
+
+
+def test_batch():
+    """批次結果與逐筆 recommend() 相同（含重複查詢），JSONL 模式保留 id 並回報壞行"""
+    failures = []
+    queries = [q for q, _ in EXPECTED] + ['', 'xyz', EXPECTED[0][0]]
+    expected = [recommend(q) for q in queries]
+    ok = recommend_batch(queries) == expected
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐筆推薦相同")
+    if not ok:
+        failures.append(('batch', 'same as recommend()', len(queries)))
+
+    # 重複查詢共用計算結果，但回傳的是各自獨立的物件
+    results = recommend_batch([EXPECTED[0][0]] * 2)
+    results[0]['recommended'] = None
+    ok = results[1] == expected[0]
+    print(f"   [{'PASS' if ok else 'FAIL'}] 重複查詢的結果互不影響")
+    if not ok:
+        failures.append(('batch', 'independent duplicates', results[1]))
+
+    stream = io.StringIO(f'{json.dumps(queries[0], ensure_ascii=False)}\n\n'
+                         f'{{"id": "m-1", "query": "{queries[1]}"}}\nnot json\n{{"id": 2}}\n')
+    out = io.StringIO()
+    errors = run_batch(stream, out)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    ok = (errors == 2 and len(records) == 4
+          and records[0] == expected[0]
+          and records[1] == {'id': 'm-1', **expected[1]}
+          and [r.get('line') for r in records[2:]] == [4, 5])
+    print(f"   [{'PASS' if ok else 'FAIL'}] JSONL 批次：{len(records)} 行輸出，{errors} 行錯誤")
+    if not ok:
+        failures.append(('run_batch', 'jsonl records', records))
+
+    # 達門檻時分給子行程，結果與單一行程相同
+    many = queries * (BATCH_PROCESS_THRESHOLD // len(queries) + 1)
+    ok = recommend_batch(many, processes=2) == recommend_batch(many)
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(many)} 筆以 2 個子行程推薦與單一行程相同")
+    if not ok:
+        failures.append(('batch', 'processes=2', len(many)))
+    return failures
+
+
+def brute_force_stacks(candidates, top_k, same_vendor=(), bonus=0.3):
+    """列舉全部組合，作為分支定界的對照；同分時依各元件候選的排序先後"""
+    components = list(candidates)
+    ranked = [sorted(candidates[c], key=lambda cand: -cand.relevance) for c in components]
+    required = [i for i, c in enumerate(components) if c in same_vendor]
+    scored = []
+    for positions in itertools.product(*(range(len(pool)) for pool in ranked)):
+        picks = [ranked[i][p] for i, p in enumerate(positions)]
+        if len(required) > 1 and len({picks[i].vendor for i in required}) > 1:
+            continue
+        score = 0.0
+        for i, cand in enumerate(picks):
+            score += cand.relevance + bonus * sum(p.vendor == cand.vendor for p in picks[:i])
+        scored.append((-score, positions, [cand.provider for cand in picks]))
+    scored.sort(key=lambda item: item[:2])
+    return [(-score, providers) for score, _, providers in scored[:top_k]]
+
+
+def test_stack():
+    """分支定界與列舉全部組合相同且只走訪一小部分；限制條件與點名服務商生效"""
+    if len(discover_skills()) < len(SKILLS):
+        print('   [SKIP] 同一個目錄下未安裝全部三個 skill')
+        return []
+    failures = []
+
+    def same(stacks, expected):
+        return [(s.score, [c.provider for c in s.components.values()]) for s in stacks] == expected
+
+    recommender = StackRecommender()
+    queries = ['ECPay 金流 + 發票 + 超商物流', '藍新 金流 發票', '冷凍 宅配 金流', '訂閱制 發票 宅配',
+               '小型商家 簡單', 'xyz']
+    mismatched = []
+    for query in queries:
+        candidates = {c: recommender.candidates(c, query) for c in SKILLS}
+        for same_vendor in ((), ('payment', 'invoice'), SKILLS):
+            stacks, _ = best_stacks(candidates, 5, same_vendor)
+            if not same(stacks, brute_force_stacks(candidates, 5, same_vendor)):
+                mismatched.append((query, same_vendor))
+    ok = not mismatched
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢 × 3 種限制與列舉全部組合相同")
+    if not ok:
+        failures.append(('stack', 'same as brute force', mismatched[:3]))
+
+    # 合成資料：3 個元件各 60 家候選，列舉需 216000 種組合
+    rng = random.Random(7)
+    candidates = {c: [Candidate(c, f'v{rng.randrange(20)}', '', 0.0, relevance=rng.random())
+                      for _ in range(60)] for c in SKILLS}
+    stacks, visited = best_stacks(candidates, 5)
+    total = 60 ** 3
+    ok = same(stacks, brute_force_stacks(candidates, 5)) and visited < total // 20
+    print(f"   [{'PASS' if ok else 'FAIL'}] {total} 種組合只評估 {visited} 個節點，結果與列舉相同")
+    if not ok:
+        failures.append(('stack', 'pruned search', visited))
+
+    result = recommender.recommend('ECPay 金流 + 發票 + 超商物流')
+    top = result['stacks'][0]['components']
+    ok = [top[c]['provider'].lower() for c in SKILLS] == ['ecpay'] * 3
+    print(f"   [{'PASS' if ok else 'FAIL'}] 點名 ECPay 時首選三個元件皆為 ECPay")
+    if not ok:
+        failures.append(('stack', 'mentioned vendor', top))
+
+    result = recommender.recommend('電商 穩定', top_k=20, same_vendor=['payment', 'invoice'])
+    providers = [{c: s['components'][c]['provider'].lower() for c in SKILLS} for s in result['stacks']]
+    ok = (len(providers) == 20
+          and all(p['payment'] == p['invoice'] or {p['payment'], p['invoice']} == {'newebpay', 'ezpay'}
+                  for p in providers)
+          and all(p['invoice'] != 'mof' for p in providers)
+          and all(p['logistics'] in {q.provider for q in recommender.logistics.providers if q.api_available}
+                  for p in providers))
+    print(f"   [{'PASS' if ok else 'FAIL'}] 金流與發票同家、排除財政部平台與無 API 的物流業者")
+    if not ok:
+        failures.append(('stack', 'constraints', providers[:3]))
+    return failures
+
+
+def test_refresh():
+    """providers.csv 只在變動時重新讀取，refresh() 只重建有變動的檔案"""
+    import recommend as module
+
+    tmp = tempfile.mkdtemp()
+    original = module.DATA_DIR
+    try:
+        for name in ('providers.csv', 'reasoning.csv'):
+            shutil.copy(os.path.join(original, name), tmp)
+        module.DATA_DIR = tmp
+        first = module.refresh()
+        providers = module.load_providers()
+        unchanged = module.load_providers() is providers and module.refresh() == []
+        with open(os.path.join(tmp, 'providers.csv'), 'a', encoding='utf-8') as f:
+            f.write('TestVAN,測試服務商' + ',' * (len(providers[0]) - 2) + '\n')
+        reloaded = module.refresh()
+        after = module.load_providers()
+        scores = module.analyze_requirements('xyz')
+    finally:
+        module.DATA_DIR = original
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = (sorted(first) == ['providers.csv', 'reasoning.csv'] and unchanged
+          and reloaded == ['providers.csv'] and len(after) == len(providers) + 1
+          and 'TestVAN' in scores)
+    print(f"   [{'PASS' if ok else 'FAIL'}] 未變動時沿用同一份資料，改動 providers.csv 只重建該檔 ({reloaded})")
+    return [] if ok else [('refresh', 'providers.csv only', (first, unchanged, reloaded, len(after)))]
+
+
+def test_missing_source():
+    """來源檔暫時不存在（例如正被刪除重建）時沿用上一版，檔案回來後照常運作"""
+    import recommend as module
+
+    query = EXPECTED[0][0]
+    names = ('providers.csv', 'reasoning.csv')
+    tmp = tempfile.mkdtemp()
+    original = module.DATA_DIR
+    try:
+        for name in names:
+            shutil.copy(os.path.join(original, name), tmp)
+        module.DATA_DIR = tmp
+        providers = module.load_providers()
+        expected = module.recommend(query)
+        for name in names:
+            os.replace(os.path.join(tmp, name), os.path.join(tmp, name + '.bak'))
+        missing = (len(module.load_providers()), module.refresh(), module.recommend(query))
+        for name in names:
+            os.replace(os.path.join(tmp, name + '.bak'), os.path.join(tmp, name))
+        back = (module.refresh(), module.recommend(query))
+    finally:
+        module.DATA_DIR = original
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = missing == (len(providers), [], expected) and back == ([], expected)
+    print(f"   [{'PASS' if ok else 'FAIL'}] 來源檔暫時不存在時沿用上一版 ({missing[0]} 家服務商)")
+    return [] if ok else [('missing source', 'previous version kept', (missing[:2], back[0]))]
+
+
+def test_source_removed_while_reading():
+    """檢查之後、讀取之前來源檔被刪除時，FileSnapshot 與 RuleTable 都沿用上一版"""
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'reasoning.csv')
+        shutil.copy(os.path.join(SCRIPT_DIR, '..', 'data', 'reasoning.csv'), path)
+
+        def removed_first(build):
+            def wrapped(p):
+                os.replace(p, p + '.bak')
+                return build(p)  # read_csv 在檔案不存在時回傳空列表
+            return wrapped
+
+        snapshot = FileSnapshot(path)
+        table = RuleTable(path)
+        before = (len(snapshot.get()), len(table.load()))
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('讀取期間刪除,ECPay,HIGH,測試用\n')
+        snapshot.build = removed_first(read_csv)
+        snapshot_refreshed = snapshot.refresh()
+        os.replace(path + '.bak', path)
+        table._build = removed_first(table._build)
+        table_refreshed = table.refresh()
+        after = (len(snapshot.get()), len(table.load()))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = before[0] > 0 and after == before and not snapshot_refreshed and not table_refreshed
+    print(f"   [{'PASS' if ok else 'FAIL'}] 讀取前被刪除時不換成空資料 (before={before} after={after})")
+    return [] if ok else [('removed while reading', before, after)]
+
+
 def main():
     print('=' * 60)
     print('推薦系統回歸測試 (taiwan-invoice)')
@@ -106,6 +432,23 @@ def main():
     print('\n3. 規則長度中立性')
     failures += test_verbose_rule_not_penalised()
 
+    print('\n4. 編譯後的規則表')
+    failures += test_rule_table()
+
+    print('\n5. 關鍵字規則自動機')
+    failures += test_keyword_rules()
+
+    print('\n6. 批次推薦')
+    failures += test_batch()
+
+    print('\n7. 金流 + 發票 + 物流組合推薦')
+    failures += test_stack()
+
+    print('\n8. 來源檔變動時重新載入')
+    failures += test_refresh()
+    failures += test_missing_source()
+    failures += test_source_removed_while_reading()
+
     print('\n' + '=' * 60)
     if failures:
         print(f'[FAIL] {len(failures)} 項未通過')
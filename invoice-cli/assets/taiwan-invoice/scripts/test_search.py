@@ -2,7 +2,8 @@
 """
 搜尋引擎回歸測試
 
-鎖住兩件事：
+鎖住下列 18 項行為。第 2 項在執行時分為欄位涵蓋、設定欄位有效性與新
+provider 可搜尋三節，因此執行輸出的節次編號比這裡多兩號：
 
 1. **中文分詞**。此處原本只做 text.split()，中文必須整個詞完全相同才命中 ——
    搜尋「折讓」找不到「折讓的」。中文沒有空白分隔，以空白切詞在本專案的
@@ -12,17 +13,80 @@
 2. **各域的欄位涵蓋**。field 與 operation 兩域的 search_cols 原本只列出
    前三家 provider，導致其餘 provider 的資料寫進 CSV 卻搜尋不到。
 
+3. **倒排索引的分數一致性**。_search_csv 改走預先建好的倒排索引後，
+   分數必須與逐列呼叫 bm25_score() 的結果逐位元相同。
+
+4. **編譯索引檔的失效判斷**。來源 CSV 變動後不得再用舊索引。
+
+5. **跨域搜索**。search_federated 只分詞一次，結果必須與逐域搜索相同。
+
+6. **MaxScore 剪枝**。prune=True 只能省下計算，排序與分數不得改變。
+
+7. **稀疏矩陣後端**。backend='sparse' 的分數須與純 Python 評分一致
+   （浮點加總順序不同，容許 1e-9 誤差）；未安裝 NumPy / SciPy 時略過。
+
+8. **批次查詢**。search_batch 與 search.py --batch 的結果須與逐筆 search()
+   相同，且維持輸入順序；JSONL 壞行只回報錯誤，不中斷整批。
+
+9. **常駐服務**。search.py 經由 server.py 取得的結果須與行程內搜索相同；
+   服務未啟動或資料目錄不同時，客戶端回傳 None 讓呼叫端改走行程內搜索。
+   格式錯誤的請求一律回 400，不得斷線；CLI 只在明確開啟時才把查詢交給服務。
+
+10. **查詢結果快取**。重複查詢須命中快取且回傳副本；CSV 變動後不得
+    回傳舊結果。
+
+11. **關鍵字自動機**。detect_domain 的 Aho-Corasick 比對須與逐一
+    `keyword in query` 的計分完全相同（含重疊、重複與跨域的關鍵字）；
+    數千條關鍵字時純 Python 自動機只存 trie 的轉移，記憶體與關鍵字總長同階。
+
+12. **錯誤碼精確查詢**。'-10066' 之類的查詢須直接取回該碼的列（可加上
+    provider 限定），不像錯誤碼或未命中的查詢照舊走 BM25；'b2c'、'7-11' 等
+    含數字的一般詞不算碼，不會為它們建立碼索引。
+
+13. **BM25F 欄位權重**。BM25F 須明確開啟（field_weights，含空 dict）：
+    預設查詢與一般 BM25 相同，開啟時須與逐列、逐欄位計算的 BM25F 相同；
+    查詢時指定的權重只影響該次查詢。
+
+14. **輸入建議**。suggest() 的排序陣列前綴索引須與逐詞 startswith 掃描
+    相同（不分大小寫、端點可從任一路徑片段起比對），CLI 與常駐服務亦同。
+
+15. **模糊比對**。trigram 候選須與逐一計算整個詞彙的編輯距離結果相同；
+    拼對的查詢開啟 fuzzy 後結果不變，未開啟時行為不變。
+
+16. **分階段計時**。未啟用 --profile 時函數不得被包裝；啟用後各階段的
+    自身耗時扣除子階段、巢狀的同階段只計一次，且查詢結果不變。
+
+17. **啟動成本**。單筆查詢的常見呼叫不得匯入 argparse、csv、json 等只有
+    其他路徑用得到的模組（以 -X importtime 檢查）；免 argparse 的解析結果
+    須與 build_parser() 相同，不認得的參數一律交回 argparse。
+
+18. **欄式資料列**。RowStore 逐列取回的 dict 須與 csv.DictReader 相同，
+    重複的儲存格共用同一個字串，經索引檔存取後內容不變。
+
 使用方法:
     python test_search.py
 """
 
+import io
+import json
 import os
+import random
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, SCRIPT_DIR)
 
-from core import CSV_CONFIG, search, tokenize  # noqa: E402
+import core  # noqa: E402
+import engine  # noqa: E402
+from core import (  # noqa: E402
+    CSV_CONFIG, DATA_DIR, _load_csv, _search_csv, bm25_score, compute_idf,
+    search, search_federated, tokenize,
+)
 
 
 def check(label, condition, detail=''):
@@ -42,6 +106,24 @@ def test_tokenize():
     failed += check('保留中文單字', '紅' in toks and '陽' in toks)
     failed += check('產生中文 bigram', '紅陽' in toks)
     failed += check('空字串回傳空列表', tokenize('') == [])
+
+    # 單次掃描 + LRU 記憶的分詞必須與逐步分詞（英數 → 單字 → bigram）逐項相同
+    def reference(text):
+        text = text.lower()
+        chars = re.findall(r'[一-鿿]', text)
+        return (re.findall(r'[a-z0-9]+', text) + chars
+                + [chars[i] + chars[i + 1] for i in range(len(chars) - 1)])
+
+    texts = []
+    for cfg in CSV_CONFIG.values():
+        for row in _load_csv(os.path.join(DATA_DIR, cfg['file'])):
+            texts.append(' '.join(str(row.get(c, '')) for c in cfg['search_cols']))
+    mismatched = [t for t in texts if tokenize(t) != reference(t)]
+    failed += check('CSV 全部文字的分詞與逐步分詞相同', not mismatched, f'例: {mismatched[:1]}')
+
+    toks = tokenize('開立發票')
+    toks.append('汙染')
+    failed += check('修改回傳列表不影響記憶', tokenize('開立發票') == reference('開立發票'))
     return failed
 
 
@@ -76,7 +158,8 @@ def test_config_columns_exist():
             continue
         with open(path, encoding='utf-8') as f:
             header = f.readline().strip().split(',')
-        ghosts = [c for c in cfg['search_cols'] + cfg['output_cols'] if c not in header]
+        ghosts = [c for c in cfg['search_cols'] + cfg['output_cols'] + cfg.get('suggest_cols', [])
+                  if c not in header]
         failed += check(f'{domain} 域無不存在的欄位', not ghosts, f'{cfg["file"]} 沒有 {ghosts}')
     return failed
 
@@ -96,6 +179,812 @@ def test_search_finds_new_providers():
     return failed
 
 
+def _reference_search(query, domain, max_results):
+    """未建索引前的逐列算法，作為一致性比對的基準"""
+    cfg = CSV_CONFIG[domain]
+    rows = _load_csv(os.path.join(DATA_DIR, cfg['file']))
+    documents = [tokenize(' '.join(str(r.get(c, '')) for c in cfg['search_cols'])) for r in rows]
+    idf = compute_idf(documents)
+    avg_dl = sum(len(d) for d in documents) / len(documents) if documents else 1
+    q = tokenize(query)
+
+    results = []
+    for row, doc in zip(rows, documents):
+        score = bm25_score(q, doc, idf, avg_dl)
+        if score > 0:
+            result = {c: row.get(c, '') for c in cfg['output_cols']}
+            result['_score'] = round(score, 4)
+            results.append(result)
+    results.sort(key=lambda x: x['_score'], reverse=True)
+    return results[:max_results]
+
+
+def test_index_parity():
+    """倒排索引的結果必須與逐列 BM25 完全相同"""
+    failed = 0
+    queries = ['10000016', '-10066', 'B2B 稅額', '列印空白', 'ecpay 折讓 作廢',
+               'MerchantID RelateNumber', '開立 開立 發票']
+    for domain, cfg in CSV_CONFIG.items():
+        mismatched = [q for q in queries
+                      if _search_csv(q, domain, 10) != _reference_search(q, domain, 10)]
+        failed += check(f'{domain} 域索引結果與逐列計算一致', not mismatched,
+                        f'不一致的查詢: {mismatched}')
+    return failed
+
+
+def test_index_file_invalidation():
+    """CSV 變動後，編譯索引檔必須自動失效重建"""
+    failed = 0
+    saved = core.ENGINE.data_dir, core.ENGINE.index_dir
+    tmp = tempfile.mkdtemp()
+    try:
+        core.ENGINE.data_dir = os.path.join(tmp, 'data')
+        core.ENGINE.index_dir = os.path.join(tmp, '.index')
+        shutil.copytree(saved[0], core.ENGINE.data_dir)
+        core._INDEX_CACHE.clear()
+
+        built = core.build_all_indexes()
+        failed += check('build_all_indexes 為每個域寫出索引檔',
+                        all(os.path.exists(core._index_path(d)) for d in built))
+
+        loaded = core.load_index('tax')
+        failed += check('未變動時可直接載入索引檔',
+                        loaded is not None and len(loaded.rows) == built['tax'])
+
+        csv_path = os.path.join(core.ENGINE.data_dir, CSV_CONFIG['tax']['file'])
+        with open(csv_path, 'a', encoding='utf-8') as f:
+            f.write('測試用,應稅,0.05,,,,,,索引失效測試\n')
+        failed += check('CSV 變動後索引檔視為過期', core.load_index('tax') is None)
+        index = core.get_index('tax')
+        failed += check('get_index 自動重建並反映新資料',
+                        len(index.rows) == built['tax'] + 1,
+                        f'rows={len(index.rows)}')
+
+        os.utime(csv_path, ns=(0, 0))
+        failed += check('僅 mtime 變動、內容相同時沿用索引檔',
+                        core.load_index('tax') is not None)
+    finally:
+        core.ENGINE.data_dir, core.ENGINE.index_dir = saved
+        core._INDEX_CACHE.clear()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+
+def test_federated_search():
+    """跨域搜索的各域結果與全域排序"""
+    failed = 0
+    query = 'ecpay 折讓 錯誤'
+    result = search_federated(query, max_per_domain=3, top_k=5)
+
+    expected = {d: _search_csv(query, d, 3) for d in CSV_CONFIG}
+    expected = {d: r for d, r in expected.items() if r}
+    failed += check('各域結果與逐域搜索相同', result['domains'] == expected)
+
+    scores = [r['_score'] for r in result['top']]
+    failed += check('全域 top-k 依分數排序且標註來源域',
+                    scores == sorted(scores, reverse=True) and len(scores) == 5
+                    and all(r['_domain'] in CSV_CONFIG for r in result['top']))
+
+    best = max(r['_score'] for rs in result['domains'].values() for r in rs)
+    failed += check('全域第一名為各域最高分', scores[0] == best)
+
+    threaded = search_federated(query, max_per_domain=3, top_k=5, workers=4)
+    failed += check('執行緒池模式結果相同', threaded == result)
+    return failed
+
+
+def test_pruned_search_parity():
+    """剪枝模式的結果必須與完整評分相同"""
+    failed = 0
+    queries = ['ecpay 綠界 發票 開立 錯誤 金額 計算 b2b 稅額 載具 捐贈 列印',
+               '10000016 金額 錯誤', 'B2B 稅額', '列印空白 發票 ecpay smilepay amego']
+    for domain in CSV_CONFIG:
+        mismatched = [(q, k) for q in queries for k in (1, 3, 5)
+                      if search(q, domain, k, prune=True) != search(q, domain, k)]
+        failed += check(f'{domain} 域剪枝結果與完整評分一致', not mismatched,
+                        f'不一致: {mismatched}')
+    return failed
+
+
+def test_sparse_backend_parity():
+    """稀疏矩陣後端的分數與純 Python 評分一致"""
+    if not core.has_sparse_backend():
+        print('   [SKIP] 未安裝 numpy / scipy')
+        return 0
+
+    failed = 0
+    queries = ['10000016', 'B2B 稅額', 'ecpay 折讓 作廢', '開立 開立 發票', '查無此詞xyz']
+    tokenized = [tokenize(q) for q in queries]
+
+    def same(a, b):
+        return a.keys() == b.keys() and all(abs(a[k] - b[k]) < 1e-9 for k in a)
+
+    for domain in CSV_CONFIG:
+        index = core.get_index(domain)
+        sparse_index = core.get_sparse_index(domain)
+        expected = [core.score_index(index, q) for q in tokenized]
+        single = [sparse_index.score(q) for q in tokenized]
+        batch = sparse_index.score_many(tokenized)
+        failed += check(f'{domain} 域 score 與純 Python 一致',
+                        all(same(a, b) for a, b in zip(single, expected)))
+        failed += check(f'{domain} 域 score_many 與純 Python 一致',
+                        all(same(a, b) for a, b in zip(batch, expected)))
+
+    query = 'ecpay 折讓 錯誤'
+    failed += check('search(backend=\'sparse\') 結果相同',
+                    search(query, 'error', 5, backend='sparse') == search(query, 'error', 5))
+    return failed
+
+
+def test_search_batch():
+    """批次搜索與逐筆搜索結果相同"""
+    failed = 0
+    queries = ['ecpay 折讓', '10000016', 'B2B 稅額', '列印空白', '']
+    expected = [search(q) for q in queries]
+    failed += check('search_batch 與逐筆 search 相同', core.search_batch(queries) == expected)
+
+    items = [{'query': '統編', 'domain': 'field', 'max_results': 2}, 'B2B 稅額']
+    failed += check('dict 項目可覆寫域與結果數',
+                    core.search_batch(items, max_results=3)
+                    == [search('統編', 'field', 2), search('B2B 稅額', None, 3)])
+
+    saved = engine.BATCH_PROCESS_THRESHOLD
+    try:
+        engine.BATCH_PROCESS_THRESHOLD = 1
+        failed += check('多行程模式結果相同且保持順序',
+                        core.search_batch(queries * 3, processes=2) == expected * 3)
+    finally:
+        engine.BATCH_PROCESS_THRESHOLD = saved
+
+    import search as search_cli
+    stdin = io.StringIO('"10000016"\n\nnot json\n{"id": 1, "query": "統編", "domain": "field"}\n')
+    stdout = io.StringIO()
+    errors = search_cli.run_batch(stdin, stdout, max_results=2, chunk_size=2)
+    records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    failed += check('--batch 逐行輸出 JSONL 並回報壞行',
+                    errors == 1 and len(records) == 3
+                    and records[0]['results'] == search('10000016', None, 2)
+                    and records[1] == {'line': 3, 'error': records[1].get('error')}
+                    and records[2]['id'] == 1
+                    and records[2]['results'] == search('統編', 'field', 2))
+    return failed
+
+
+def test_search_daemon():
+    """常駐服務的結果與行程內搜索相同，服務不可用時客戶端回傳 None"""
+    import search as search_cli
+    import server
+
+    failed = 0
+    daemon = server.make_server('127.0.0.1', 0, skills=['invoice'], quiet=True)
+    port = daemon.server_address[1]
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    try:
+        payload = {'skill': 'invoice', 'query': 'ecpay 折讓', 'max_results': 3, 'data_dir': DATA_DIR}
+        reply = search_cli.query_daemon('/search', payload, port=port)
+        failed += check('服務結果與行程內搜索相同',
+                        reply is not None and reply['results'] == search('ecpay 折讓', None, 3))
+        failed += check('回應帶有處理時間', reply is not None and reply['elapsed_ms'] >= 0)
+
+        reply = search_cli.query_daemon('/search', {**payload, 'all': True}, port=port)
+        failed += check('全域搜索結果相同',
+                        reply is not None and reply['results'] == core.search_all('ecpay 折讓', 3))
+
+        reply = search_cli.query_daemon('/batch', {'skill': 'invoice', 'queries': ['10000016', 'B2B 稅額']},
+                                        port=port)
+        failed += check('批次查詢結果相同',
+                        reply is not None and reply['results'] == [search('10000016'), search('B2B 稅額')])
+
+        failed += check('資料目錄不同時拒絕回應',
+                        search_cli.query_daemon('/search', {**payload, 'data_dir': tempfile.gettempdir()},
+                                                port=port) is None)
+        failed += check('未載入的 skill 拒絕回應',
+                        search_cli.query_daemon('/search', {**payload, 'skill': 'nope'}, port=port) is None)
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+
+    failed += check('服務未啟動時回傳 None',
+                    search_cli.query_daemon('/search', payload, port=port, timeout=1) is None)
+    return failed
+
+
+def _post_status(port, path, body):
+    """送出原始請求，回傳 HTTP 狀態碼；連線未回應就斷開時回傳 None"""
+    import http.client
+
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        data = body if isinstance(body, bytes) else json.dumps(body).encode('utf-8')
+        conn.request('POST', path, data, {'Content-Type': 'application/json'})
+        return conn.getresponse().status
+    except (OSError, http.client.HTTPException):
+        return None
+    finally:
+        conn.close()
+
+
+def test_daemon_bad_requests():
+    """格式錯誤的請求回 400 而非斷線；CLI 預設不使用埠上的服務"""
+    import http.server
+    import server
+
+    failed = 0
+    daemon = server.make_server('127.0.0.1', 0, skills=['invoice'], quiet=True)
+    port = daemon.server_address[1]
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    try:
+        bad = [
+            ('/batch', {'skill': 'invoice', 'queries': [42]}),
+            ('/batch', {'skill': 'invoice', 'queries': [None, 'B2B']}),
+            ('/batch', {'skill': 'invoice', 'queries': [{'query': ['B2B']}]}),
+            ('/batch', {'skill': 'invoice', 'queries': [{'query': 'B2B', 'domain': 'nope'}]}),
+            ('/batch', {'skill': 'invoice', 'queries': [{'query': 'B2B', 'max_results': '3'}]}),
+            ('/search', {'skill': 'invoice', 'query': 'B2B', 'domain': ['error']}),
+            ('/search', {'skill': 'invoice', 'query': 'B2B', 'max_results': True}),
+            ('/suggest', {'skill': 'invoice', 'prefix': 'b2', 'limit': 0}),
+            ('/search', b'{"skill": "invoice", "query": '),
+        ]
+        statuses = [_post_status(port, path, body) for path, body in bad]
+        failed += check('格式錯誤的請求回 400', statuses == [400] * len(bad), f'{statuses}')
+        failed += check('skill 非字串時回 404',
+                        _post_status(port, '/search', {'skill': ['invoice'], 'query': 'B2B'}) == 404)
+        failed += check('路徑含 NUL 時視為資料目錄不同',
+                        _post_status(port, '/search', {'skill': 'invoice', 'query': 'B2B',
+                                                       'data_dir': 'a\0b'}) == 409)
+        failed += check('之後的正常請求照常回應',
+                        _post_status(port, '/batch', {'skill': 'invoice',
+                                                      'queries': ['B2B', {'query': '統編', 'domain': 'field'}]})
+                        == 200)
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+
+    class FakeDaemon(http.server.BaseHTTPRequestHandler):
+        """佔用服務埠、回傳假結果的程式"""
+
+        def do_POST(self):
+            data = json.dumps({'results': [{'provider': 'FAKE-DAEMON'}]}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    fake = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeDaemon)
+    thread = threading.Thread(target=fake.serve_forever, daemon=True)
+    thread.start()
+    try:
+        env = {k: v for k, v in os.environ.items() if k not in (engine.PROFILE_ENV, 'TAIWAN_SEARCH_DAEMON')}
+        env.update(TAIWAN_SEARCH_HOST='127.0.0.1', TAIWAN_SEARCH_PORT=str(fake.server_address[1]))
+        command = [sys.executable, os.path.join(SCRIPT_DIR, 'search.py'), 'ecpay', '-d', 'provider',
+                   '-f', 'json']
+
+        def run(extra=(), **more_env):
+            result = subprocess.run(command + list(extra), capture_output=True, text=True,
+                                    encoding='utf-8', env={**env, **more_env})
+            return result.stdout
+
+        failed += check('預設不使用埠上的服務', 'FAKE-DAEMON' not in run() and 'ecpay' in run().lower())
+        failed += check('--daemon 時交給服務', 'FAKE-DAEMON' in run(['--daemon']))
+        failed += check('TAIWAN_SEARCH_DAEMON=1 時交給服務',
+                        'FAKE-DAEMON' in run(TAIWAN_SEARCH_DAEMON='1'))
+        failed += check('--no-daemon 優先於環境變數',
+                        'FAKE-DAEMON' not in run(['--no-daemon'], TAIWAN_SEARCH_DAEMON='1'))
+    finally:
+        fake.shutdown()
+        fake.server_close()
+    return failed
+
+
+def test_query_cache():
+    """LRU 查詢快取的命中、淘汰與資料更新後失效"""
+    failed = 0
+    saved_cache = core.ENGINE.cache
+    core.ENGINE.cache = core.QueryCache()
+    try:
+        first = search('B2B 稅額')
+        first[0]['_score'] = -1
+        again = search('  b2b 稅額 ')
+        stats = core.cache_stats()
+        failed += check('正規化後相同的查詢命中快取',
+                        stats['hits'] >= 2 and again == _search_csv('B2B 稅額', 'tax', 5),
+                        f'stats={stats}')
+        failed += check('修改回傳結果不影響快取', again[0]['_score'] != -1)
+
+        cache = core.QueryCache(maxsize=2)
+        for key in ('a', 'b', 'a', 'c'):
+            cache.put((key,), (), key)
+        failed += check('超過容量時淘汰最久未用的項目',
+                        cache.get(('b',), ())[0] is False and cache.get(('a',), ())[0]
+                        and cache.stats()['evictions'] == 1)
+    finally:
+        core.ENGINE.cache = saved_cache
+
+    saved = core.ENGINE.data_dir, core.ENGINE.index_dir
+    tmp = tempfile.mkdtemp()
+    try:
+        core.ENGINE.data_dir = os.path.join(tmp, 'data')
+        core.ENGINE.index_dir = os.path.join(tmp, '.index')
+        shutil.copytree(saved[0], core.ENGINE.data_dir)
+        core._INDEX_CACHE.clear()
+
+        query = '快取失效測試'
+        before = search(query, 'tax')
+        with open(os.path.join(core.ENGINE.data_dir, CSV_CONFIG['tax']['file']), 'a', encoding='utf-8') as f:
+            f.write('測試用,應稅,0.05,,,,,,快取失效測試\n')
+        after = search(query, 'tax')
+        failed += check('CSV 變動後不回傳快取中的舊結果',
+                        len(after) == len(before) + 1 and core.cache_stats()['invalidations'] >= 1,
+                        f'before={len(before)} after={len(after)}')
+    finally:
+        core.ENGINE.data_dir, core.ENGINE.index_dir = saved
+        core._INDEX_CACHE.clear()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+
+def _naive_keyword_counts(groups, text):
+    return {g: sum(1 for k in keywords if k in text) for g, keywords in groups.items()}
+
+
+def test_keyword_matcher():
+    """Aho-Corasick 比對結果與逐一子字串檢查相同"""
+    failed = 0
+    groups = {'a': ['he', 'she', 'his', 'hers'], 'b': ['he', 'he', 's', '發票', '票']}
+    texts = ['ushers', 'hishe', '', '電子發票 she', 'xyz']
+    backends = [False] + ([True] if core.HAS_AHOCORASICK else [])
+    for use_c in backends:
+        matcher = core.KeywordMatcher(groups, use_c=use_c)
+        label = 'pyahocorasick' if use_c else '純 Python'
+        failed += check(f'{label}：重疊、重複關鍵字的計數正確',
+                        all(matcher.counts(t) == _naive_keyword_counts(groups, t) for t in texts))
+
+    lowered = {d: [k.lower() for k in ks] for d, ks in core.DOMAIN_KEYWORDS.items()}
+    queries = ['ECPay B2C 開立', '10000016 error', '列印空白問題', '推薦適合的加值中心',
+               'MerchantID 欄位', 'B2B 稅額計算', '-1 fail', '']
+    matcher = core._domain_matcher()
+    failed += check('DOMAIN_KEYWORDS 各域計分與逐一比對相同',
+                    all(matcher.counts(q.lower()) == _naive_keyword_counts(lowered, q.lower())
+                        for q in queries))
+
+    # 數千條中文關鍵字：純 Python 自動機只存 trie 的轉移（與狀態數同階），結果仍與逐一比對相同
+    rng = random.Random(22)
+    alphabet = [chr(0x4e00 + i) for i in range(300)]
+    keywords = {''.join(rng.choice(alphabet) for _ in range(rng.randint(2, 4))) for _ in range(5000)}
+    big = {f'k{i}': [k] for i, k in enumerate(sorted(keywords))}
+    matcher = core.KeywordMatcher(big, use_c=False)
+    transitions = sum(len(edges) for edges in matcher._goto)
+    failed += check(f'{len(big)} 條關鍵字的轉移數與 trie 邊數相同 ({transitions})',
+                    transitions == len(matcher._goto) - 1)
+    texts = [''.join(rng.choice(alphabet) for _ in range(rng.randint(5, 80))) for _ in range(200)]
+    texts += [rng.choice(sorted(keywords)) * 2 for _ in range(20)]
+    failed += check(f'{len(big)} 條關鍵字比對 {len(texts)} 段文字與逐一比對相同',
+                    all(matcher.counts(t) == _naive_keyword_counts(big, t) for t in texts))
+    return failed
+
+
+def test_exact_code_lookup():
+    """錯誤碼查詢走碼索引，其餘查詢結果不變"""
+    failed = 0
+    core.ENGINE.cache.clear()
+
+    results = search('-10066')
+    failed += check("'-10066' 自動定位到 error 域並只回傳該碼",
+                    [(r['provider'], r['code']) for r in results] == [('SmilePay', '-10066')],
+                    f'got {[(r["provider"], r["code"]) for r in results]}')
+    failed += check('查詢前的域判斷為 error', core.resolve_domain('10000016') == 'error')
+
+    failed += check("'ecpay 10000016' 與 '10000016 ECPay' 皆命中",
+                    [r['code'] for r in search('ecpay 10000016')] == ['10000016']
+                    and [r['code'] for r in search('10000016 ECPay')] == ['10000016'])
+    failed += check('provider 不符時不強制命中，改走 BM25',
+                    core._exact_search('smilepay 10000016', 'error', 5) is None)
+    exact = core._exact_search('error 10000016', 'error', 5)
+    failed += check("'error 10000016' 的 error 不是服務商，不限服務商直接命中",
+                    exact is not None and [r['code'] for r in exact] == ['10000016'],
+                    f'got {exact}')
+
+    ordinary = ['b2c', 'b2b 發票', '7-11 取貨', 'ecpay b2c', 'mig4.0']
+    failed += check('含數字的一般詞不像碼', all(engine._parse_code_query(q) is None for q in ordinary),
+                    f'{[q for q in ordinary if engine._parse_code_query(q) is not None]}')
+    saved = core.ENGINE.indexes.pop('error', None)
+    try:
+        for q in ordinary:
+            core.resolve_domain(q)
+        failed += check('一般查詢的域判斷不建立 error 域的碼索引', 'error' not in core.ENGINE.indexes)
+    finally:
+        if saved is not None:
+            core.ENGINE.indexes['error'] = saved
+    data_codes = [row['code'].lower() for row in _load_csv(os.path.join(DATA_DIR, CSV_CONFIG['error']['file']))]
+    failed += check('error-codes.csv 含數字或底線的碼都符合碼的形狀',
+                    all(engine._parse_code_query(c) == (None, c) for c in data_codes
+                        if any(ch.isdigit() or ch == '_' for ch in c)))
+    failed += check('未知的碼照舊走 BM25',
+                    search('99999999', domain='error') == _search_csv('99999999', 'error', 5))
+    failed += check('非錯誤碼查詢不受影響',
+                    search('金額錯誤', domain='error') == _search_csv('金額錯誤', 'error', 5))
+
+    rows = core.lookup_code('10000016', provider='ECPAY')
+    failed += check('lookup_code 不分大小寫、回傳原始列',
+                    len(rows) == 1 and rows[0]['solution'].startswith('檢查 SalesAmount'))
+    rows[0]['code'] = 'mutated'
+    failed += check('lookup_code 回傳副本', core.lookup_code('10000016')[0]['code'] == '10000016')
+
+    queries = ['-10066', 'ecpay 10000016', '發票作廢', '10000001']
+    failed += check('search_batch 與逐筆 search() 相同',
+                    core.search_batch(queries) == [search(q) for q in queries])
+
+    probe = ('import sys; sys.path.append(sys.argv[1]); paths = list(sys.path); import error_handler; '
+             'print(sys.path == paths and "core" not in sys.modules)')
+    result = subprocess.run([sys.executable, '-c', probe, SCRIPT_DIR], capture_output=True, text=True)
+    failed += check('匯入 error_handler 不改動 sys.path、不匯入 core', result.stdout.strip() == 'True',
+                    result.stderr[-300:])
+    from error_handler import InvoiceErrorHandler
+    info = InvoiceErrorHandler('ecpay').get_error_info('10000001')
+    failed += check('error_handler 以 CSV 補足未內建的錯誤碼',
+                    info.message == '參數錯誤' and info.suggestion == '檢查必填欄位是否完整',
+                    f'got {info}')
+    return failed
+
+
+def _reference_bm25f(query, domain, max_results, weights):
+    """逐列、逐欄位計算的 BM25F，作為 BM25F 索引的比對基準"""
+    cfg = CSV_CONFIG[domain]
+    fields = cfg['search_cols']
+    rows = _load_csv(os.path.join(DATA_DIR, cfg['file']))
+    field_tokens = [[tokenize(str(r.get(c, ''))) for c in fields] for r in rows]
+    avg_lens = [sum(len(per[f]) for per in field_tokens) / len(rows) for f in range(len(fields))]
+    idf = compute_idf([[t for tokens in per for t in tokens] for per in field_tokens])
+    q = tokenize(query)
+
+    results = []
+    for row, per in zip(rows, field_tokens):
+        score = 0.0
+        for term in q:
+            tf = 0.0
+            for f, tokens in enumerate(per):
+                count = tokens.count(term)
+                if count and weights.get(fields[f], 1.0):
+                    tf += weights.get(fields[f], 1.0) * (count / (1 - 0.75 + 0.75 * (len(tokens) / avg_lens[f])))
+            if tf:
+                score += idf[term] * (tf * 2.5 / (tf + 1.5))
+        if score > 0:
+            result = {c: row.get(c, '') for c in cfg['output_cols']}
+            result['_score'] = round(score, 4)
+            results.append(result)
+    results.sort(key=lambda x: x['_score'], reverse=True)
+    return results[:max_results]
+
+
+def test_bm25f():
+    """BM25F 須明確開啟；開啟時分數與逐欄位計算一致，查詢時權重可覆寫設定"""
+    failed = 0
+    core.ENGINE.cache.clear()
+    weights = CSV_CONFIG['error']['field_weights']
+    queries = ['金額 錯誤', 'ecpay 簽章', 'CheckMacValue 驗證失敗', 'amego 發票號碼', '重複 開立', '稅額']
+
+    mismatched = [q for q in queries
+                  if search(q, 'error', 10) != _reference_search(q, 'error', 10)]
+    failed += check('error 域預設仍為一般 BM25', not mismatched, f'不一致的查詢: {mismatched}')
+    failed += check('BM25F 確實改變排序（開啟與否有差別）',
+                    any(_search_csv(q, 'error', 10, field_weights={}) != _search_csv(q, 'error', 10)
+                        for q in queries))
+    mismatched = [q for q in queries
+                  if _search_csv(q, 'error', 10, field_weights={}) != _reference_bm25f(q, 'error', 10, weights)]
+    failed += check('error 域 BM25F 與逐欄位計算一致', not mismatched, f'不一致的查詢: {mismatched}')
+
+    boost = {'solution': 3.0, 'code': 0.0}
+    mismatched = [q for q in queries
+                  if search(q, 'error', 10, field_weights=boost)
+                  != _reference_bm25f(q, 'error', 10, {**weights, **boost})]
+    failed += check('查詢時指定的權重與逐欄位計算一致', not mismatched, f'不一致的查詢: {mismatched}')
+    failed += check('指定與設定相同的權重時結果不變',
+                    all(search(q, 'error', 10, field_weights=weights) == search(q, 'error', 10, field_weights={})
+                        for q in queries))
+    failed += check('查詢時權重不影響之後的預設查詢',
+                    search('金額 錯誤', 'error', 10) == _reference_search('金額 錯誤', 'error', 10))
+    failed += check('剪枝與 BM25F 相容',
+                    all(_search_csv(q, 'error', 3, prune=True, field_weights={})
+                        == _search_csv(q, 'error', 3, field_weights={})
+                        for q in queries))
+
+    for label, domain, boost in [('未設定 field_weights 的域', 'tax', {'notes': 2.0}),
+                                 ('不在 search_cols 的欄位', 'error', {'severity': 2.0})]:
+        try:
+            search('稅額', domain, 5, field_weights=boost)
+            raised = False
+        except ValueError:
+            raised = True
+        failed += check(f'{label}拋出 ValueError', raised)
+    failed += check('未知的域指定權重時與未指定相同，回傳空結果',
+                    search('稅額', 'no-such-domain', 5, field_weights={'notes': 2.0}) == []
+                    == search('稅額', 'no-such-domain', 5))
+
+    saved = core.ENGINE.index_dir
+    tmp = tempfile.mkdtemp()
+    try:
+        core.ENGINE.index_dir = tmp
+        built = core.build_index('error')
+        core.save_index('error', built)
+        loaded = core.load_index('error')
+        failed += check('BM25F 索引檔可存取',
+                        loaded is not None and loaded.postings == built.postings
+                        and loaded.field_postings == built.field_postings and loaded.fields == built.fields
+                        and loaded.field_idf == built.field_idf)
+    finally:
+        core.ENGINE.index_dir = saved
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+
+def _reference_suggest(prefix, domain, limit):
+    """逐詞比對所有鍵，作為前綴索引的對照"""
+    prefix = prefix.lower()
+    matches = []
+    for d in ([domain] if domain else [d for d, cfg in CSV_CONFIG.items() if 'suggest_cols' in cfg]):
+        for term, cols in core.prefix_index(d).terms:
+            key = term.lower()
+            keys = [key] + [key[i + 1:] for i, c in enumerate(key) if c == '/' and key[i + 1:]]
+            hits = sorted(k for k in keys if k.startswith(prefix))
+            if hits:
+                matches.append((hits[0], term, d, cols))
+    matches.sort(key=lambda m: m[0])
+    return [{'text': term, 'domain': d, 'columns': list(cols)} for _, term, d, cols in matches[:limit]]
+
+
+def test_suggest():
+    """前綴建議與逐詞掃描相同，CLI 與常駐服務回傳相同結果"""
+    import search as search_cli
+    import server
+
+    failed = 0
+    names = [item['text'] for item in core.suggest('relate', 'field')]
+    failed += check('欄位名可前綴查詢', 'RelateNumber' in names, f'{names}')
+    failed += check('不分大小寫', core.suggest('RELATE', 'field') == core.suggest('relate', 'field'))
+    endpoints = [item['text'] for item in core.suggest('invoice', 'operation', 50)]
+    failed += check('端點可從路徑片段起比對',
+                    '/B2CInvoice/InvoicePrint' in endpoints and '/invoice/issue' in endpoints, f'{endpoints}')
+    failed += check('括號附註與佔位值不列入建議',
+                    all(not t.startswith(('(', 'n/a')) for t, _ in core.prefix_index('field').terms))
+    failed += check('錯誤碼可前綴查詢',
+                    any(item['text'] == '-10066' for item in core.suggest('-100', 'error', 50)))
+    failed += check('空白前綴回傳空列表', core.suggest('  ') == [])
+    failed += check('未設定 suggest_cols 的域回傳空列表', core.suggest('b2b', 'tax') == [])
+    failed += check('前綴索引隨 DomainIndex 保留',
+                    core.prefix_index('field') is core.prefix_index('field'))
+
+    prefixes = ['b', 'B2C', '/b2b', 'merchant', 'i', 'invoice', '10', '-1', 'query', 'zz', '/']
+    mismatched = [(p, d, n) for p in prefixes for d in (None, 'field', 'operation', 'error') for n in (1, 5, 100)
+                  if core.suggest(p, d, n) != _reference_suggest(p, d, n)]
+    failed += check('與逐詞掃描結果相同', not mismatched, f'不一致: {mismatched[:5]}')
+
+    stdout = io.StringIO()
+    search_cli.stream_suggestions(io.StringIO('relate\n/b2c\n'), stdout, None, 3, use_daemon=False)
+    records = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    failed += check('--suggest 逐行串流輸出 JSONL',
+                    [r['prefix'] for r in records] == ['relate', '/b2c']
+                    and records[1]['suggestions'] == core.suggest('/b2c', None, 3))
+
+    daemon = server.make_server('127.0.0.1', 0, skills=['invoice'], quiet=True)
+    port = daemon.server_address[1]
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    try:
+        reply = search_cli.query_daemon('/suggest', {'skill': 'invoice', 'prefix': 'b2c', 'limit': 4,
+                                                     'data_dir': DATA_DIR}, port=port)
+        failed += check('常駐服務的建議與行程內相同',
+                        reply is not None and reply['results'] == core.suggest('b2c', None, 4))
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+    return failed
+
+
+def test_fuzzy():
+    """trigram 候選與全詞彙編輯距離掃描相同，拼錯的識別字可修正"""
+    import server
+    import search as search_cli
+
+    failed = 0
+    failed += check('相鄰對調算一次編輯', engine._edit_distance('vaule', 'value', 2) == 1)
+    failed += check('超過上限提前回傳 limit + 1', engine._edit_distance('abcdef', 'uvwxyz', 2) == 3)
+
+    typos = ['relatenumbr', 'custmeridentifier', 'alowance', 'invocie', 'lovecod', 'carriernumm',
+             'b2cinvoce', 'taxamuont', 'zzzzzz', 'merchantid']
+    mismatched = []
+    for domain in ('field', 'operation', 'troubleshoot'):
+        index = core.get_index(domain)
+        fuzzy = engine.FuzzyIndex(index.postings)
+        for token in typos:
+            k = 1 if len(token) < engine.FUZZY_LONG_TERM else 2
+            expected = sorted(t for t in fuzzy.terms if engine._edit_distance(token, t, k) <= k)
+            if sorted(t for _, t in fuzzy.candidates(token, k)) != expected:
+                mismatched.append((domain, token))
+    failed += check('trigram 候選與全詞彙掃描相同', not mismatched, f'不一致: {mismatched}')
+
+    failed += check('未開啟 fuzzy 時拼錯的詞找不到', search('RelateNumbr', 'troubleshoot') == [])
+    fixed = search('RelateNumbr', 'troubleshoot', 3, fuzzy=True)
+    failed += check('開啟 fuzzy 後修正為詞彙中的詞',
+                    fixed == search('RelateNumber', 'troubleshoot', 3) and fixed != [])
+    failed += check('中文與詞彙中已有的詞不修正',
+                    core.ENGINE.correct_tokens('field', tokenize('RelateNumber 統編'))
+                    == tokenize('RelateNumber 統編'))
+    queries = ['ecpay 折讓', '統編', 'B2B 稅額', 'CarrierType', '列印空白']
+    failed += check('拼對的查詢開啟 fuzzy 後結果不變',
+                    all(search(q, None, 5, fuzzy=True) == search(q) for q in queries))
+    failed += check('跨域搜索也可修正',
+                    'troubleshoot' in core.search_all('RelateNumbr', 3, fuzzy=True)
+                    and 'troubleshoot' not in core.search_all('RelateNumbr', 3))
+
+    daemon = server.make_server('127.0.0.1', 0, skills=['invoice'], quiet=True)
+    port = daemon.server_address[1]
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    try:
+        reply = search_cli.query_daemon('/search', {'skill': 'invoice', 'query': 'RelateNumbr',
+                                                    'domain': 'troubleshoot', 'max_results': 3,
+                                                    'fuzzy': True, 'data_dir': DATA_DIR}, port=port)
+        failed += check('常駐服務支援 fuzzy', reply is not None and reply['results'] == fixed)
+    finally:
+        daemon.shutdown()
+        daemon.server_close()
+    return failed
+
+
+def test_profiler():
+    """未啟用時不包裝；自身耗時扣除子階段；--profile 不改變輸出"""
+    import types
+
+    failed = 0
+    failed += check('未啟用時 core 的函數維持原樣',
+                    not engine.PROFILER.enabled and engine.tokenize is core.tokenize
+                    and not hasattr(engine.SearchEngine._materialize, '__profiled__'))
+
+    def inner(n):
+        return n if n <= 0 else namespace.inner(n - 1)
+
+    def outer():
+        return namespace.inner(2)
+
+    namespace = types.SimpleNamespace(inner=inner, outer=outer)
+    profiler = engine.Profiler()
+    profiler.instrument(namespace, ['inner'], 'inner')
+    failed += check('instrument() 在 enable() 之前不做任何事', namespace.inner is inner)
+
+    profiler.enabled = True
+    profiler.instrument(namespace, ['inner'], 'inner')
+    profiler.instrument(namespace, ['outer'], 'outer')
+    wrapped = namespace.inner
+    profiler.instrument(namespace, ['inner'], 'inner')
+    failed += check('不重複包裝', namespace.inner is wrapped)
+    namespace.outer()
+    calls, total, own, depth = profiler.stats['inner']
+    outer_calls, outer_total, outer_own, _ = profiler.stats['outer']
+    failed += check('巢狀同階段：次數全計、總耗時只計最外層',
+                    calls == 3 and depth == 0 and own <= total + 1e-9 and total <= outer_total)
+    failed += check('外層自身耗時扣除子階段',
+                    outer_calls == 1 and abs(outer_own - (outer_total - total)) < 1e-9)
+
+    for spec, expected in [('table', ('table', None)), ('1', ('table', None)), ('JSON', ('json', None)),
+                           ('cprofile:/tmp/x.prof', ('cprofile', '/tmp/x.prof'))]:
+        failed += check(f'parse_profile_mode({spec!r})', engine.parse_profile_mode(spec) == expected)
+    for spec in ('bogus', 'json:/tmp/x'):
+        try:
+            engine.parse_profile_mode(spec)
+            failed += check(f'{spec!r} 拋出 ValueError', False)
+        except ValueError:
+            failed += check(f'{spec!r} 拋出 ValueError', True)
+
+    command = [sys.executable, os.path.join(SCRIPT_DIR, 'search.py'), 'ecpay 折讓', '-d', 'operation',
+               '-f', 'json', '--no-daemon']
+    env = {k: v for k, v in os.environ.items() if k != engine.PROFILE_ENV}
+    plain = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', env=env)
+    profiled = subprocess.run(command + ['--profile', 'json'], capture_output=True, text=True,
+                              encoding='utf-8', env=env)
+    try:
+        report = json.loads(profiled.stderr.strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        report = {}
+    failed += check('--profile 不改變 stdout 的結果',
+                    profiled.returncode == 0 and profiled.stdout == plain.stdout)
+    failed += check('JSON 報告含分詞、評分與排序階段',
+                    {'tokenize', 'bm25_score', 'sort'} <= set(report.get('stages', {}))
+                    and report['stages']['sort']['calls'] == 1,
+                    f'stderr: {profiled.stderr[-300:]}')
+
+    env[engine.PROFILE_ENV] = 'table'
+    by_env = subprocess.run(command, capture_output=True, text=True, encoding='utf-8', env=env)
+    failed += check(f'${engine.PROFILE_ENV} 等同 --profile',
+                    by_env.stdout == plain.stdout and '[profile] search.py' in by_env.stderr)
+    return failed
+
+
+def _imported_modules(args):
+    """以 -X importtime 執行 search.py，回傳 (結果, 匯入過的模組名稱)"""
+    env = {k: v for k, v in os.environ.items() if k != engine.PROFILE_ENV}
+    result = subprocess.run([sys.executable, '-X', 'importtime', os.path.join(SCRIPT_DIR, 'search.py')]
+                            + args, capture_output=True, text=True, encoding='utf-8', env=env)
+    modules = {line.rsplit('|', 1)[-1].strip() for line in result.stderr.splitlines()
+               if line.startswith('import time:')}
+    return result, modules
+
+
+def test_startup():
+    """單筆查詢不匯入用不到的模組；快速解析與 argparse 結果相同"""
+    import search as search_cli
+
+    failed = 0
+    deferred = {'argparse', 'csv', 'json', 'hashlib', 'dataclasses', 'concurrent.futures'}
+    argv = ['ecpay 折讓', '-d', 'operation', '-n', '2', '--no-daemon']
+    # 第一次執行可能要從 CSV 建立索引檔（會匯入 csv），量第二次
+    _imported_modules(argv)
+    result, modules = _imported_modules(argv)
+    failed += check('單筆查詢成功', result.returncode == 0 and 'ecpay' in result.stdout.lower(),
+                    result.stderr[-300:])
+    failed += check('單筆查詢不匯入 argparse / csv / json 等模組', not deferred & modules,
+                    f'匯入了: {sorted(deferred & modules)}')
+
+    result, modules = _imported_modules(['ecpay', '--list'])
+    failed += check('其他參數改走 argparse', result.returncode == 0 and 'argparse' in modules)
+
+    for argv in (['ecpay 折讓'], ['10000016', '-d', 'error', '-n', '3'], ['稅額', '--domain=tax', '-f', 'json'],
+                 ['ECPay', '-a', '--max-results', '2', '--fuzzy', '--no-daemon'], ['B2B', '-f', 'md']):
+        fast = search_cli.parse_simple_args(argv, search_cli.FAST_OPTIONS, search_cli.FAST_DEFAULTS)
+        full = search_cli.build_parser().parse_args(argv)
+        failed += check(f'快速解析 {argv} 與 argparse 相同', fast is not None and vars(fast) == vars(full),
+                        f'{fast} != {full}')
+    for argv in ([], ['-10066'], ['ecpay', '--help'], ['ecpay', '-d', 'nope'], ['ecpay', '-n', 'x'],
+                 ['ecpay', '-n'], ['ecpay', 'extra'], ['ecpay', '--boost', 'code=2'], ['ecpay', '--fuzzy=1'],
+                 ['ecpay', '--dom', 'tax']):
+        failed += check(f'{argv} 交回 argparse',
+                        search_cli.parse_simple_args(argv, search_cli.FAST_OPTIONS,
+                                                     search_cli.FAST_DEFAULTS) is None)
+    return failed
+
+
+def test_row_store():
+    """RowStore 與 DictReader 的 dict 列表等價，且共用重複的字串"""
+    failed = 0
+    for domain, cfg in CSV_CONFIG.items():
+        path = os.path.join(DATA_DIR, cfg['file'])
+        expected = _load_csv(path)
+        store = engine.read_rows(path)
+        failed += check(f'{domain} 域逐列內容與 DictReader 相同',
+                        len(store) == len(expected) and list(store) == expected
+                        and all(store[i] == row for i, row in enumerate(expected)))
+
+    store = engine.read_rows(os.path.join(DATA_DIR, CSV_CONFIG['error']['file']))
+    providers = store.column('provider')
+    failed += check('重複的儲存格共用同一個字串物件',
+                    len({id(v) for v in providers}) == len(set(providers)))
+    failed += check('不存在的欄位視為空字串',
+                    store.value(0, 'nope') == '' and store.column('nope') == [''] * len(store))
+
+    short = engine.RowStore.from_records(['a', 'b', 'c'], [['1', '2'], [], ['3', '4', '5', '6']])
+    failed += check('欄數不足補空字串、多出捨棄、空行略過',
+                    list(short) == [{'a': '1', 'b': '2', 'c': ''}, {'a': '3', 'b': '4', 'c': '5'}])
+    failed += check('缺少的 CSV 檔為空的 RowStore',
+                    len(engine.read_rows(os.path.join(DATA_DIR, 'missing.csv'))) == 0)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        fresh = engine.SearchEngine('invoice', CSV_CONFIG, core.DOMAIN_KEYWORDS, DATA_DIR, tmp)
+        index = fresh.build_index('error')
+        fresh.save_index('error', index)
+        loaded = fresh.load_index('error')
+        failed += check('索引檔存取後資料列不變',
+                        loaded is not None and loaded.rows.columns == index.rows.columns
+                        and loaded.rows.data == index.rows.data)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failed
+
+
 def main():
     print('=' * 60)
     print('搜尋引擎回歸測試 (taiwan-invoice)')
@@ -114,6 +1003,55 @@ def main():
     print('\n4. 新 provider 可搜尋')
     failed += test_search_finds_new_providers()
 
+    print('\n5. 倒排索引一致性')
+    failed += test_index_parity()
+
+    print('\n6. 編譯索引檔失效')
+    failed += test_index_file_invalidation()
+
+    print('\n7. 跨域搜索')
+    failed += test_federated_search()
+
+    print('\n8. MaxScore 剪枝')
+    failed += test_pruned_search_parity()
+
+    print('\n9. 稀疏矩陣後端')
+    failed += test_sparse_backend_parity()
+
+    print('\n10. 批次查詢')
+    failed += test_search_batch()
+
+    print('\n11. 常駐服務')
+    failed += test_search_daemon()
+    failed += test_daemon_bad_requests()
+
+    print('\n12. 查詢結果快取')
+    failed += test_query_cache()
+
+    print('\n13. 關鍵字自動機')
+    failed += test_keyword_matcher()
+
+    print('\n14. 錯誤碼精確查詢')
+    failed += test_exact_code_lookup()
+
+    print('\n15. BM25F 欄位權重')
+    failed += test_bm25f()
+
+    print('\n16. 輸入建議')
+    failed += test_suggest()
+
+    print('\n17. 模糊比對')
+    failed += test_fuzzy()
+
+    print('\n18. 分階段計時')
+    failed += test_profiler()
+
+    print('\n19. 啟動成本')
+    failed += test_startup()
+
+    print('\n20. 欄式資料列')
+    failed += test_row_store()
+
     print('\n' + '=' * 60)
     if failed:
         print(f'[FAIL] {failed} 項未通過')
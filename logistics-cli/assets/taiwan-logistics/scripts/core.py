@@ -18,17 +18,31 @@ Taiwan Logistics BM25 搜索引擎
     all_results = search_all("配送失敗", max_per_domain=3)
 """
 
-import csv
-import math
-import re
-from pathlib import Path
-from typing import List, Dict, Optional, Tuple
 import json
+import os
+from pathlib import Path
+
+from engine import (  # noqa: F401  -- 沿用舊名稱的匯出
+    BATCH_PROCESS_THRESHOLD, HAS_AHOCORASICK, MIN_RULE_MATCH, PROFILE_ENV, PROFILER, DomainIndex,
+    FileSnapshot, KeywordMatcher, KeywordRules, PrefixIndex, Profiler, QueryCache, RowStore,
+    RuleTable, SearchEngine, SparseIndex, Watcher, bm25_score, cli_field_weights, compute_idf,
+    file_snapshot, has_sparse_backend, map_batch, match_tokens, parse_field_weights,
+    parse_profile_mode, parse_simple_args, read_csv, read_rows, rule_match_score, rule_table,
+    score_index, score_index_pruned, start_profiling, tokenize,
+)
 
 # 數據文件路徑
 SCRIPT_DIR = Path(__file__).parent
 DATA_DIR = SCRIPT_DIR.parent / 'data'
 
+# 編譯後的索引檔放在 data/ 旁邊，由 search.py --build-index 產生，
+# 查詢時若來源 CSV 有變動會自動重建
+INDEX_DIR = SCRIPT_DIR.parent / '.index'
+
+# 評分後端：'python'（預設，無外部依賴）或 'sparse'（需 NumPy + SciPy，
+# 適合數萬筆以上的語料與批次查詢）
+SEARCH_BACKEND = os.environ.get('TAIWAN_LOGISTICS_SEARCH_BACKEND', 'python')
+
 # CSV 配置
 CSV_CONFIG = {
     'provider': {
@@ -40,7 +54,9 @@ CSV_CONFIG = {
         'file': 'operations.csv',
         # 逐一列出所有 provider 端點欄位，與 field 域同理
         'search_cols': ['operation', 'operation_zh', 'ecpay_endpoint', 'newebpay_endpoint', 'payuni_endpoint', 'notes'],
-        'output_cols': ['operation', 'operation_zh', 'ecpay_endpoint', 'newebpay_endpoint', 'payuni_endpoint', 'method', 'required_fields', 'optional_fields', 'notes']
+        'output_cols': ['operation', 'operation_zh', 'ecpay_endpoint', 'newebpay_endpoint', 'payuni_endpoint', 'method', 'required_fields', 'optional_fields', 'notes'],
+        # 輸入建議 (suggest) 的來源欄位：欄位名、端點路徑、代碼
+        'suggest_cols': ['operation', 'ecpay_endpoint', 'newebpay_endpoint', 'payuni_endpoint']
     },
     'logistics_type': {
         'file': 'logistics-types.csv',
@@ -52,12 +68,19 @@ CSV_CONFIG = {
         # 逐一列出所有 provider 欄位 —— 原本只涵蓋 3 家，
         # 導致搜尋其餘 provider 的欄位名時完全比對不到
         'search_cols': ['field_name', 'field_zh', 'ecpay_name', 'newebpay_name', 'payuni_name', 'smilepay_name', 'pchomepay_name', 'paynow_name', 'hct_name', 'ezship_name', 'lalamove_name', 'pandago_name', 'uber_direct_name', 'notes'],
-        'output_cols': ['field_name', 'field_zh', 'ecpay_name', 'newebpay_name', 'payuni_name', 'smilepay_name', 'pchomepay_name', 'paynow_name', 'hct_name', 'ezship_name', 'lalamove_name', 'pandago_name', 'uber_direct_name', 'type', 'required', 'notes']
+        'output_cols': ['field_name', 'field_zh', 'ecpay_name', 'newebpay_name', 'payuni_name', 'smilepay_name', 'pchomepay_name', 'paynow_name', 'hct_name', 'ezship_name', 'lalamove_name', 'pandago_name', 'uber_direct_name', 'type', 'required', 'notes'],
+        'suggest_cols': ['field_name', 'ecpay_name', 'newebpay_name', 'payuni_name', 'smilepay_name', 'pchomepay_name', 'paynow_name', 'hct_name', 'ezship_name', 'lalamove_name', 'pandago_name', 'uber_direct_name']
     },
     'status': {
         'file': 'status-codes.csv',
         'search_cols': ['provider', 'code', 'status_zh', 'status_en', 'description'],
-        'output_cols': ['provider', 'code', 'status_zh', 'category', 'description']
+        'output_cols': ['provider', 'code', 'status_zh', 'category', 'description'],
+        # BM25F 預設欄位權重（未列出者為 1.0），只在 --bm25f / --boost / field_weights 時採用：
+        # 命中代碼、服務商比命中長篇說明重要；預設查詢仍為一般 BM25
+        'field_weights': {'code': 3.0, 'provider': 2.0, 'description': 0.5},
+        # 精確查詢用的鍵：(provider, code) 與 code，見 lookup_code()
+        'key_cols': ['provider', 'code'],
+        'suggest_cols': ['code']
     }
 }
 
@@ -70,193 +93,36 @@ DOMAIN_KEYWORDS = {
     'status': ['status', 'code', '狀態', '配送', '取貨', '完成', '失敗', '300', '3001']
 }
 
-
-def tokenize(text: str) -> List[str]:
-    """中英文混合分詞"""
-    if not text:
-        return []
-
-    # 轉小寫
-    text = text.lower()
-
-    # 分離中英文
-    tokens = []
-
-    # 英文 token (包含數字)
-    for match in re.finditer(r'[a-z0-9]+', text):
-        tokens.append(match.group())
-
-    # 中文 bigram + unigram
-    chinese_chars = re.findall(r'[\u4e00-\u9fff]', text)
-    for char in chinese_chars:
-        tokens.append(char)
-
-    # Bigram for better matching
-    for i in range(len(chinese_chars) - 1):
-        tokens.append(chinese_chars[i] + chinese_chars[i + 1])
-
-    return tokens
-
-
-def compute_idf(documents: List[List[str]]) -> Dict[str, float]:
-    """計算 IDF (Inverse Document Frequency)"""
-    n = len(documents)
-    df = {}
-
-    for doc in documents:
-        seen = set()
-        for term in doc:
-            if term not in seen:
-                df[term] = df.get(term, 0) + 1
-                seen.add(term)
-
-    idf = {}
-    for term, freq in df.items():
-        idf[term] = math.log((n - freq + 0.5) / (freq + 0.5) + 1.0)
-
-    return idf
-
-
-def bm25_score(
-    query_tokens: List[str],
-    doc_tokens: List[str],
-    idf: Dict[str, float],
-    avg_dl: float,
-    k1: float = 1.5,
-    b: float = 0.75
-) -> float:
-    """計算 BM25 分數"""
-    score = 0.0
-    dl = len(doc_tokens)
-
-    # Term frequency in document
-    tf = {}
-    for term in doc_tokens:
-        tf[term] = tf.get(term, 0) + 1
-
-    for term in query_tokens:
-        if term in tf:
-            freq = tf[term]
-            idf_score = idf.get(term, 0)
-            numerator = freq * (k1 + 1)
-            denominator = freq + k1 * (1 - b + b * (dl / avg_dl))
-            score += idf_score * (numerator / denominator)
-
-    return score
-
-
-def load_csv(domain: str) -> Tuple[List[Dict], List[List[str]]]:
-    """載入 CSV 並返回行數據和 token 化文檔"""
-    config = CSV_CONFIG.get(domain)
-    if not config:
-        return [], []
-
-    csv_path = DATA_DIR / config['file']
-    if not csv_path.exists():
-        return [], []
-
-    rows = []
-    documents = []
-
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rows.append(row)
-
-            # 組合搜索欄位
-            search_text = ' '.join(
-                str(row.get(col, '')) for col in config['search_cols']
-            )
-            documents.append(tokenize(search_text))
-
-    return rows, documents
-
-
-def detect_domain(query: str) -> str:
-    """自動偵測查詢應該屬於哪個域"""
-    query_lower = query.lower()
-    scores = {}
-
-    for domain, keywords in DOMAIN_KEYWORDS.items():
-        score = sum(1 for kw in keywords if kw in query_lower)
-        scores[domain] = score
-
-    # 返回最高分的域，如果都是 0 則返回 'provider'
-    max_score = max(scores.values())
-    if max_score == 0:
-        return 'provider'
-
-    return max(scores, key=scores.get)
-
-
-def search(
-    query: str,
-    domain: Optional[str] = None,
-    max_results: int = 5
-) -> List[Dict]:
-    """
-    主搜索函數
-
-    Args:
-        query: 搜索查詢
-        domain: 搜索域 (None 表示自動偵測)
-        max_results: 最大結果數
-
-    Returns:
-        結果列表 (按分數排序)
-    """
-    if not query:
-        return []
-
-    # 自動偵測域
-    if domain is None:
-        domain = detect_domain(query)
-
-    # 載入數據
-    rows, documents = load_csv(domain)
-    if not rows:
-        return []
-
-    # 計算 IDF
-    idf = compute_idf(documents)
-    avg_dl = sum(len(doc) for doc in documents) / len(documents)
-
-    # Query tokens
-    query_tokens = tokenize(query)
-
-    # 計算每個文檔的分數
-    scores = []
-    for i, doc_tokens in enumerate(documents):
-        score = bm25_score(query_tokens, doc_tokens, idf, avg_dl)
-        if score > 0:
-            scores.append((score, i))
-
-    # 排序並返回結果
-    scores.sort(reverse=True)
-
-    config = CSV_CONFIG[domain]
-    results = []
-
-    for score, idx in scores[:max_results]:
-        row = rows[idx]
-        result = {col: row.get(col, '') for col in config['output_cols']}
-        result['_score'] = round(score, 2)
-        result['_domain'] = domain
-        results.append(result)
-
-    return results
-
-
-def search_all(query: str, max_per_domain: int = 3) -> Dict[str, List]:
-    """全域搜索 (搜索所有域)"""
-    all_results = {}
-
-    for domain in CSV_CONFIG.keys():
-        results = search(query, domain=domain, max_results=max_per_domain)
-        if results:
-            all_results[domain] = results
-
-    return all_results
+# 索引、查詢快取與評分都在 engine.py（三個 skill 共用），本檔只定義此 skill 的設定
+ENGINE = SearchEngine('logistics', CSV_CONFIG, DOMAIN_KEYWORDS, DATA_DIR, INDEX_DIR,
+                      backend=SEARCH_BACKEND)
+
+# 模組層級的函數介面：search.py、server.py、recommend.py 與既有程式沿用這些名稱
+_INDEX_CACHE = ENGINE.indexes
+_load_csv = read_csv
+load_csv = ENGINE.load_csv
+build_index = ENGINE.build_index
+save_index = ENGINE.save_index
+load_index = ENGINE.load_index
+build_all_indexes = ENGINE.build_all_indexes
+get_index = ENGINE.get_index
+get_sparse_index = ENGINE.get_sparse_index
+_index_path = ENGINE._index_path
+get_available_domains = ENGINE.get_available_domains
+get_domain_info = ENGINE.get_domain_info
+cache_stats = ENGINE.cache_stats
+_domain_matcher = ENGINE.domain_matcher
+detect_domain = ENGINE.detect_domain
+lookup_code = ENGINE.lookup_code
+_exact_search = ENGINE._exact_search
+resolve_domain = ENGINE.resolve_domain
+_search_csv = ENGINE.rank
+search = ENGINE.search
+search_federated = ENGINE.search_federated
+search_all = ENGINE.search_all
+suggest = ENGINE.suggest
+prefix_index = ENGINE.prefix_index
+search_batch = ENGINE.search_batch
 
 
 if __name__ == '__main__':
@@ -0,0 +1,2459 @@
+#!/usr/bin/env python3
+"""
+Taiwan 電商 Skill 共用 BM25 搜索引擎
+
+invoice / payment / logistics 三個 skill 的 core.py 只保留各自的 CSV_CONFIG
+與 DOMAIN_KEYWORDS，索引、快取、評分與批次查詢都由這裡的 SearchEngine 提供。
+三個 skill 各附一份內容相同的 engine.py（各自獨立安裝、發布）；以
+taiwan-invoice 的為準，由 scripts/sync-assets.mjs 複製到其餘兩個 skill，
+CI 以 --check 擋下分歧的副本。
+
+用法:
+    from engine import SearchEngine
+
+    ENGINE = SearchEngine('invoice', CSV_CONFIG, DOMAIN_KEYWORDS, DATA_DIR, INDEX_DIR)
+    results = ENGINE.search('ecpay 折讓', max_results=5)
+
+無外部依賴；NumPy / SciPy（sparse 後端）與 pyahocorasick 皆為選用。
+"""
+
+# CLI 每次呼叫都會載入本模組：只有建索引、索引檔驗證或平行查詢才用到的
+# csv、hashlib、concurrent.futures 延遲到使用時才匯入；DomainIndex 也不用 dataclass
+# （dataclasses 會連帶匯入 inspect，佔掉一半的匯入時間）。見 test_search.py 的啟動時間檢查
+import bisect
+import heapq
+import marshal
+import math
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache, partial, wraps
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple, Union
+
+try:
+    import ahocorasick  # pyahocorasick：選用，C 實作的多關鍵字比對
+    HAS_AHOCORASICK = True
+except ImportError:
+    HAS_AHOCORASICK = False
+
+# 索引檔格式版本。tokenize() 或索引結構有變動時必須遞增，
+# 否則會載入以舊規則建好的索引
+INDEX_FORMAT_VERSION = 4
+
+# 批次查詢達此筆數才啟用多行程；fork 與結果序列化的固定成本
+# 在小批次時會抵銷平行的效益
+BATCH_PROCESS_THRESHOLD = 2000
+
+# 查詢結果 LRU 快取的容量 (筆)，0 表示停用
+QUERY_CACHE_SIZE = 256
+
+# reasoning.csv 規則比對的最低匹配強度，低於此值視為雜訊不計分
+MIN_RULE_MATCH = 0.15
+
+# MaxScore 剪枝的浮點容差：上界與部分分數的加總順序不同，需保留餘裕
+_PRUNE_EPS = 1e-9
+
+# 錯誤碼 / 狀態碼的精確查詢：'-10066' 之類的查詢在 BM25 下只是數字 token，
+# 可能輸給只是提到相近數字的列，因此先查碼索引，命中才不走 BM25。
+# 只接受三個 skill 的錯誤碼 / 狀態碼 CSV 實際出現的形狀（小寫後比對）；'b2c'、'7-11'
+# 這類含數字的一般詞不算，不會為它們建立碼索引。純字母的碼（'success'、'ssnd'、
+# '集貨'）本身就是一般詞，照舊交給 BM25
+_CODE_SHAPE = re.compile(r'''
+    -?\d+                     # 10000016、-10066、200
+  | [a-z]{1,6}-?\d{2,}        # key10001、aes-001、ls01、refund-001
+  | \d+-[a-z]+(?:-\d+)?       # 200-store
+  | [a-z]+(?:_[a-z]+)+         # invalid_merid
+''', re.VERBOSE)
+
+
+# 模糊比對（拼字修正）：英數詞至少此長度才嘗試修正，太短的詞修正後多半是別的詞
+FUZZY_MIN_LENGTH = 5
+# 允許的編輯距離：詞長未達此值時 1，否則 2（相鄰字元對調算 1 次）。
+# 每次編輯最多破壞 4 個 trigram，兩個門檻保證候選詞至少與查詢詞共用 1 個 trigram
+FUZZY_LONG_TERM = 9
+
+# 分詞結果的記憶容量 (筆)：推薦規則、CSV 欄位與重複的查詢會反覆分詞同一段文字
+TOKENIZE_CACHE_SIZE = 4096
+
+# 分階段計時的環境變數，值同 CLI 的 --profile（table / json / cprofile[:路徑]），見 Profiler
+PROFILE_ENV = 'TAIWAN_SEARCH_PROFILE'
+
+# 英數詞或整段中文詞塊；英數詞的首字元必小於 '一'，以此區分兩者
+_CHUNK_RE = re.compile(r'[a-z0-9]+|[一-鿿]+')
+
+
+@lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+def _tokenize(text: str) -> Tuple[str, ...]:
+    words = []
+    chars = []
+    for chunk in _CHUNK_RE.findall(text.lower()):
+        if chunk < '一':
+            words.append(chunk)
+        else:
+            chars.extend(chunk)
+    return (*words, *chars, *map(str.__add__, chars, chars[1:]))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    中英文混合分詞：英數詞 + 中文單字 + 相鄰中文字的 bigram
+
+    中文沒有空白分隔，bigram 讓「折讓」能命中「折讓的」、「開立」能命中
+    「開立發票」；只以空白切詞幾乎等同關鍵字全等比對。
+
+    以單一正規表示式掃描一次，結果依輸入文字做 LRU 記憶（重複的查詢、
+    規則與欄位值共用同一組 token 字串）；回傳的是新列表，呼叫端可自由修改。
+    """
+    if not text:
+        return []
+    return list(_tokenize(text))
+
+
+@lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+def _match_tokens(text: str) -> frozenset:
+    tokens = set()
+    for chunk in _CHUNK_RE.findall(text.lower()):
+        if len(chunk) == 1 or chunk < '一':
+            tokens.add(chunk)
+        else:
+            tokens.update(map(str.__add__, chunk, chunk[1:]))
+    return frozenset(tokens)
+
+
+def match_tokens(text: str) -> set:
+    """
+    抽出用於規則比對的 token：英數詞 + 中文 bigram
+
+    與 tokenize() 不同，bigram 只在同一個中文詞塊內組合、不跨空白邊界，
+    避免組出「試避」這類跨詞的無意義片段影響規則比對的精確度。
+    與 tokenize() 共用單次掃描的正規表示式與 LRU 記憶。
+    """
+    if not text:
+        return set()
+    return set(_match_tokens(text))
+
+
+def tokenize_cache_info() -> Dict[str, Any]:
+    """分詞記憶的命中統計（tokenize / match_tokens 各自的 lru_cache 資訊）"""
+    return {'tokenize': _tokenize.cache_info()._asdict(),
+            'match_tokens': _match_tokens.cache_info()._asdict()}
+
+
+def rule_match_score(query: str, *rule_fields: str) -> float:
+    """
+    量化查詢與規則文字的匹配強度，回傳 0.0–1.0
+
+    取代原本「命中任一詞即給滿分」的判斷 —— 舊做法讓「開立」這類高頻
+    短詞使不相干的規則也拿到完整權重。
+
+    計分方式為「規則解釋了查詢的多少比例」，即 overlap / 查詢詞數。
+    刻意不納入 recall（overlap / 規則詞數）：規則的 use_cases 詞數多寡
+    是撰寫風格差異，用它加權會讓寫得詳細的規則反而吃虧。
+
+    另設最低命中詞數，避免單一詞偶然命中就計分；查詢本身很短時放寬，
+    否則兩字查詢將永遠無法命中任何規則。
+    """
+    if not query:
+        return 0.0
+    return _rule_strength(_match_tokens(query),
+                          [_match_tokens(f) for f in rule_fields if f])
+
+
+def _rule_strength(q: frozenset, rule_tokens: Iterable[frozenset]) -> float:
+    """rule_match_score() 的計分本體：q 與各欄位皆為已抽出的 match_tokens"""
+    if not q:
+        return 0.0
+
+    min_overlap = 1 if len(q) <= 2 else 2
+
+    best = 0.0
+    for r in rule_tokens:
+        if not r:
+            continue
+        overlap = len(q & r)
+        if overlap < min_overlap:
+            continue
+        best = max(best, overlap / len(q))
+
+    return best
+
+
+class RuleTable:
+    """
+    編譯後的 reasoning.csv 規則表
+
+    每條規則的比對欄位預先轉為 match_tokens 的 frozenset，並建立
+    token -> 規則編號的倒排索引；查詢只為與它至少共用一個 token 的規則
+    計分（其餘規則依最低命中詞數本來就是 0 分），結果與逐條呼叫
+    rule_match_score() 相同。來源 CSV 的 (mtime_ns, size) 變動時自動重新載入；
+    來源檔暫時不存在（例如正被刪除重建）時沿用上一版，見 _reload_source()。
+
+    取得方式見 rule_table()，同一個檔案在行程內只編譯一次。
+    """
+
+    def __init__(self, path: Any, fields: Tuple[str, ...] = ('scenario', 'use_cases')):
+        self.path = path
+        self.fields = fields
+        # (來源簽章, 規則列, 各規則各欄位的 token 集合, token -> 規則編號)；整組替換，
+        # 並行的查詢不會讀到新舊混雜的表
+        self._compiled: Tuple[Optional[Tuple[int, int]], List[Dict[str, str]],
+                              List[Tuple[frozenset, ...]], Dict[str, List[int]]] = (None, [], [], {})
+        self._lock = threading.Lock()
+
+    def _compile(self):
+        compiled = self._compiled
+        if _source_unchanged(self.path, compiled[0]):
+            return compiled
+        with self._lock:
+            compiled = self._compiled
+            if _source_unchanged(self.path, compiled[0]):
+                return compiled
+            loaded = _reload_source(self.path, self._build, compiled[0] is not None)
+            if loaded is not None:
+                source, (rules, tokens, postings) = loaded
+                self._compiled = (source, rules, tokens, postings)
+            return self._compiled
+
+    def _build(self, path: str) -> Tuple[List[Dict[str, str]], List[Tuple[frozenset, ...]], Dict[str, List[int]]]:
+        rules = read_csv(path)
+        tokens = [tuple(_match_tokens(rule.get(f) or '') for f in self.fields) for rule in rules]
+        postings: Dict[str, List[int]] = {}
+        for rule_id, sets in enumerate(tokens):
+            for token in frozenset().union(*sets):
+                postings.setdefault(token, []).append(rule_id)
+        return rules, tokens, postings
+
+    def load(self) -> List[Dict[str, str]]:
+        """確保規則表與來源 CSV 一致並回傳規則列（表內共用的 dict，請勿修改）"""
+        return self._compile()[1]
+
+    def refresh(self) -> bool:
+        """檢查來源 CSV，有變動時重新編譯；回傳是否重新編譯（首次呼叫亦算）"""
+        before = self._compiled[0]
+        return self._compile()[0] != before
+
+    def match(self, query: str, threshold: float = MIN_RULE_MATCH) -> List[Tuple[Dict[str, str], float]]:
+        """
+        回傳匹配強度達 threshold 的 (規則列, 強度)，依 CSV 順序
+
+        規則列為表內共用的 dict，呼叫端請勿修改。
+        """
+        _, rules, tokens, postings = self._compile()
+        if not query:
+            return []
+        q = _match_tokens(query)
+        candidates = set()
+        for token in q:
+            candidates.update(postings.get(token, ()))
+        return self._strengths(q, candidates, threshold, rules, tokens)
+
+    def match_batch(self, queries: Iterable[str],
+                    threshold: float = MIN_RULE_MATCH) -> List[List[Tuple[Dict[str, str], float]]]:
+        """
+        整批比對，回傳與 queries 順序相同、各自等同 match() 的結果
+
+        整批查詢的 token 聯集只查一次倒排索引，再依各查詢的 token 分配候選規則；
+        token 集合相同的查詢（例如只差在詞序或標點）只計分一次。
+        整批使用同一版規則表。
+        """
+        _, rules, tokens, postings = self._compile()
+        token_sets = [_match_tokens(query) if query else frozenset() for query in queries]
+        probed = {token: postings.get(token, ()) for token in frozenset().union(*token_sets)}
+        matched: Dict[frozenset, List[Tuple[Dict[str, str], float]]] = {}
+        results = []
+        for q in token_sets:
+            if q not in matched:
+                candidates = set()
+                for token in q:
+                    candidates.update(probed[token])
+                matched[q] = self._strengths(q, candidates, threshold, rules, tokens)
+            results.append(list(matched[q]))
+        return results
+
+    @staticmethod
+    def _strengths(q: frozenset, candidates: Iterable[int], threshold: float, rules: List[Dict[str, str]],
+                   tokens: List[Tuple[frozenset, ...]]) -> List[Tuple[Dict[str, str], float]]:
+        matched = []
+        for rule_id in sorted(candidates):
+            strength = _rule_strength(q, tokens[rule_id])
+            if strength >= threshold:
+                matched.append((rules[rule_id], strength))
+        return matched
+
+
+def _source_unchanged(path: str, source: Optional[Tuple[int, int]]) -> bool:
+    """已載入的版本仍可用：來源簽章沒變，或已有上一版而來源檔暫時不存在"""
+    current = _source_signature(path)
+    return current == source or (current == (0, 0) and source is not None)
+
+
+def _reload_source(path: str, build: Callable[[str], Any],
+                   has_previous: bool) -> Optional[Tuple[Tuple[int, int], Any]]:
+    """
+    重新讀取來源檔，回傳 (簽章, build(path))
+
+    簽章在讀取前取得，讀取期間檔案又被改寫時，下一次取用會再讀一次。已有上一版時，
+    檔案在檢查之後被刪除（讀取丟出 OSError，或 read_csv 因檔案不存在回傳空列表）
+    回傳 None，呼叫端沿用上一版；替換中的檔案不會讓資料暫時變成空的。
+    """
+    source = _source_signature(path)
+    if source == (0, 0) and has_previous:
+        return None
+    try:
+        value = build(path)
+    except OSError:
+        if has_previous:
+            return None
+        raise
+    if has_previous and _source_signature(path) == (0, 0):
+        return None
+    return source, value
+
+
+_RULE_TABLES: Dict[str, RuleTable] = {}
+
+
+def rule_table(path: Any) -> RuleTable:
+    """取得 path 的規則表（每個檔案一份，第一次使用時建立）"""
+    key = os.path.abspath(path)
+    table = _RULE_TABLES.get(key)
+    if table is None:
+        table = _RULE_TABLES.setdefault(key, RuleTable(key))
+    return table
+
+
+class FileSnapshot:
+    """
+    由單一來源檔衍生、隨檔案變動重建的資料（例如 providers.csv 讀成的列）
+
+    與 RuleTable 相同：每次取用只比對來源的 (mtime_ns, size)，變動時才重建；
+    (來源簽章, 衍生值) 整組替換，並行的讀取者拿到的一定是某一版完整的資料，
+    不會看到重建到一半的狀態。來源檔暫時不存在時沿用上一版，見 _reload_source()。
+
+    取得方式見 file_snapshot()，同一個 (檔案, build) 在行程內只有一份。
+    """
+
+    def __init__(self, path: Any, build: Callable[[str], Any] = None):
+        self.path = path
+        self.build = build or read_csv
+        self._state: Tuple[Optional[Tuple[int, int]], Any] = (None, None)
+        self._lock = threading.Lock()
+
+    def _current(self) -> Tuple[Optional[Tuple[int, int]], Any]:
+        state = self._state
+        if _source_unchanged(self.path, state[0]):
+            return state
+        with self._lock:
+            state = self._state
+            if _source_unchanged(self.path, state[0]):
+                return state
+            loaded = _reload_source(self.path, self.build, state[0] is not None)
+            if loaded is not None:
+                self._state = loaded
+            return self._state
+
+    def get(self) -> Any:
+        """回傳與來源檔一致的衍生值（行程內共用的物件，請勿修改）"""
+        return self._current()[1]
+
+    def refresh(self) -> bool:
+        """檢查來源檔，有變動時重建；回傳是否重建（首次呼叫亦算）"""
+        before = self._state[0]
+        return self._current()[0] != before
+
+
+_SNAPSHOTS: Dict[Tuple[str, Any], FileSnapshot] = {}
+
+
+def file_snapshot(path: Any, build: Callable[[str], Any] = None) -> FileSnapshot:
+    """取得 path 經 build（預設 read_csv）衍生的資料（每個檔案與 build 一份，第一次使用時建立）"""
+    key = (os.path.abspath(path), build or read_csv)
+    snapshot = _SNAPSHOTS.get(key)
+    if snapshot is None:
+        snapshot = _SNAPSHOTS.setdefault(key, FileSnapshot(key[0], key[1]))
+    return snapshot
+
+
+class Watcher:
+    """
+    背景執行緒每 interval 秒呼叫一次 refresh，來源檔的變動在請求之外就先重建好
+
+    標準函式庫沒有跨平台的檔案變動通知（inotify 只有 Linux），這裡以 stat 輪詢；
+    refresh 通常只比對 (mtime_ns, size)，沒有變動時幾乎不花時間。refresh 丟出的
+    例外（例如檔案寫到一半）記在 error，下一輪再試，不中斷監看。
+
+    用法:
+        watcher = Watcher(recommender.refresh, interval=2.0).start()
+        ...
+        watcher.stop()
+    """
+
+    def __init__(self, refresh: Callable[[], Any], interval: float = 1.0):
+        self.refresh = refresh
+        self.interval = interval
+        self.error: Optional[Exception] = None
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'Watcher':
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='taiwan-skill-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.refresh()
+                self.error = None
+            except Exception as e:
+                self.error = e
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> 'Watcher':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def compute_idf(documents: List[List[str]]) -> Dict[str, float]:
+    """計算 IDF (Inverse Document Frequency)"""
+    n = len(documents)
+    df: Dict[str, int] = {}
+    for doc in documents:
+        for term in set(doc):
+            df[term] = df.get(term, 0) + 1
+
+    return {term: math.log((n - freq + 0.5) / (freq + 0.5) + 1.0) for term, freq in df.items()}
+
+
+def bm25_score(
+    query_tokens: List[str],
+    doc_tokens: List[str],
+    idf: Dict[str, float],
+    avg_dl: float,
+    k1: float = 1.5,
+    b: float = 0.75
+) -> float:
+    """逐列計算 BM25 分數（索引評分的基準實作）"""
+    if not doc_tokens or not query_tokens:
+        return 0.0
+
+    dl = len(doc_tokens)
+    tf: Dict[str, int] = {}
+    for term in doc_tokens:
+        tf[term] = tf.get(term, 0) + 1
+
+    score = 0.0
+    for term in query_tokens:
+        if term in tf:
+            score += _term_impact(tf[term], dl, idf.get(term, 0), avg_dl, k1, b)
+    return score
+
+
+def read_csv(path: str) -> List[Dict[str, str]]:
+    """讀取 CSV 為 dict 列表；檔案不存在時回傳空列表"""
+    if not os.path.exists(path):
+        return []
+    import csv
+
+    with open(path, 'r', encoding='utf-8') as f:
+        return list(csv.DictReader(f))
+
+
+class RowStore:
+    """
+    以欄為單位存放 CSV 資料列
+
+    每列一個 dict 時，dict 本身的開銷遠大於儲存格內容；三個 skill 的索引
+    都常駐在同一個服務裡時尤其明顯。這裡每欄一個 list，以 row_id 取值，
+    同一份資料內重複的儲存格（服務商、分類、'N/A' 等）只留一個字串物件
+    （marshal 寫入索引檔時也只寫一次）。只有輸出結果時才組成 dict，見
+    SearchEngine._materialize()。
+
+    為了相容，len()、store[row_id] 與逐列走訪的行為與原本的 dict 列表
+    相同（取得的是新建的 dict）；不存在的欄位一律視為空字串。
+    """
+
+    __slots__ = ('columns', 'data', '_positions')
+
+    def __init__(self, columns: Iterable[str], data: List[List[str]]):
+        self.columns = tuple(columns)
+        self.data = data
+        self._positions = {col: i for i, col in enumerate(self.columns)}
+
+    @classmethod
+    def from_records(cls, header: List[str], records: Iterable[List[str]]) -> 'RowStore':
+        """由 CSV 標題列與資料列建立；欄數不足的列補空字串、多出的捨棄"""
+        width = len(header)
+        pool: Dict[str, str] = {}
+        intern = pool.setdefault
+        data: List[List[str]] = [[] for _ in range(width)]
+        for record in records:
+            if not record:
+                continue
+            if len(record) < width:
+                record = record + [''] * (width - len(record))
+            for values, value in zip(data, record):
+                values.append(intern(value, value))
+        return cls(header, data)
+
+    def __len__(self) -> int:
+        return len(self.data[0]) if self.data else 0
+
+    def column(self, col: str) -> List[str]:
+        """整欄的值，依 row_id 排列；不存在的欄位回傳等長的空字串列表"""
+        i = self._positions.get(col)
+        return self.data[i] if i is not None else [''] * len(self)
+
+    def value(self, row_id: int, col: str) -> str:
+        i = self._positions.get(col)
+        return self.data[i][row_id] if i is not None else ''
+
+    def __getitem__(self, row_id: int) -> Dict[str, str]:
+        return {col: values[row_id] for col, values in zip(self.columns, self.data)}
+
+    def __iter__(self) -> Iterator[Dict[str, str]]:
+        for record in zip(*self.data):
+            yield dict(zip(self.columns, record))
+
+    def records(self, cols: Iterable[str]) -> Iterator[Tuple[str, ...]]:
+        """依 row_id 逐列產生 cols 各欄的值"""
+        return zip(*(self.column(col) for col in cols))
+
+    def __repr__(self) -> str:
+        return f'RowStore(rows={len(self)}, columns={len(self.columns)})'
+
+
+def read_rows(path: str) -> RowStore:
+    """讀取 CSV 為 RowStore；檔案不存在時回傳空的 RowStore"""
+    if not os.path.exists(path):
+        return RowStore((), [])
+    import csv
+
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        return RowStore.from_records(header, reader)
+
+
+class DomainIndex:
+    """
+    單一搜索域的倒排索引
+
+    postings 為 term -> [(row_id, tf), ...]，依 row_id 遞增排列。
+    查詢時只走訪查詢詞自己的 postings，不必每次重讀 CSV、重新分詞。
+
+    CSV_CONFIG 設有 field_weights 的域另存各欄位的 postings，預設查詢仍是
+    一般 BM25；查詢時指定 field_weights 才以 BM25F 評分（見 _reweighted()）：
+    tf 是各欄位「長度正規化後的詞頻 × 欄位權重」之和，長度正規化已折入其中，
+    因此視圖的 doc_lens 一律為 1、avg_dl 為 1，BM25 評分式化為
+    tf·(k1+1)/(tf+k1)，既有的評分與剪枝都不必分支，仍是一次 postings 走訪。
+    """
+
+    __slots__ = ('rows', 'postings', 'doc_lens', 'idf', 'avg_dl', 'source', 'bounds', 'codes',
+                 'provider_codes', 'fields', 'field_postings', 'field_idf', 'prefixes', 'fuzzy')
+
+    def __init__(
+        self,
+        rows: RowStore,
+        postings: Dict[str, List[Tuple[int, int]]],
+        doc_lens: List[int],
+        idf: Dict[str, float],
+        avg_dl: float,
+        source: Tuple[int, int] = (0, 0),
+        bounds: Optional[Dict[str, float]] = None,
+        codes: Optional[Dict[str, List[int]]] = None,
+        provider_codes: Optional[Dict[str, Dict[str, List[int]]]] = None,
+        fields: Tuple[str, ...] = (),
+        field_postings: Optional[Dict[str, List[Tuple[int, int, float]]]] = None,
+        field_idf: Optional[Dict[str, float]] = None,
+        prefixes: Optional['PrefixIndex'] = None,
+        fuzzy: Optional['FuzzyIndex'] = None,
+    ):
+        self.rows = rows
+        self.postings = postings
+        self.doc_lens = doc_lens
+        self.idf = idf
+        self.avg_dl = avg_dl
+        # 建索引時來源 CSV 的 (mtime_ns, size)，用來判斷索引是否過期
+        self.source = source
+        # term -> 該詞在任一文檔的最大 BM25 貢獻，供 MaxScore 剪枝；查詢時才逐詞計算
+        self.bounds = {} if bounds is None else bounds
+        # 設有 key_cols 的域：code -> [row_id] 與 provider -> code -> [row_id]（皆小寫），
+        # 第一次精確查詢時才建立
+        self.codes = codes
+        self.provider_codes = provider_codes
+        # BM25F 域：search_cols 的欄位順序，term -> [(row_id, 欄位序號, 正規化詞頻)]
+        # （依 row_id、欄位序號遞增）與各欄位分詞後計算的 IDF；查詢時指定
+        # field_weights 時由此加權
+        self.fields = fields
+        self.field_postings = {} if field_postings is None else field_postings
+        self.field_idf = {} if field_idf is None else field_idf
+        # 設有 suggest_cols 的域：前綴建議索引，第一次 suggest() 時才建立，隨索引重建失效
+        self.prefixes = prefixes
+        # 詞彙的 trigram 索引，第一次模糊查詢時才建立，隨索引重建失效
+        self.fuzzy = fuzzy
+
+    def __repr__(self) -> str:
+        return (f'DomainIndex(rows={len(self.rows)}, terms={len(self.postings)}, '
+                f'avg_dl={self.avg_dl:.2f}, source={self.source})')
+
+
+# 前綴建議的候選詞：欄位名、端點路徑、代碼等不含空白與中文的片段
+_SUGGEST_TERM = re.compile(r'[A-Za-z0-9_\-./{}\[\]?=&]*[A-Za-z0-9][A-Za-z0-9_\-./{}\[\]?=&]*')
+# 儲存格內的括號附註，例如 '/platform/inquiry (GET;最多20筆)'，不列入建議
+_SUGGEST_NOTE = re.compile(r'\([^)]*\)|（[^）]*）')
+# 表示「無此項」的佔位值，不列入建議
+_SUGGEST_SKIP = frozenset({'n/a', 'na', '-'})
+
+
+class PrefixIndex:
+    """
+    排序陣列的前綴索引，供欄位名、端點、代碼的輸入建議
+
+    keys 為小寫且已排序，以 bisect 找到第一個 >= 前綴的位置後往後掃，
+    直到不再以前綴開頭；每次查詢 O(log n + 建議數)。端點路徑另以每個 '/'
+    之後的片段建鍵，輸入 'querytrade' 也能找到 '/Cashier/QueryTradeInfo/V5'。
+    """
+
+    def __init__(self, rows: RowStore, cols: List[str]):
+        # 詞 -> 出現的欄位（依 cols 順序），同一個詞在多個服務商欄位出現時只列一次
+        columns: Dict[str, List[str]] = {}
+        for record in rows.records(cols):
+            for col, value in zip(cols, record):
+                for term in _SUGGEST_TERM.findall(_SUGGEST_NOTE.sub(' ', value)):
+                    if term.lower() in _SUGGEST_SKIP:
+                        continue
+                    seen = columns.setdefault(term, [])
+                    if col not in seen:
+                        seen.append(col)
+
+        self.terms: List[Tuple[str, Tuple[str, ...]]] = [
+            (term, tuple(cols_)) for term, cols_ in columns.items()
+        ]
+        entries = []
+        for term_id, (term, _) in enumerate(self.terms):
+            key = term.lower()
+            entries.append((key, term_id))
+            start = key.find('/')
+            while start != -1:
+                if start + 1 < len(key):
+                    entries.append((key[start + 1:], term_id))
+                start = key.find('/', start + 1)
+        entries.sort()
+        self.keys = [key for key, _ in entries]
+        self.targets = [term_id for _, term_id in entries]
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def match(self, prefix: str, limit: int) -> List[Tuple[str, str, Tuple[str, ...]]]:
+        """回傳 [(命中的鍵, 詞, 欄位)]，依鍵排序，每個詞只出現一次"""
+        prefix = prefix.strip().lower()
+        if not prefix or limit < 1:
+            return []
+        found = []
+        seen = set()
+        keys, targets = self.keys, self.targets
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            term_id = targets[i]
+            if term_id in seen:
+                continue
+            seen.add(term_id)
+            term, cols = self.terms[term_id]
+            found.append((keys[i], term, cols))
+            if len(found) >= limit:
+                break
+        return found
+
+
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    a、b 的編輯距離（插入、刪除、替換、相鄰對調各算 1 次），超過 limit 時回傳 limit + 1
+
+    逐列計算 DP，某列最小值已超過 limit 即提前結束。
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    prev2: List[int] = []
+    prev = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        cur = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                cur[j] = min(cur[j], prev2[j - 2] + 1)
+        if min(cur) > limit:
+            return limit + 1
+        prev2, prev = prev, cur
+    return min(prev[-1], limit + 1)
+
+
+def _trigrams(term: str) -> set:
+    padded = f'${term}$'
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class FuzzyIndex:
+    """
+    索引詞彙的 trigram 倒排表，為拼錯的英數詞找出最接近的詞彙
+
+    候選詞只從與查詢詞共用 trigram 的詞彙中產生，並以 q-gram 下界
+    （每次編輯最多破壞 4 個 trigram，相鄰對調即為 4 個）先行過濾，只對剩下的少數候選計算
+    編輯距離；不逐一掃描整個詞彙。中文 token（單字、bigram）不做修正。
+    """
+
+    def __init__(self, postings: Dict[str, List[Tuple[int, Any]]]):
+        # 英數詞彙；文件頻率用來在距離相同時挑較常見的詞
+        self.terms = [term for term in postings if term < '一' and len(term) >= FUZZY_MIN_LENGTH - 1]
+        self.df = [len(postings[term]) for term in self.terms]
+        self.gram_counts = []
+        self.grams: Dict[str, List[int]] = {}
+        for term_id, term in enumerate(self.terms):
+            grams = _trigrams(term)
+            self.gram_counts.append(len(grams))
+            for gram in grams:
+                self.grams.setdefault(gram, []).append(term_id)
+        self._memo: Dict[str, Optional[str]] = {}
+
+    def candidates(self, token: str, max_edits: int) -> List[Tuple[int, str]]:
+        """回傳編輯距離不超過 max_edits 的 [(距離, 詞)]，依距離、文件頻率（多者優先）排序"""
+        grams = _trigrams(token)
+        shared: Dict[int, int] = {}
+        for gram in grams:
+            for term_id in self.grams.get(gram, ()):
+                shared[term_id] = shared.get(term_id, 0) + 1
+
+        found = []
+        for term_id, count in shared.items():
+            if count < max(len(grams), self.gram_counts[term_id]) - 4 * max_edits:
+                continue
+            term = self.terms[term_id]
+            distance = _edit_distance(token, term, max_edits)
+            if distance <= max_edits:
+                found.append((distance, -self.df[term_id], term_id))
+        found.sort()
+        return [(distance, self.terms[term_id]) for distance, _, term_id in found]
+
+    def correct(self, token: str) -> Optional[str]:
+        """最接近 token 的詞彙，找不到時回傳 None（結果依 token 記憶）"""
+        if token in self._memo:
+            return self._memo[token]
+        max_edits = 1 if len(token) < FUZZY_LONG_TERM else 2
+        found = self.candidates(token, max_edits)
+        best = found[0][1] if found else None
+        if len(self._memo) >= TOKENIZE_CACHE_SIZE:
+            self._memo.clear()
+        self._memo[token] = best
+        return best
+
+
+def _source_signature(path: str) -> Tuple[int, int]:
+    """來源 CSV 的 (mtime_ns, size)；檔案不存在時為 (0, 0)"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, 0)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _file_digest(path: str) -> str:
+    """來源 CSV 的內容雜湊，用於 mtime 變了但內容沒變的情況（例如 git checkout）"""
+    import hashlib
+
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def _term_impact(
+    freq: int,
+    dl: int,
+    idf_score: float,
+    avg_dl: float,
+    k1: float = 1.5,
+    b: float = 0.75
+) -> float:
+    """單一詞在單一文檔的 BM25 貢獻，算式與 score_index() 相同"""
+    numerator = freq * (k1 + 1)
+    denominator = freq + k1 * (1 - b + b * (dl / avg_dl)) if avg_dl > 0 else freq + k1
+    return idf_score * (numerator / denominator)
+
+
+def score_index(
+    index: DomainIndex,
+    query_tokens: List[str],
+    k1: float = 1.5,
+    b: float = 0.75
+) -> Dict[int, float]:
+    """
+    以 postings 計算 BM25 分數，回傳 row_id -> score
+
+    逐詞累加的順序與 bm25_score() 相同（依查詢詞順序、重複詞重複計），
+    因此浮點結果逐位元一致。
+    """
+    scores: Dict[int, float] = {}
+    avg_dl = index.avg_dl
+    doc_lens = index.doc_lens
+
+    for term in query_tokens:
+        postings = index.postings.get(term)
+        if not postings:
+            continue
+
+        idf_score = index.idf.get(term, 0)
+        for row_id, freq in postings:
+            numerator = freq * (k1 + 1)
+            denominator = freq + k1 * (1 - b + b * (doc_lens[row_id] / avg_dl))
+            scores[row_id] = scores.get(row_id, 0.0) + idf_score * (numerator / denominator)
+
+    return scores
+
+
+def _term_bound(index: DomainIndex, term: str) -> float:
+    """詞的分數上界（所有 postings 中的最大貢獻），計算後快取在索引上"""
+    bound = index.bounds.get(term)
+    if bound is None:
+        idf_score = index.idf.get(term, 0)
+        bound = max(
+            (_term_impact(freq, index.doc_lens[row_id], idf_score, index.avg_dl)
+             for row_id, freq in index.postings.get(term, ())),
+            default=0.0,
+        )
+        index.bounds[term] = bound
+    return bound
+
+
+def _lookup_tf(postings: List[Tuple[int, int]], row_id: int) -> int:
+    """postings 依 row_id 排序，以二分搜尋取得詞頻"""
+    i = bisect.bisect_left(postings, (row_id,))
+    if i < len(postings) and postings[i][0] == row_id:
+        return postings[i][1]
+    return 0
+
+
+def _weighted_postings(
+    field_postings: List[Tuple[int, int, float]],
+    weights: Tuple[float, ...]
+) -> List[Tuple[int, float]]:
+    """將單一詞的欄位 postings 依欄位權重合併為 [(row_id, tf)]，權重為 0 的欄位略過"""
+    combined: Dict[int, float] = {}
+    for row_id, f, ntf in field_postings:
+        weight = weights[f]
+        if weight:
+            combined[row_id] = combined.get(row_id, 0.0) + weight * ntf
+    return list(combined.items())
+
+
+def _reweighted(index: DomainIndex, weights: Tuple[float, ...], terms: Iterable[str]) -> DomainIndex:
+    """
+    以欄位權重為 terms 建立只含這些詞的 BM25F 索引視圖
+
+    只加權查詢詞自己的欄位 postings；資料列與碼索引與原索引共用。
+    """
+    postings = {}
+    for term in set(terms):
+        weighted = _weighted_postings(index.field_postings.get(term, ()), weights)
+        if weighted:
+            postings[term] = weighted
+    return DomainIndex(
+        rows=index.rows,
+        postings=postings,
+        doc_lens=[1] * len(index.rows),
+        idf=index.field_idf,
+        avg_dl=1.0,
+        source=index.source,
+        codes=index.codes,
+        provider_codes=index.provider_codes,
+        fields=index.fields,
+        field_postings=index.field_postings,
+        field_idf=index.field_idf,
+    )
+
+
+def _rescore(index: DomainIndex, query_tokens: List[str], row_ids: Iterable[int]) -> Dict[int, float]:
+    """只為指定的列計算精確分數，累加順序與 score_index() 相同"""
+    doc_lens = index.doc_lens
+    scores: Dict[int, float] = {}
+    for row_id in row_ids:
+        score = 0.0
+        for term in query_tokens:
+            postings = index.postings.get(term)
+            if not postings:
+                continue
+            freq = _lookup_tf(postings, row_id)
+            if freq:
+                score += _term_impact(freq, doc_lens[row_id], index.idf.get(term, 0), index.avg_dl)
+        scores[row_id] = score
+    return scores
+
+
+def score_index_pruned(
+    index: DomainIndex,
+    query_tokens: List[str],
+    k: int,
+    rank_key=lambda score: score
+) -> Dict[int, float]:
+    """
+    MaxScore 式剪枝評分，回傳可能進入前 k 名的文檔及其精確分數
+
+    依上界由大到小處理查詢詞；當剩餘詞的上界總和已低於目前第 k 名的
+    分數下限，新文檔不可能進榜，此後只對既有候選以二分搜尋補分。
+    rank_key 為排序時實際比較的值（例如四捨五入後的分數），剪枝判斷
+    以它為準，確保同分排序與完整評分一致。
+
+    回傳的分數以與 score_index() 相同的順序累加，逐位元一致。
+    """
+    counts: Dict[str, int] = {}
+    for term in query_tokens:
+        if term in index.postings:
+            counts[term] = counts.get(term, 0) + 1
+    if not counts or k <= 0:
+        return {}
+
+    terms = sorted(counts, key=lambda t: counts[t] * _term_bound(index, t), reverse=True)
+    suffix = [0.0] * (len(terms) + 1)
+    for i in range(len(terms) - 1, -1, -1):
+        suffix[i] = suffix[i + 1] + counts[terms[i]] * _term_bound(index, terms[i])
+
+    doc_lens = index.doc_lens
+    partial: Dict[int, float] = {}
+    threshold = None
+    cut = len(terms)
+    for i, term in enumerate(terms):
+        if len(partial) >= k:
+            threshold = heapq.nlargest(k, partial.values())[-1] - _PRUNE_EPS
+            if rank_key(suffix[i] + _PRUNE_EPS) < rank_key(threshold):
+                cut = i
+                break
+
+        idf_score = index.idf.get(term, 0)
+        count = counts[term]
+        for row_id, freq in index.postings[term]:
+            impact = _term_impact(freq, doc_lens[row_id], idf_score, index.avg_dl)
+            partial[row_id] = partial.get(row_id, 0.0) + count * impact
+
+    # 剩餘詞的上界不足以讓候選追上門檻者，直接淘汰
+    candidates = list(partial)
+    if cut < len(terms) and threshold is not None:
+        rest = suffix[cut] + _PRUNE_EPS
+        candidates = [d for d in candidates if rank_key(partial[d] + rest) >= rank_key(threshold)]
+
+    # 候選以查詢詞原順序精確重算
+    return _rescore(index, query_tokens, sorted(candidates))
+
+
+def _import_sparse():
+    """
+    延遲載入 NumPy / SciPy；未安裝時回傳 None
+
+    不在模組頂層 import：CLI 每次呼叫都會載入 core，NumPy 的匯入成本
+    會直接加在每次查詢的啟動時間上。
+    """
+    try:
+        import numpy
+        from scipy import sparse
+    except ImportError:
+        return None
+    return numpy, sparse
+
+
+def has_sparse_backend() -> bool:
+    """是否可使用 NumPy / SciPy 稀疏矩陣後端"""
+    return _import_sparse() is not None
+
+
+class SparseIndex:
+    """
+    以 CSR/CSC 稀疏矩陣保存的 BM25 權重 (文檔 × 詞)
+
+    每個非零元素即該詞在該文檔的 BM25 貢獻，查詢因此化為稀疏向量內積；
+    多筆查詢組成詞 × 查詢矩陣後，一次稀疏矩陣乘法即可得到全部分數。
+    """
+
+    def __init__(self, index: DomainIndex, k1: float = 1.5, b: float = 0.75):
+        modules = _import_sparse()
+        if modules is None:
+            raise ImportError('sparse 後端需要 numpy 與 scipy')
+        np, sparse = modules
+        self._np = np
+        self._sparse = sparse
+
+        self.vocab = {term: j for j, term in enumerate(index.postings)}
+        rows, cols, freqs, idfs = [], [], [], []
+        for term, j in self.vocab.items():
+            idf_score = index.idf.get(term, 0)
+            for row_id, freq in index.postings[term]:
+                rows.append(row_id)
+                cols.append(j)
+                freqs.append(freq)
+                idfs.append(idf_score)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        tf = np.asarray(freqs, dtype=np.float64)
+        dl = np.asarray(index.doc_lens, dtype=np.float64)[rows]
+        norm = k1 * (1 - b + b * (dl / index.avg_dl)) if index.avg_dl else np.full(len(rows), k1)
+        weights = np.asarray(idfs, dtype=np.float64) * (tf * (k1 + 1) / (tf + norm))
+
+        shape = (len(index.doc_lens), len(self.vocab))
+        self.matrix = sparse.csr_matrix((weights, (rows, np.asarray(cols, dtype=np.int64))), shape=shape)
+        self._columns = self.matrix.tocsc()
+
+    def _query_matrix(self, queries: List[List[str]]):
+        """將多筆已分詞查詢轉為 詞 × 查詢 的稀疏計數矩陣（重複詞重複計）"""
+        np = self._np
+        rows, cols, data = [], [], []
+        for qi, tokens in enumerate(queries):
+            counts: Dict[int, int] = {}
+            for term in tokens:
+                j = self.vocab.get(term)
+                if j is not None:
+                    counts[j] = counts.get(j, 0) + 1
+            for j, count in counts.items():
+                rows.append(j)
+                cols.append(qi)
+                data.append(count)
+        return self._sparse.csc_matrix(
+            (np.asarray(data, dtype=np.float64), (rows, cols)),
+            shape=(len(self.vocab), len(queries)),
+        )
+
+    def score(self, query_tokens: List[str]) -> Dict[int, float]:
+        """單筆查詢：只取查詢詞所在的欄做加權加總，回傳 row_id -> score"""
+        np = self._np
+        counts: Dict[int, int] = {}
+        for term in query_tokens:
+            j = self.vocab.get(term)
+            if j is not None:
+                counts[j] = counts.get(j, 0) + 1
+        if not counts:
+            return {}
+
+        cols = list(counts)
+        weights = np.asarray([counts[j] for j in cols], dtype=np.float64)
+        column = np.asarray(self._columns[:, cols] @ weights).ravel()
+        nz = np.flatnonzero(column)
+        return dict(zip(nz.tolist(), column[nz].tolist()))
+
+    def score_many(self, queries: List[List[str]]) -> List[Dict[int, float]]:
+        """批次查詢：一次稀疏矩陣乘法算出所有查詢的分數"""
+        if not queries:
+            return []
+        product = (self.matrix @ self._query_matrix(queries)).tocsc()
+        results = []
+        for qi in range(len(queries)):
+            start, end = product.indptr[qi], product.indptr[qi + 1]
+            results.append(dict(zip(product.indices[start:end].tolist(),
+                                    product.data[start:end].tolist())))
+        return results
+
+
+class KeywordMatcher:
+    """
+    多關鍵字一次比對 (Aho-Corasick)
+
+    將各組關鍵字編成單一自動機，掃描文字一次即得各組命中的關鍵字數，
+    與逐一檢查 `keyword in text` 的結果相同：同一關鍵字出現多次只算一次，
+    同一組重複列出、或分屬多組的關鍵字各自計數。
+
+    預設使用純 Python 實作；安裝 pyahocorasick 時改用其 C 實作。
+    """
+
+    def __init__(self, groups: Dict[Any, List[str]], use_c: Optional[bool] = None):
+        self.groups = list(groups)
+        self._order = {group: i for i, group in enumerate(self.groups)}
+        # 關鍵字 -> 所屬組別（可重複）
+        owners: Dict[str, List[str]] = {}
+        for group, keywords in groups.items():
+            for keyword in keywords:
+                owners.setdefault(keyword, []).append(group)
+        # 空字串是任何文字的子字串，不進自動機，直接計分
+        self._always = owners.pop('', [])
+        self._owners = list(owners.values())
+
+        if use_c is None:
+            use_c = HAS_AHOCORASICK
+        self._automaton = None
+        if use_c and owners:
+            self._automaton = ahocorasick.Automaton()
+            for i, keyword in enumerate(owners):
+                self._automaton.add_word(keyword, i)
+            self._automaton.make_automaton()
+        else:
+            self._build(list(owners))
+
+    def _build(self, patterns: List[str]) -> None:
+        """
+        建立 trie 與失敗連結
+
+        只存 trie 本身的轉移，比對時沒有轉移就沿失敗連結退回；不展開成完整轉移表，
+        否則每個狀態都要複製一份根節點的轉移，記憶體隨狀態數 × 關鍵字首字數成長
+        （數千條中文關鍵字即達數百 MB）。退回的總次數不超過掃描的字元數，
+        比對仍是線性時間。
+        """
+        goto: List[Dict[str, int]] = [{}]
+        out: List[List[int]] = [[]]
+        for i, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[state][ch] = nxt
+                    goto.append({})
+                    out.append([])
+                state = nxt
+            out[state].append(i)
+
+        fail = [0] * len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            # 失敗狀態較淺，已先處理
+            for ch, nxt in goto[state].items():
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                out[nxt] = out[nxt] + out[fail[nxt]]
+                queue.append(nxt)
+
+        self._goto = goto
+        self._fail = fail
+        self._out = [tuple(o) for o in out]
+
+    def _scan(self, text: str) -> set:
+        """掃描一次，回傳命中的關鍵字編號"""
+        matched = set()
+        if self._automaton is not None:
+            for _, i in self._automaton.iter(text):
+                matched.add(i)
+        elif self._owners:
+            goto, fail, out, state = self._goto, self._fail, self._out, 0
+            for ch in text:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                if out[state]:
+                    matched.update(out[state])
+        return matched
+
+    def counts(self, text: str) -> Dict[str, int]:
+        """回傳 {組別: 命中的關鍵字數}，組別順序與建構時相同"""
+        counts = dict.fromkeys(self.groups, 0)
+        for group in self._always:
+            counts[group] += 1
+        for i in self._scan(text):
+            for group in self._owners[i]:
+                counts[group] += 1
+        return counts
+
+    def matched(self, text: str) -> List[Any]:
+        """回傳至少命中一個關鍵字的組別，依建構時的順序；只與命中數有關，不走訪所有組別"""
+        hit = set(self._always)
+        for i in self._scan(text):
+            hit.update(self._owners[i])
+        return sorted(hit, key=self._order.__getitem__)
+
+
+class KeywordRules:
+    """
+    編譯後的關鍵字推薦規則與反模式
+
+    rules 為 {關鍵字: [(provider, 權重, 理由)]}，anti_patterns 為
+    {provider: [(關鍵字, 警告)]}。兩者的關鍵字（不分大小寫）編成同一個
+    KeywordMatcher 自動機，每筆查詢只掃描一次，結果與逐條檢查
+    `keyword in query.lower()` 相同、依規則定義的順序回傳；規則數增加時
+    查詢成本只隨查詢長度與命中數成長。同一查詢的掃描結果經 LRU 記憶，
+    先計分、再取警告不必掃第二次。
+
+    規則可直接以 dict 定義，或由 CSV 載入，見 from_csv()。
+    """
+
+    def __init__(self, rules: Dict[str, List[Tuple[str, Any, str]]],
+                 anti_patterns: Optional[Dict[str, List[Tuple[str, str]]]] = None,
+                 use_c: Optional[bool] = None):
+        self.rules = [(keyword, tuple(entries)) for keyword, entries in rules.items()]
+        self.anti_patterns = {provider: list(patterns) for provider, patterns in (anti_patterns or {}).items()}
+        groups: Dict[Any, List[str]] = {}
+        for i, (keyword, _) in enumerate(self.rules):
+            groups[('rule', i)] = [keyword.lower()]
+        for provider, patterns in self.anti_patterns.items():
+            for i, (keyword, _) in enumerate(patterns):
+                groups[('anti', provider, i)] = [keyword.lower()]
+        self.matcher = KeywordMatcher(groups, use_c)
+        self._hits = lru_cache(maxsize=QUERY_CACHE_SIZE)(self._scan)
+
+    @classmethod
+    def from_csv(cls, rules_path: Any, anti_path: Optional[Any] = None,
+                 use_c: Optional[bool] = None) -> 'KeywordRules':
+        """
+        由 CSV 載入規則
+
+        rules_path 的欄位為 keyword, provider, weight, reason，同一關鍵字的多列
+        依檔案順序合併；anti_path 的欄位為 provider, keyword, warning。
+        整數權重維持 int，輸出的理由與以 dict 定義時相同。
+        """
+        rules: Dict[str, List[Tuple[str, Any, str]]] = {}
+        for row in read_csv(str(rules_path)):
+            weight = float(row['weight'])
+            rules.setdefault(row['keyword'], []).append(
+                (row['provider'], int(weight) if weight.is_integer() else weight, row.get('reason') or ''))
+        anti_patterns: Dict[str, List[Tuple[str, str]]] = {}
+        if anti_path is not None:
+            for row in read_csv(str(anti_path)):
+                anti_patterns.setdefault(row['provider'], []).append((row['keyword'], row.get('warning') or ''))
+        return cls(rules, anti_patterns, use_c)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def _scan(self, query: str) -> Tuple[Tuple[int, ...], Dict[str, Tuple[int, ...]]]:
+        """(命中的規則編號, provider -> 命中的反模式編號)"""
+        rule_ids = []
+        anti: Dict[str, List[int]] = {}
+        for group in self.matcher.matched(query.lower()):
+            if group[0] == 'rule':
+                rule_ids.append(group[1])
+            else:
+                anti.setdefault(group[1], []).append(group[2])
+        return tuple(rule_ids), {provider: tuple(ids) for provider, ids in anti.items()}
+
+    def match(self, query: str) -> List[Tuple[str, Tuple[Tuple[str, Any, str], ...]]]:
+        """回傳命中的 (關鍵字, [(provider, 權重, 理由)])，依規則定義的順序"""
+        return [self.rules[i] for i in self._hits(query)[0]]
+
+    def warnings(self, query: str, provider: str) -> List[Tuple[str, str]]:
+        """回傳 provider 命中的 (關鍵字, 警告)，依定義的順序"""
+        patterns = self.anti_patterns.get(provider, [])
+        return [patterns[i] for i in self._hits(query)[1].get(provider, ())]
+
+
+class QueryCache:
+    """
+    有上限的 LRU 查詢結果快取，附命中 / 未命中 / 淘汰計數
+
+    每筆結果記錄它所依賴的 CSV 版本；取用時版本不符即視為過期並丟棄，
+    資料更新後不會再回傳舊結果。
+    """
+
+    def __init__(self, maxsize: int = QUERY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries: 'OrderedDict[Tuple, Tuple[Tuple, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple, version: Tuple) -> Tuple[bool, Any]:
+        """回傳 (是否命中, 值)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != version:
+                del self._entries[key]
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def put(self, key: Tuple, version: Tuple, value: Any) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+class Profiler:
+    """
+    分階段計時：各階段的呼叫次數、總耗時與扣除子階段後的自身耗時
+
+    instrument() 以計時包裝取代模組或類別上的函數，只在 enable() 之後才會
+    包裝；未啟用時函數維持原樣，沒有任何額外成本。同一階段巢狀呼叫時
+    （例如 format_* 互相呼叫）總耗時只計最外層。只供單執行緒的 CLI 使用。
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.started = 0.0
+        self.stats: Dict[str, List] = {}   # stage -> [calls, total, self, depth]
+        self._stack: List[float] = []      # 進行中的各層呼叫已累計的子階段耗時
+
+    def enable(self) -> 'Profiler':
+        if not self.enabled:
+            self.enabled = True
+            self.started = time.perf_counter()
+            self.instrument_engine()
+        return self
+
+    def instrument(self, owner: Any, names: Iterable[str], stage: str) -> None:
+        """將 owner（模組或類別）上的 names 包裝為 stage 階段；未啟用時不做任何事"""
+        if not self.enabled:
+            return
+        for name in names:
+            fn = getattr(owner, name, None)
+            if fn is not None and not getattr(fn, '__profiled__', False):
+                setattr(owner, name, self._timed(fn, stage))
+
+    def _timed(self, fn, stage: str):
+        record = self.stats.setdefault(stage, [0, 0.0, 0.0, 0])
+        stack = self._stack
+        clock = time.perf_counter
+
+        @wraps(fn)
+        def timed(*args, **kwargs):
+            record[3] += 1
+            stack.append(0.0)
+            start = clock()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                record[3] -= 1
+                record[0] += 1
+                record[2] += elapsed - stack.pop()
+                if not record[3]:
+                    record[1] += elapsed
+                if stack:
+                    stack[-1] += elapsed
+
+        timed.__profiled__ = True
+        return timed
+
+    def instrument_engine(self) -> None:
+        """包裝本模組的 CSV 讀取、分詞、IDF、評分、排序與索引載入 / 建立"""
+        module = sys.modules[__name__]
+        self.instrument(module, ['read_csv', 'read_rows'], 'load_csv')
+        self.instrument(module, ['tokenize', 'match_tokens'], 'tokenize')
+        self.instrument(module, ['compute_idf'], 'compute_idf')
+        self.instrument(module, ['bm25_score', 'score_index', 'score_index_pruned'], 'bm25_score')
+        self.instrument(SparseIndex, ['score', 'score_many'], 'bm25_score')
+        self.instrument(SearchEngine, ['_materialize'], 'sort')
+        self.instrument(SearchEngine, ['load_index'], 'load_index')
+        self.instrument(SearchEngine, ['build_index'], 'build_index')
+
+    def report(self) -> Dict[str, Any]:
+        """{'wall_ms', 'stages': {stage: {'calls', 'total_ms', 'self_ms'}}}，依自身耗時排序"""
+        stages = sorted(self.stats.items(), key=lambda item: item[1][2], reverse=True)
+        return {
+            'wall_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'stages': {stage: {'calls': calls, 'total_ms': round(total * 1000, 3),
+                               'self_ms': round(own * 1000, 3)}
+                       for stage, (calls, total, own, _) in stages if calls},
+        }
+
+    def format_table(self) -> str:
+        report = self.report()
+        wall = report['wall_ms'] or 1.0
+        width = max([14, *map(len, report['stages'])])
+        lines = [f'  {"stage":<{width}} {"calls":>8} {"total ms":>11} {"self ms":>11} {"self %":>7}']
+        for stage, s in report['stages'].items():
+            lines.append(f'  {stage:<{width}} {s["calls"]:>8} {s["total_ms"]:>11.3f} '
+                         f'{s["self_ms"]:>11.3f} {s["self_ms"] / wall * 100:>6.1f}%')
+        lines.append(f'  {"(wall)":<{width}} {"":>8} {report["wall_ms"]:>11.3f}')
+        return '\n'.join(lines)
+
+
+PROFILER = Profiler()
+
+
+def parse_profile_mode(spec: str) -> Tuple[str, Optional[str]]:
+    """
+    解析 --profile / TAIWAN_SEARCH_PROFILE 的值為 (模式, cProfile 輸出路徑)
+
+    'table'（或 '1'）、'json'、'cprofile'、'cprofile:路徑'；格式錯誤時拋出 ValueError。
+    """
+    mode, _, path = spec.strip().partition(':')
+    mode = mode.lower()
+    if mode in ('1', 'true', 'on'):
+        mode = 'table'
+    if mode not in ('table', 'json', 'cprofile') or (path and mode != 'cprofile'):
+        raise ValueError(f'--profile 應為 table、json、cprofile 或 cprofile:路徑: {spec!r}')
+    return mode, path or None
+
+
+def start_profiling(spec: str, script: str, out: Optional[TextIO] = None) -> Profiler:
+    """
+    依 spec（見 parse_profile_mode）開始量測，行程結束時把結果寫到 out
+
+    table / json 啟用 PROFILER 的分階段計時，呼叫端可再以 PROFILER.instrument()
+    包裝自己的 format_* 等函數；cprofile 以 cProfile 量測整個行程，結果存成
+    script 名稱加 .prof 的檔案（或指定的路徑），供 pstats / snakeviz 檢視。
+    out 預設為行程結束當下的 sys.stderr，不影響 stdout 的查詢結果。
+    """
+    import atexit
+
+    mode, path = parse_profile_mode(spec)
+    if mode == 'cprofile':
+        import cProfile
+
+        profile = cProfile.Profile()
+        path = path or f'{os.path.splitext(os.path.basename(script))[0]}.prof'
+
+        def dump():
+            profile.disable()
+            profile.dump_stats(path)
+            print(f'[profile] cProfile 結果已寫入 {path}（python -m pstats {path}）', file=out or sys.stderr)
+
+        atexit.register(dump)
+        profile.enable()
+        return PROFILER
+
+    def emit():
+        if mode == 'json':
+            import json
+            print(json.dumps({'script': os.path.basename(script), **PROFILER.report()}), file=out or sys.stderr)
+        else:
+            print(f'\n[profile] {os.path.basename(script)}', file=out or sys.stderr)
+            print(PROFILER.format_table(), file=out or sys.stderr)
+
+    atexit.register(emit)
+    return PROFILER.enable()
+
+
+def parse_simple_args(argv: List[str], options: Dict[str, Tuple[str, Any]],
+                      defaults: Dict[str, Any]) -> Optional[Any]:
+    """
+    不經 argparse 解析「一個查詢字串加上少數選項」的常見 CLI 呼叫
+
+    argparse 連同它匯入的 shutil、gettext 比一次查詢還慢，而 agent 幾乎每次都是
+    這種呼叫。options 為 {選項字串: (屬性, 轉換)}：轉換為 None 表示旗標；為集合
+    時值必須在其中；否則以值呼叫，拋出 ValueError 視為無效。遇到其他參數、缺少
+    查詢或值無效時回傳 None，由呼叫端改用 argparse（含 --help 與錯誤訊息）。
+    回傳的物件與 argparse.Namespace 一樣以屬性取值，未出現的選項取 defaults。
+    """
+    from types import SimpleNamespace
+
+    values = dict(defaults)
+    query = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg.startswith('-') and len(arg) > 1:
+            name, eq, value = arg.partition('=')
+            spec = options.get(name)
+            if spec is None:
+                return None
+            dest, convert = spec
+            if convert is None:
+                if eq:
+                    return None
+                values[dest] = True
+            else:
+                if not eq:
+                    i += 1
+                    if i == len(argv):
+                        return None
+                    value = argv[i]
+                if callable(convert):
+                    try:
+                        value = convert(value)
+                    except ValueError:
+                        return None
+                elif value not in convert:
+                    return None
+                values[dest] = value
+        elif query is None:
+            query = arg
+        else:
+            return None
+        i += 1
+    if query is None:
+        return None
+    values['query'] = query
+    return SimpleNamespace(**values)
+
+
+def parse_field_weights(spec: str) -> Dict[str, float]:
+    """解析 CLI 的 'code=3,solution=0.5' 為 {欄位: 權重}；格式錯誤時拋出 ValueError"""
+    weights = {}
+    for item in spec.split(','):
+        col, sep, value = item.partition('=')
+        if not sep or not col.strip():
+            raise ValueError(f'欄位權重格式應為 欄位=權重: {item!r}')
+        weights[col.strip()] = float(value)
+    return weights
+
+
+def cli_field_weights(args: Any) -> Optional[Dict[str, float]]:
+    """
+    CLI 的 --boost / --bm25f 轉成 search() 的 field_weights
+
+    兩者皆未指定時回傳 None（一般 BM25）；只有 --bm25f 時回傳空 dict，
+    即沿用 CSV_CONFIG 預設的欄位權重。
+    """
+    if args.boost is not None:
+        return args.boost
+    return {} if args.bm25f else None
+
+
+def _copy_results(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [dict(r) for r in results]
+
+
+def _looks_like_code(token: str) -> bool:
+    """token（小寫）是否符合錯誤碼 / 狀態碼的形狀，見 _CODE_SHAPE"""
+    return bool(_CODE_SHAPE.fullmatch(token))
+
+
+def _parse_code_query(query: str) -> Optional[Tuple[Optional[str], str]]:
+    """
+    將 '10000016'、'ecpay 10000016'、'10000016 ecpay' 拆成 (另一個詞, code)（小寫），不像碼時回傳 None
+
+    另一個詞不一定是服務商（'error 10000016'），是否當作 provider 限定由
+    SearchEngine._query_code_rows() 依碼索引判斷。
+    """
+    parts = query.lower().split()
+    if len(parts) == 1 and _looks_like_code(parts[0]):
+        return None, parts[0]
+    if len(parts) == 2:
+        if _looks_like_code(parts[1]):
+            return parts[0], parts[1]
+        if _looks_like_code(parts[0]):
+            return parts[1], parts[0]
+    return None
+
+
+BatchItem = Union[str, Dict[str, Any]]
+BatchJob = Tuple[str, str, int]
+
+# name -> 最近建立的引擎。批次查詢的子行程經由這裡取回引擎：
+# fork 的子行程直接拿到父行程已載入索引的那一個，spawn 的則依設定重建
+_ENGINES: Dict[str, 'SearchEngine'] = {}
+
+
+def _restore_engine(name: str, settings: Dict[str, Any]) -> 'SearchEngine':
+    engine = _ENGINES.get(name)
+    if engine is None or engine._settings() != settings:
+        engine = SearchEngine(name, **settings)
+    return engine
+
+
+def _run_batch_chunk(engine: 'SearchEngine', backend: Optional[str],
+                     jobs: List[BatchJob]) -> List[List[Dict[str, Any]]]:
+    """子行程入口（須為模組層級函數才能被 pickle）"""
+    return engine._run_batch(jobs, backend)
+
+
+def map_batch(fn, items: Iterable[Any], processes: Optional[int] = None,
+              threshold: int = BATCH_PROCESS_THRESHOLD) -> List[Any]:
+    """
+    以 fn 處理整批 items，回傳與 items 順序相同的結果
+
+    fn 接受一段 items、回傳等長的結果列表，須為模組層級函數（或其 partial）
+    才能交給子行程。processes 大於 1 且達 threshold 筆時分塊交給多個子行程，
+    否則在本行程一次處理。search_batch() 與各 skill 的 recommend_batch() 共用。
+    """
+    items = list(items)
+    if not processes or processes <= 1 or len(items) < threshold:
+        return fn(items)
+
+    import multiprocessing
+
+    size = -(-len(items) // (processes * 4))
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    with multiprocessing.Pool(processes) as pool:
+        return [result for part in pool.map(fn, chunks) for result in part]
+
+
+class SearchEngine:
+    """
+    一個 skill 的搜索引擎：CSV 設定加上索引、查詢快取與各種查詢入口
+
+    Args:
+        name: skill 名稱，例如 'invoice'
+        csv_config: domain -> {'file', 'search_cols', 'output_cols', 'key_cols'?,
+                    'field_weights'?, 'suggest_cols'?}
+        domain_keywords: domain -> 自動偵測用的關鍵字（與轉小寫後的查詢比對，
+                         因此關鍵字應以小寫撰寫）
+        data_dir: CSV 所在目錄
+        index_dir: 編譯索引檔目錄，由 search.py --build-index 產生
+        default_domain: 查詢未命中任何關鍵字時的域
+        score_digits: 輸出的 _score 四捨五入位數；排序也以四捨五入後的分數
+                      為準，同分時維持 CSV 原本的先後
+        tag_domain: 單域結果是否也帶 '_domain' 欄位（跨域合併的結果一律帶）
+        backend: 預設評分後端，'python'（無外部依賴）或 'sparse'（需 NumPy + SciPy）
+        cache_size: 查詢結果 LRU 快取容量，0 表示停用
+
+    同一個引擎可在多執行緒間共用；data_dir / index_dir 可於建立後改指其他目錄
+    （改指後請清空 indexes）。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        csv_config: Dict[str, Dict[str, Any]],
+        domain_keywords: Dict[str, List[str]],
+        data_dir: Any,
+        index_dir: Any,
+        default_domain: str = 'provider',
+        score_digits: int = 2,
+        tag_domain: bool = True,
+        backend: str = 'python',
+        cache_size: int = QUERY_CACHE_SIZE
+    ):
+        self.name = name
+        self.csv_config = csv_config
+        self.domain_keywords = domain_keywords
+        self.data_dir = data_dir
+        self.index_dir = index_dir
+        self.default_domain = default_domain
+        self.score_digits = score_digits
+        self.tag_domain = tag_domain
+        self.backend = backend
+
+        # 每個行程只建一次索引；agent 迴圈會在同一行程內反覆呼叫 search()
+        self.indexes: Dict[str, DomainIndex] = {}
+        # domain -> (建立時所依據的 DomainIndex, SparseIndex)；索引重建後自動失效
+        self.sparse_indexes: Dict[str, Tuple[DomainIndex, SparseIndex]] = {}
+        self.cache = QueryCache(cache_size)
+        self._matcher: Optional[KeywordMatcher] = None
+        _ENGINES[name] = self
+
+    def _settings(self) -> Dict[str, Any]:
+        return {
+            'csv_config': self.csv_config,
+            'domain_keywords': self.domain_keywords,
+            'data_dir': self.data_dir,
+            'index_dir': self.index_dir,
+            'default_domain': self.default_domain,
+            'score_digits': self.score_digits,
+            'tag_domain': self.tag_domain,
+            'backend': self.backend,
+            'cache_size': self.cache.maxsize,
+        }
+
+    def __reduce__(self):
+        # 只傳設定，不傳索引與快取；子行程見 _restore_engine()
+        return _restore_engine, (self.name, self._settings())
+
+    def __repr__(self) -> str:
+        return f'SearchEngine({self.name!r}, data_dir={str(self.data_dir)!r})'
+
+    # ── 索引 ────────────────────────────────────────────────
+
+    def csv_path(self, domain: str) -> str:
+        return os.path.join(self.data_dir, self.csv_config[domain]['file'])
+
+    def _index_path(self, domain: str) -> str:
+        return os.path.join(self.index_dir, f'{domain}.idx')
+
+    def load_csv(self, domain: str) -> Tuple[RowStore, List[List[str]]]:
+        """載入域的 CSV，回傳 (資料列, 各列搜索欄位的 token)"""
+        config = self.csv_config.get(domain)
+        if not config:
+            return RowStore((), []), []
+
+        rows = read_rows(self.csv_path(domain))
+        documents = [tokenize(' '.join(record)) for record in rows.records(config['search_cols'])]
+        return rows, documents
+
+    def build_index(self, domain: str) -> Optional[DomainIndex]:
+        """讀取域的 CSV 並建立倒排索引"""
+        if domain not in self.csv_config:
+            return None
+
+        source = _source_signature(self.csv_path(domain))
+        rows, documents = self.load_csv(domain)
+
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        for row_id, doc_tokens in enumerate(documents):
+            tf: Dict[str, int] = {}
+            for term in doc_tokens:
+                tf[term] = tf.get(term, 0) + 1
+            for term, freq in tf.items():
+                postings.setdefault(sys.intern(term), []).append((row_id, freq))
+
+        # IDF 與平均文檔長度沿用逐列計算的算法，確保分數與 bm25_score() 完全一致
+        avg_dl = sum(len(doc) for doc in documents) / len(documents) if documents else 1
+        # idf 改以 postings 的 key 建立：詞彙字串只存一份（marshal 會保留 interning）
+        idf = compute_idf(documents)
+
+        index = DomainIndex(
+            rows=rows,
+            postings=postings,
+            doc_lens=[len(doc) for doc in documents],
+            idf={term: idf[term] for term in postings},
+            avg_dl=avg_dl,
+            source=source,
+        )
+        if 'field_weights' in self.csv_config[domain]:
+            self._add_field_postings(domain, index)
+        return index
+
+    def _add_field_postings(self, domain: str, index: DomainIndex, b: float = 0.75) -> None:
+        """
+        為 BM25F 域加上各欄位的 postings：各欄位分別分詞，詞頻以該欄位的平均長度正規化
+
+        b 與 _term_impact() 的預設值相同；IDF 以整列（所有欄位）計算文件頻率。
+        欄位權重在查詢時才套用，見 _reweighted()。
+        """
+        fields = tuple(self.csv_config[domain]['search_cols'])
+        rows = index.rows
+        field_tokens = [[tokenize(value) for value in record] for record in rows.records(fields)]
+
+        n = len(rows)
+        avg_lens = [sum(len(per_field[f]) for per_field in field_tokens) / n if n else 0.0
+                    for f in range(len(fields))]
+
+        field_postings: Dict[str, List[Tuple[int, int, float]]] = {}
+        for row_id, per_field in enumerate(field_tokens):
+            for f, tokens in enumerate(per_field):
+                if not tokens:
+                    continue
+                norm = 1 - b + b * (len(tokens) / avg_lens[f])
+                tf: Dict[str, int] = {}
+                for term in tokens:
+                    tf[term] = tf.get(term, 0) + 1
+                for term, freq in tf.items():
+                    field_postings.setdefault(sys.intern(term), []).append((row_id, f, freq / norm))
+
+        idf = compute_idf([[t for tokens in per_field for t in tokens] for per_field in field_tokens])
+        index.fields = fields
+        index.field_postings = field_postings
+        index.field_idf = {term: idf[term] for term in field_postings}
+
+    def field_weights(self, domain: str, overrides: Optional[Dict[str, float]] = None) -> Tuple[float, ...]:
+        """
+        BM25F 域各 search_cols 的權重（未列出的欄位為 1.0），依 search_cols 順序
+
+        overrides 為查詢時指定的權重，覆寫 CSV_CONFIG 的設定；域未設定
+        field_weights 或指定了不在 search_cols 內的欄位時拋出 ValueError。
+        """
+        config = self.csv_config[domain]
+        if 'field_weights' not in config:
+            raise ValueError(f'域 {domain} 未設定 field_weights (BM25F)，無法指定欄位權重')
+        weights = dict(config['field_weights'])
+        if overrides:
+            unknown = [col for col in overrides if col not in config['search_cols']]
+            if unknown:
+                raise ValueError(f'域 {domain} 的 search_cols 沒有欄位: {", ".join(unknown)}')
+            weights.update(overrides)
+        return tuple(float(weights.get(col, 1.0)) for col in config['search_cols'])
+
+    def save_index(self, domain: str, index: DomainIndex) -> bool:
+        """
+        將索引寫入 index_dir，回傳是否成功
+
+        先寫暫存檔再 os.replace，避免並行的 CLI 讀到寫到一半的檔案。
+        安裝目錄唯讀時靜默略過，查詢仍可使用記憶體中的索引。
+        """
+        config = self.csv_config[domain]
+        payload = {
+            'version': INDEX_FORMAT_VERSION,
+            'search_cols': config['search_cols'],
+            'field_weights': config.get('field_weights'),
+            'source': index.source,
+            'digest': _file_digest(self.csv_path(domain)),
+            'columns': index.rows.columns,
+            'rows': index.rows.data,
+            'postings': index.postings,
+            'doc_lens': index.doc_lens,
+            'idf': index.idf,
+            'avg_dl': index.avg_dl,
+            'fields': index.fields,
+            'field_postings': index.field_postings,
+            'field_idf': index.field_idf,
+        }
+
+        path = self._index_path(domain)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                marshal.dump(payload, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def load_index(self, domain: str) -> Optional[DomainIndex]:
+        """載入編譯後的索引檔；不存在、格式不符或來源 CSV 已變動時回傳 None"""
+        config = self.csv_config[domain]
+        csv_path = self.csv_path(domain)
+
+        try:
+            # 整檔讀入再 loads：marshal.load(f) 逐物件向檔案要資料，同一個檔案慢上數倍
+            with open(self._index_path(domain), 'rb') as f:
+                payload = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+
+        if not isinstance(payload, dict):
+            return None
+        if payload.get('version') != INDEX_FORMAT_VERSION:
+            return None
+        if payload.get('search_cols') != config['search_cols']:
+            return None
+        if payload.get('field_weights') != config.get('field_weights'):
+            return None
+
+        source = _source_signature(csv_path)
+        stale = tuple(payload.get('source', ())) != source
+        if stale and payload.get('digest') != _file_digest(csv_path):
+            return None
+
+        try:
+            index = DomainIndex(
+                rows=RowStore(payload['columns'], payload['rows']),
+                postings=payload['postings'],
+                doc_lens=payload['doc_lens'],
+                idf=payload['idf'],
+                avg_dl=payload['avg_dl'],
+                source=source,
+                fields=tuple(payload['fields']),
+                field_postings=payload['field_postings'],
+                field_idf=payload['field_idf'],
+            )
+        except KeyError:
+            return None
+
+        # 只有 mtime 變動、內容相同：更新簽章，下次就不必再算雜湊
+        if stale:
+            self.save_index(domain, index)
+        return index
+
+    def build_all_indexes(self) -> Dict[str, int]:
+        """重建所有域的索引檔，回傳 domain -> 記錄數"""
+        built = {}
+        for domain in self.csv_config:
+            index = self.build_index(domain)
+            self.save_index(domain, index)
+            self.indexes[domain] = index
+            built[domain] = len(index.rows)
+        return built
+
+    def get_index(self, domain: str) -> Optional[DomainIndex]:
+        """
+        取得域的索引
+
+        依序使用：記憶體快取 → 編譯後的索引檔 → 重新建立（並寫回索引檔）。
+        每次都比對來源 CSV 的簽章，資料更新後不會用到過期的索引。
+        """
+        if domain not in self.csv_config:
+            return None
+
+        index = self.indexes.get(domain)
+        if index is not None and index.source == _source_signature(self.csv_path(domain)):
+            return index
+
+        index = self.load_index(domain)
+        if index is None:
+            index = self.build_index(domain)
+            self.save_index(domain, index)
+
+        self.indexes[domain] = index
+        return index
+
+    def get_sparse_index(self, domain: str) -> Optional[SparseIndex]:
+        """取得域的稀疏矩陣索引，依附於 get_index() 的失效判斷"""
+        index = self.get_index(domain)
+        if index is None:
+            return None
+        cached = self.sparse_indexes.get(domain)
+        if cached is not None and cached[0] is index:
+            return cached[1]
+        sparse_index = SparseIndex(index)
+        self.sparse_indexes[domain] = (index, sparse_index)
+        return sparse_index
+
+    def get_available_domains(self) -> List[str]:
+        """取得可用的搜索域列表"""
+        return list(self.csv_config.keys())
+
+    def get_domain_info(self, domain: str) -> Optional[Dict[str, Any]]:
+        """取得域的設定資訊與記錄數"""
+        if domain not in self.csv_config:
+            return None
+
+        config = self.csv_config[domain]
+        return {
+            'domain': domain,
+            'file': config['file'],
+            'search_cols': config['search_cols'],
+            'output_cols': config['output_cols'],
+            'total_records': len(self.get_index(domain).rows)
+        }
+
+    # ── 查詢快取 ────────────────────────────────────────────
+
+    def _data_version(self, domains: Iterable[str]) -> Tuple:
+        """
+        結果所依賴的 CSV 版本：各域來源檔的 (mtime_ns, size)
+
+        只 stat 實際影響結果的檔案 —— 與 get_index() 每次查詢本來就做的
+        檢查相同，快取命中時不會比直接搜索多出 I/O。
+        """
+        return tuple(_source_signature(self.csv_path(d)) for d in domains if d in self.csv_config)
+
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        """
+        快取鍵用的查詢正規化
+
+        只去頭尾空白並轉小寫：tokenize() 與 detect_domain() 都先轉小寫，
+        結果不受影響。連續空白不合併，含空白的關鍵字 (如 'how to') 比對會因此改變。
+        """
+        return query.strip().lower()
+
+    def _cached(self, key: Tuple, version: Tuple, compute, copy):
+        """以查詢快取包裝查詢；回傳值一律經 copy()，呼叫端修改結果不會汙染快取"""
+        found, value = self.cache.get(key, version)
+        if not found:
+            value = compute()
+            self.cache.put(key, version, value)
+        return copy(value)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """查詢結果快取的統計：hits、misses、evictions、invalidations、size、maxsize"""
+        return self.cache.stats()
+
+    # ── 域偵測 ──────────────────────────────────────────────
+
+    def domain_matcher(self) -> KeywordMatcher:
+        """domain_keywords 編譯後的比對器，第一次使用時建立（關鍵字照原樣編譯）"""
+        if self._matcher is None:
+            self._matcher = KeywordMatcher(self.domain_keywords)
+        return self._matcher
+
+    def detect_domain(self, query: str) -> str:
+        """自動偵測查詢屬於哪個域（結果經 LRU 快取；只依賴關鍵字，與 CSV 無關）"""
+        return self._cached(('detect', self._normalize_query(query)), (),
+                            lambda: self._detect_domain(query), str)
+
+    def _detect_domain(self, query: str) -> str:
+        # 一次掃描得到各域命中的關鍵字數，取最高者；都沒命中時為 default_domain
+        scores = self.domain_matcher().counts(query.lower())
+        best_domain = max(scores, key=scores.get)
+        if scores[best_domain] == 0:
+            return self.default_domain
+        return best_domain
+
+    # ── 錯誤碼 / 狀態碼精確查詢 ─────────────────────────────
+
+    def _code_domains(self, domain: Optional[str] = None) -> List[str]:
+        if domain is not None:
+            return [domain] if 'key_cols' in self.csv_config.get(domain, {}) else []
+        return [d for d, config in self.csv_config.items() if 'key_cols' in config]
+
+    def _code_rows(
+        self,
+        index: DomainIndex,
+        domain: str,
+        code: str,
+        provider: Optional[str] = None
+    ) -> List[int]:
+        """以碼索引取得 row_id（依 CSV 順序）；索引在第一次使用時建立並掛在 DomainIndex 上"""
+        if index.codes is None:
+            provider_col, code_col = self.csv_config[domain]['key_cols']
+            codes: Dict[str, List[int]] = {}
+            provider_codes: Dict[str, Dict[str, List[int]]] = {}
+            owners = index.rows.column(provider_col)
+            for row_id, key in enumerate(index.rows.column(code_col)):
+                key = key.strip().lower()
+                if not key:
+                    continue
+                codes.setdefault(key, []).append(row_id)
+                owner = owners[row_id].strip().lower()
+                provider_codes.setdefault(owner, {}).setdefault(key, []).append(row_id)
+            index.provider_codes = provider_codes
+            index.codes = codes
+
+        if provider is None:
+            return index.codes.get(code, [])
+        return index.provider_codes.get(provider, {}).get(code, [])
+
+    def _query_code_rows(self, index: DomainIndex, domain: str, parsed: Tuple[Optional[str], str]) -> List[int]:
+        """
+        依 _parse_code_query() 的結果取 row_id
+
+        另一個詞是該域碼索引中的服務商時才當作 provider 限定（'ecpay 10000016'），
+        否則不限服務商（'error 10000016'）。
+        """
+        other, code = parsed
+        rows = self._code_rows(index, domain, code)
+        if other is not None and other in index.provider_codes:
+            rows = self._code_rows(index, domain, code, other)
+        return rows
+
+    def lookup_code(
+        self,
+        code: str,
+        provider: Optional[str] = None,
+        domain: Optional[str] = None
+    ) -> List[Dict[str, str]]:
+        """
+        以錯誤碼 / 狀態碼精確查詢 CSV 原始資料列（不分大小寫）
+
+        Args:
+            code: 碼，例如 '10000016'、'-10066'
+            provider: 只取該服務商的列，預設不限
+            domain: 指定域，預設為所有設有 key_cols 的域
+
+        Returns:
+            符合的資料列（副本），依 CSV 順序
+        """
+        code = code.strip().lower()
+        provider = provider.strip().lower() if provider else None
+        rows = []
+        for d in self._code_domains(domain):
+            index = self.get_index(d)
+            if index is not None:
+                rows.extend(index.rows[r] for r in self._code_rows(index, d, code, provider))
+        return rows
+
+    def _exact_search(
+        self,
+        query: str,
+        domain: str,
+        max_results: int,
+        index: Optional[DomainIndex] = None,
+        field_weights: Optional[Dict[str, float]] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        查詢像碼且在該域的碼索引中命中時，直接回傳那幾列；否則回傳 None 交給 BM25
+
+        分數仍以 BM25（指定 field_weights 時為 BM25F）計算（只算命中的列），輸出格式與一般搜索相同。
+        """
+        if not self._code_domains(domain):
+            return None
+        parsed = _parse_code_query(query)
+        if parsed is None:
+            return None
+        index = index or self.get_index(domain)
+        if index is None or not index.rows:
+            return None
+        row_ids = self._query_code_rows(index, domain, parsed)
+        if not row_ids:
+            return None
+
+        query_tokens = tokenize(query)
+        if field_weights is not None:
+            index = _reweighted(index, self.field_weights(domain, field_weights), query_tokens)
+        scores = _rescore(index, query_tokens, row_ids)
+        return self._materialize(index, domain, scores, max_results) or None
+
+    # ── 前綴建議 ────────────────────────────────────────────
+
+    def _suggest_domains(self, domain: Optional[str] = None) -> List[str]:
+        if domain is not None:
+            return [domain] if 'suggest_cols' in self.csv_config.get(domain, {}) else []
+        return [d for d, config in self.csv_config.items() if 'suggest_cols' in config]
+
+    def prefix_index(self, domain: str) -> Optional[PrefixIndex]:
+        """取得域的前綴索引；掛在 DomainIndex 上，CSV 變動、索引重建後自動重建"""
+        if not self._suggest_domains(domain):
+            return None
+        index = self.get_index(domain)
+        if index is None:
+            return None
+        if index.prefixes is None:
+            index.prefixes = PrefixIndex(index.rows, self.csv_config[domain]['suggest_cols'])
+        return index.prefixes
+
+    def suggest(self, prefix: str, domain: Optional[str] = None, limit: int = 10) -> List[Dict[str, Any]]:
+        """
+        輸入建議：回傳以 prefix 開頭（不分大小寫）的欄位名、端點或代碼
+
+        Args:
+            prefix: 已輸入的文字，例如 'merchantt'、'/b2cinv'、'1000'
+            domain: 指定域，預設為所有設有 suggest_cols 的域
+            limit: 最多回傳幾筆
+
+        Returns:
+            [{'text', 'domain', 'columns'}]，依字母順序；columns 為該詞出現的 CSV 欄位
+        """
+        per_domain = []
+        for d in self._suggest_domains(domain):
+            prefixes = self.prefix_index(d)
+            if prefixes is not None:
+                per_domain.append([(key, term, d, cols) for key, term, cols in prefixes.match(prefix, limit)])
+        merged = heapq.merge(*per_domain, key=lambda item: item[0])
+        return [
+            {'text': term, 'domain': d, 'columns': list(cols)}
+            for _, term, d, cols in islice(merged, max(limit, 0))
+        ]
+
+    def resolve_domain(self, query: str) -> str:
+        """決定查詢要搜索的域：像碼且精確命中某域的碼索引時為該域，否則同 detect_domain()"""
+        parsed = _parse_code_query(query)
+        if parsed is not None:
+            for domain in self._code_domains():
+                index = self.get_index(domain)
+                if index is not None and self._query_code_rows(index, domain, parsed):
+                    return domain
+        return self.detect_domain(query)
+
+    # ── 評分與排序 ──────────────────────────────────────────
+
+    def _rank_key(self, score: float) -> float:
+        """結果排序實際比較的值：輸出的分數（四捨五入到 score_digits 位）"""
+        return round(score, self.score_digits)
+
+    def correct_tokens(self, domain: str, query_tokens: List[str],
+                       index: Optional[DomainIndex] = None) -> List[str]:
+        """
+        模糊比對：將域的詞彙中沒有的英數詞（至少 FUZZY_MIN_LENGTH 字元）換成最接近的詞彙
+
+        已在詞彙中的詞、中文 token 與找不到候選的詞照舊；trigram 索引掛在
+        DomainIndex 上，第一次使用時建立。
+        """
+        index = index or self.get_index(domain)
+        if index is None:
+            return list(query_tokens)
+        corrected = []
+        for token in query_tokens:
+            if token in index.postings or token >= '一' or len(token) < FUZZY_MIN_LENGTH:
+                corrected.append(token)
+                continue
+            if index.fuzzy is None:
+                index.fuzzy = FuzzyIndex(index.postings)
+            corrected.append(index.fuzzy.correct(token) or token)
+        return corrected
+
+    def _score_domain(
+        self,
+        domain: str,
+        index: DomainIndex,
+        query_tokens: List[str],
+        max_results: int,
+        prune: bool = False,
+        backend: Optional[str] = None
+    ) -> Dict[int, float]:
+        """依後端設定計算 row_id -> score"""
+        if (backend or self.backend) == 'sparse':
+            return self.get_sparse_index(domain).score(query_tokens)
+        if prune:
+            return score_index_pruned(index, query_tokens, max_results, self._rank_key)
+        return score_index(index, query_tokens)
+
+    def _materialize(
+        self,
+        index: DomainIndex,
+        domain: str,
+        scores: Dict[int, float],
+        max_results: int
+    ) -> List[Dict[str, Any]]:
+        """取前 max_results 名並建立輸出 dict"""
+        rank_key = self._rank_key
+        # 同分時維持 CSV 原本的先後（row_id 小者在前）
+        winners = heapq.nlargest(
+            max_results,
+            ((score, row_id) for row_id, score in scores.items() if score > 0),
+            key=lambda item: (rank_key(item[0]), -item[1]),
+        )
+
+        output_cols = self.csv_config[domain]['output_cols']
+        columns = [(col, index.rows.column(col)) for col in output_cols]
+        results = []
+        for score, row_id in winners:
+            result = {col: values[row_id] for col, values in columns}
+            result['_score'] = rank_key(score)
+            if self.tag_domain:
+                result['_domain'] = domain
+            results.append(result)
+        return results
+
+    def _rank_domain(
+        self,
+        query_tokens: List[str],
+        domain: str,
+        max_results: int = 5,
+        prune: bool = False,
+        backend: Optional[str] = None,
+        field_weights: Optional[Dict[str, float]] = None,
+        fuzzy: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        以已分詞的查詢對單一域排序，供單域與跨域搜索共用
+
+        以 heapq 取前 max_results 名，只為勝出的列建立輸出 dict。
+        """
+        weights = self.field_weights(domain, field_weights) if field_weights is not None else None
+        index = self.get_index(domain)
+        if index is None or not index.rows:
+            return []
+
+        if fuzzy:
+            query_tokens = self.correct_tokens(domain, query_tokens, index)
+
+        if weights is not None:
+            # BM25F：只為查詢詞的欄位 postings 加權；稀疏矩陣依一般 BM25 建立，改走 python 後端
+            index = _reweighted(index, weights, query_tokens)
+            backend = 'python'
+
+        scores = self._score_domain(domain, index, query_tokens, max_results, prune, backend)
+        return self._materialize(index, domain, scores, max_results)
+
+    def rank(
+        self,
+        query: str,
+        domain: str,
+        max_results: int = 5,
+        prune: bool = False,
+        backend: Optional[str] = None,
+        field_weights: Optional[Dict[str, float]] = None,
+        fuzzy: bool = False
+    ) -> List[Dict[str, Any]]:
+        """對指定域做 BM25 排序（不經快取與精確查詢）"""
+        return self._rank_domain(tokenize(query), domain, max_results, prune, backend, field_weights, fuzzy)
+
+    # ── 查詢入口 ────────────────────────────────────────────
+
+    def search(
+        self,
+        query: str,
+        domain: Optional[str] = None,
+        max_results: int = 5,
+        prune: bool = False,
+        backend: Optional[str] = None,
+        field_weights: Optional[Dict[str, float]] = None,
+        fuzzy: bool = False
+    ) -> List[Dict[str, Any]]:
+        """
+        主搜索函數
+
+        Args:
+            query: 搜索查詢
+            domain: 搜索域，不指定則自動偵測 (見 resolve_domain)
+            max_results: 最大結果數
+            prune: 啟用 MaxScore 上界剪枝（結果相同，長查詢、大語料時較快）
+            backend: 'python' 或 'sparse'，預設依引擎設定
+            field_weights: 指定時（含空 dict）改以 BM25F 評分：CSV_CONFIG 的 field_weights
+                           為預設權重，此處的 {欄位: 權重} 覆寫之；只適用於設有
+                           field_weights 的域，否則拋出 ValueError。None 為一般 BM25
+            fuzzy: 先將拼錯的英數詞（'merchanttradno'）修正為詞彙中最接近的詞再評分，
+                   見 correct_tokens()
+
+        Returns:
+            結果列表 (按分數排序)
+
+        查詢像錯誤碼 / 狀態碼（'10000016'、'ecpay 10000016'）且精確命中時，
+        直接回傳該碼的列，不走 BM25。相同查詢的結果經 LRU 快取，見 cache_stats()。
+        """
+        if not query:
+            return []
+
+        if not domain:
+            domain = self.resolve_domain(query)
+
+        if field_weights is not None:
+            if domain not in self.csv_config:
+                return []  # 與未指定權重時相同：未知的域沒有結果
+            self.field_weights(domain, field_weights)
+
+        def compute():
+            exact = self._exact_search(query, domain, max_results, field_weights=field_weights)
+            if exact is not None:
+                return exact
+            return self.rank(query, domain, max_results, prune, backend, field_weights, fuzzy)
+
+        boost = tuple(sorted(field_weights.items())) if field_weights is not None else None
+        key = ('search', self._normalize_query(query), domain, max_results, backend or self.backend, boost,
+               bool(fuzzy))
+        return self._cached(key, self._data_version([domain]), compute, _copy_results)
+
+    def search_federated(
+        self,
+        query: str,
+        max_per_domain: int = 3,
+        top_k: int = 10,
+        domains: Optional[Iterable[str]] = None,
+        workers: Optional[int] = None,
+        backend: Optional[str] = None,
+        fuzzy: bool = False
+    ) -> Dict[str, Any]:
+        """
+        跨域搜索：查詢只分詞一次，對各域的快取索引評分後合併
+
+        Args:
+            query: 搜索查詢
+            max_per_domain: 每個域的最大結果數
+            top_k: 跨域合併後的最大結果數 (0 表示不合併)
+            domains: 要搜索的域，預設為全部
+            workers: 大於 1 時以執行緒池平行評分各域（sparse 後端的矩陣運算
+                     會釋放 GIL，平行效果較明顯）
+            backend: 'python' 或 'sparse'，預設依引擎設定
+            fuzzy: 各域先以自己的詞彙修正拼錯的英數詞，見 correct_tokens()
+
+        Returns:
+            {'domains': {domain: [...]}, 'top': [...]}
+            top 內的結果帶有 '_domain' 欄位，依分數排序，同分時依域的順序
+        """
+        if not query:
+            return {'domains': {}, 'top': []}
+
+        query_tokens = tokenize(query)
+        domains = [d for d in (domains or self.csv_config.keys()) if d in self.csv_config]
+        per_domain = max(max_per_domain, top_k)
+
+        if workers and workers > 1 and len(domains) > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                ranked = list(pool.map(
+                    lambda d: self._rank_domain(query_tokens, d, per_domain, backend=backend, fuzzy=fuzzy),
+                    domains))
+        else:
+            ranked = [self._rank_domain(query_tokens, d, per_domain, backend=backend, fuzzy=fuzzy)
+                      for d in domains]
+
+        by_domain = {}
+        merged = []
+        for domain, results in zip(domains, ranked):
+            if not results:
+                continue
+            by_domain[domain] = results[:max_per_domain]
+            merged.extend({**r, '_domain': domain} for r in results[:top_k])
+
+        merged.sort(key=lambda x: x['_score'], reverse=True)
+
+        return {'domains': by_domain, 'top': merged[:top_k]}
+
+    def search_all(
+        self,
+        query: str,
+        max_per_domain: int = 3,
+        fuzzy: bool = False
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """在所有域中搜索，回傳 domain -> 結果列表（沒有結果的域不列出）"""
+        return self._cached(
+            ('all', self._normalize_query(query), max_per_domain, bool(fuzzy)),
+            self._data_version(self.csv_config),
+            lambda: self.search_federated(query, max_per_domain, top_k=0, fuzzy=fuzzy)['domains'],
+            lambda results: {d: _copy_results(r) for d, r in results.items()})
+
+    # ── 批次查詢 ────────────────────────────────────────────
+
+    def _batch_job(self, item: BatchItem, domain: Optional[str], max_results: int) -> BatchJob:
+        """
+        將批次項目正規化為 (query, domain, max_results)
+
+        項目可為查詢字串，或 {'query', 'domain', 'max_results'} dict
+        （dict 內的值覆寫批次預設）。未指定域時自動偵測。
+        """
+        if isinstance(item, str):
+            query = item
+        else:
+            query = item.get('query') or ''
+            domain = item.get('domain') or domain
+            max_results = item.get('max_results') or max_results
+        return query, domain or self.resolve_domain(query), max_results
+
+    def _run_batch(self, jobs: List[BatchJob], backend: Optional[str] = None) -> List[List[Dict[str, Any]]]:
+        """
+        在單一行程內評分一組已正規化的查詢
+
+        每個域的索引在批次開始時取得一次，整批共用；錯誤碼查詢先走精確查詢，
+        sparse 後端把其餘同域的查詢合併成一次稀疏矩陣乘法。
+        """
+        indexes = {}
+        for _, domain, _ in jobs:
+            if domain not in indexes:
+                indexes[domain] = self.get_index(domain)
+
+        results: List[List[Dict[str, Any]]] = [[] for _ in jobs]
+        pending = []
+        for i, (query, domain, max_results) in enumerate(jobs):
+            exact = self._exact_search(query, domain, max_results, indexes[domain])
+            if exact is None:
+                pending.append(i)
+            else:
+                results[i] = exact
+        tokenized = {i: tokenize(jobs[i][0]) for i in pending}
+
+        if (backend or self.backend) == 'sparse':
+            by_domain: Dict[str, List[int]] = {}
+            for i in pending:
+                by_domain.setdefault(jobs[i][1], []).append(i)
+            for domain, ids in by_domain.items():
+                index = indexes[domain]
+                if index is None or not index.rows:
+                    continue
+                scored = self.get_sparse_index(domain).score_many([tokenized[i] for i in ids])
+                for i, scores in zip(ids, scored):
+                    results[i] = self._materialize(index, domain, scores, jobs[i][2])
+            return results
+
+        for i in pending:
+            _, domain, max_results = jobs[i]
+            index = indexes[domain]
+            if index is None or not index.rows:
+                continue
+            results[i] = self._materialize(index, domain, score_index(index, tokenized[i]), max_results)
+        return results
+
+    def search_batch(
+        self,
+        queries: Iterable[BatchItem],
+        domain: Optional[str] = None,
+        max_results: int = 5,
+        processes: Optional[int] = None,
+        backend: Optional[str] = None
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        批次搜索：整批共用同一份索引，避免每筆查詢都重新啟動直譯器、載入 CSV
+
+        Args:
+            queries: 查詢字串，或 {'query', 'domain', 'max_results'} dict
+            domain: 批次預設域，不指定則逐筆自動偵測
+            max_results: 批次預設的最大結果數
+            processes: 大於 1 且批次達 BATCH_PROCESS_THRESHOLD 筆時，分塊交給多個子行程
+            backend: 'python' 或 'sparse'，預設依引擎設定
+
+        Returns:
+            與 queries 順序相同的結果列表，每項等同 search() 的回傳值
+        """
+        jobs = [self._batch_job(item, domain, max_results) for item in queries]
+
+        if not processes or processes <= 1 or len(jobs) < BATCH_PROCESS_THRESHOLD:
+            return self._run_batch(jobs, backend)
+
+        # 先在父行程備妥索引：fork 的子行程直接繼承記憶體內的索引，
+        # spawn 的子行程則從剛寫好的索引檔載入，都不必重新分詞整份 CSV
+        for job_domain in {job[1] for job in jobs}:
+            self.get_index(job_domain)
+        return map_batch(partial(_run_batch_chunk, self, backend), jobs, processes)
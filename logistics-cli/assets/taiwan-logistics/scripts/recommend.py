@@ -9,6 +9,7 @@ Taiwan Logistics Skill - 物流服務商推薦系統
     python recommend.py "超商取貨 冷凍配送 高交易量"
     python recommend.py "7-11 B2C 穩定" --format json
     python recommend.py "生鮮電商 溫控" --format simple
+    python recommend.py --batch < merchants.jsonl > results.jsonl   # 批次，JSONL 進出
 
 作者: Taiwan E-Commerce Toolkit
 版本: 1.0.0
@@ -18,14 +19,18 @@ import sys
 import csv
 import json
 import math
+import os
 import re
+import threading
 import argparse
+from collections import Counter
+from functools import partial
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import Any, Iterable, Iterator, List, Dict, Optional, TextIO, Tuple
 from dataclasses import dataclass
 
+# core（連同搜索引擎）在建立推薦引擎時才匯入，--help 與參數錯誤不必付出載入成本
 sys.path.insert(0, str(Path(__file__).parent))
-from core import tokenize as core_tokenize
 
 
 @dataclass
@@ -42,6 +47,36 @@ class LogisticsProvider:
     market_share: str
     api_style: str
     logistics_types: List[str]
+    # providers.csv 的 api_available=false：無對外商家 API，只能經聚合商
+    api_available: bool = True
+
+
+@dataclass
+class ProviderDocument:
+    """預先分詞的服務商文件，載入資料時建立一次"""
+    provider: LogisticsProvider
+    terms: List[str]
+    term_freqs: Dict[str, int]
+
+    @property
+    def length(self) -> int:
+        return len(self.terms)
+
+
+@dataclass(frozen=True)
+class ProviderCorpus:
+    """
+    某一版 providers.csv 建出的推薦資料：服務商、預先分詞的文件、文件頻率與平均長度
+
+    重新載入時先建好新的一份再整組替換（見 LogisticsRecommender.refresh()），
+    一次推薦只取用同一份，不會看到新舊混雜或建到一半的狀態。
+    """
+    providers: List[LogisticsProvider]
+    documents: List[ProviderDocument]
+    doc_freq: Dict[str, int]
+    avg_doc_len: float
+    # 建立時 providers.csv 的 (mtime_ns, size)
+    source: Optional[Tuple[int, int]] = None
 
 
 @dataclass
@@ -54,6 +89,17 @@ class RecommendResult:
     features: List[str]
     warnings: List[str]
 
+    def as_dict(self) -> Dict[str, Any]:
+        """--format json 與 --batch 輸出的單筆結構"""
+        return {
+            'provider': self.provider,
+            'display_name': self.display_name,
+            'score': round(self.score, 2),
+            'match_reasons': self.match_reasons,
+            'features': self.features,
+            'warnings': self.warnings
+        }
+
 
 class BM25:
     """BM25 搜尋算法"""
@@ -62,17 +108,17 @@ class BM25:
         self.k1 = k1
         self.b = b
 
-    def score(self, query_terms: List[str], doc_terms: List[str],
+    def score(self, query_terms: List[str], term_freqs: Dict[str, int],
               avg_doc_len: float, doc_len: int, total_docs: int,
               doc_freq: Dict[str, int]) -> float:
-        """計算 BM25 分數"""
+        """計算 BM25 分數（term_freqs 為文件的 詞 -> 詞頻）"""
         score = 0.0
 
         for term in query_terms:
-            if term not in doc_terms:
+            tf = term_freqs.get(term, 0)
+            if tf == 0:
                 continue
 
-            tf = doc_terms.count(term)
             df = doc_freq.get(term, 0)
 
             if df == 0:
@@ -84,6 +130,26 @@ class BM25:
 
         return score
 
+    def term_impacts(self, term: str, documents: List['ProviderDocument'], avg_doc_len: float,
+                     doc_freq: Dict[str, int]) -> Dict[int, float]:
+        """
+        term 在各文件的 BM25 貢獻 {文件序號: 分數}，只列含該詞的文件
+
+        與 score() 逐詞累加的值相同：依查詢詞的順序加總即得同一個分數。
+        """
+        df = doc_freq.get(term, 0)
+        if df == 0:
+            return {}
+
+        idf = math.log((len(documents) - df + 0.5) / (df + 0.5) + 1)
+        impacts = {}
+        for i, document in enumerate(documents):
+            tf = document.term_freqs.get(term, 0)
+            if tf:
+                impacts[i] = idf * (tf * (self.k1 + 1)) / \
+                    (tf + self.k1 * (1 - self.b + self.b * (document.length / avg_doc_len)))
+        return impacts
+
 
 class LogisticsRecommender:
     """物流服務商推薦引擎"""
@@ -121,25 +187,58 @@ class LogisticsRecommender:
         if data_dir is None:
             data_dir = Path(__file__).parent.parent / 'data'
 
+        from core import tokenize
+
         self.data_dir = data_dir
-        self.providers: List[LogisticsProvider] = []
+        self._tokenize = tokenize
+        # 服務商語料：各文件的 token 與詞頻、文件頻率、平均長度，見 build_corpus()
+        self.corpus = ProviderCorpus([], [], {}, 0.0)
+        self._reload_lock = threading.Lock()
         self.bm25 = BM25(k1=1.5, b=0.75)
         self.load_data()
 
+    # 沿用的屬性名稱，皆取自目前的語料；同一次計算需要多項時請先取 self.corpus
+    @property
+    def providers(self) -> List[LogisticsProvider]:
+        return self.corpus.providers
+
+    @property
+    def documents(self) -> List[ProviderDocument]:
+        return self.corpus.documents
+
+    @property
+    def doc_freq(self) -> Dict[str, int]:
+        return self.corpus.doc_freq
+
+    @property
+    def avg_doc_len(self) -> float:
+        return self.corpus.avg_doc_len
+
+    def _source_signature(self) -> Optional[Tuple[int, int]]:
+        """providers.csv 的 (mtime_ns, size)；檔案不存在時為 None"""
+        try:
+            st = os.stat(self.data_dir / 'providers.csv')
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
     def load_data(self):
-        """載入服務商資料"""
+        """載入服務商資料並建立語料"""
         providers_file = self.data_dir / 'providers.csv'
 
-        if not providers_file.exists():
+        # 簽章在讀檔前取得：讀取期間檔案又被改寫時，下一次 refresh() 會再載入一次
+        source = self._source_signature()
+        if source is None:
             raise FileNotFoundError(f"找不到資料檔案: {providers_file}")
 
+        providers = []
         with open(providers_file, 'r', encoding='utf-8') as f:
             reader = csv.DictReader(f)
             for row in reader:
                 # providers.csv 的實際欄位為 name_zh/type/coverage/doc_access…
                 # 這裡做寬鬆對應，缺欄位時以合理預設值代替，避免 KeyError
                 features = [s for s in re.split(r'\s*[|,]\s*', row.get('features', '')) if s]
-                self.providers.append(
+                providers.append(
                     LogisticsProvider(
                         provider=row['provider'],
                         display_name=row.get('display_name') or row.get('name_zh') or row['provider'],
@@ -152,12 +251,72 @@ class LogisticsRecommender:
                         market_share=row.get('market_share') or row.get('coverage', ''),
                         api_style=row.get('api_style') or row.get('type', ''),
                         logistics_types=features,
+                        api_available=row.get('api_available', '').strip().lower() != 'false',
                     )
                 )
+        self.build_corpus(providers, source)
+
+    def build_corpus(self, providers: Optional[List[LogisticsProvider]] = None,
+                     source: Optional[Tuple[int, int]] = None) -> ProviderCorpus:
+        """
+        將每家服務商的文件分詞一次，算好詞頻、文件頻率與平均長度，建好後整組替換
+
+        原本每次評分都重新分詞所有服務商來算平均長度與每個查詢詞的文件頻率，
+        一次推薦是 O(服務商² × 查詢詞)；預先算好後 recommend() 只需走訪一次。
+
+        Args:
+            providers: 服務商清單，預設為目前語料的服務商
+            source: 對應的 providers.csv 簽章，預設沿用目前語料的
+        """
+        if providers is None:
+            providers = self.corpus.providers
+        if source is None:
+            source = self.corpus.source
+
+        documents = []
+        doc_freq: Counter = Counter()
+        for provider in providers:
+            terms = self.tokenize(self.build_document(provider))
+            term_freqs = Counter(terms)
+            doc_freq.update(term_freqs.keys())
+            documents.append(ProviderDocument(provider, terms, term_freqs))
+        total = sum(document.length for document in documents)
+        avg_doc_len = total / len(documents) if documents else 0.0
+
+        self.corpus = ProviderCorpus(list(providers), documents, dict(doc_freq), avg_doc_len, source)
+        return self.corpus
+
+    def refresh(self) -> bool:
+        """
+        providers.csv 變動時重新載入並重建語料，回傳是否重建
+
+        只比對 (mtime_ns, size)，沒有變動時幾乎不花時間；recommend() 每次都會先檢查。
+        新語料建好才整組替換，並行的 recommend() 拿到的一定是某一版完整的語料；
+        檔案暫時不存在（例如正被替換，或在檢查之後、開檔之前被刪除重建）時沿用
+        目前的語料，下一次檢查再載入。
+        """
+        source = self._source_signature()
+        if source is None or source == self.corpus.source:
+            return False
+        with self._reload_lock:
+            source = self._source_signature()
+            if source is None or source == self.corpus.source:
+                return False
+            try:
+                self.load_data()
+            except OSError:
+                return False
+        return True
+
+    def watch(self, interval: float = 1.0):
+        """在背景每 interval 秒執行一次 refresh()，回傳已啟動的 core.Watcher（以 stop() 停止）"""
+        from core import Watcher
+
+        return Watcher(self.refresh, interval).start()
 
     def tokenize(self, text: str) -> List[str]:
-        """分詞（沿用 core.py 的中英混合分詞，避免中文查詢整段當成單一 token）"""
-        return core_tokenize(text)
+        """分詞（沿用 core.py 的中英混合分詞，避免中文查詢整段當成單一 token；結果經 LRU 記憶）"""
+        return self._tokenize(text)
 
     def build_document(self, provider: LogisticsProvider) -> str:
         """建立服務商文件 (用於搜尋)"""
@@ -172,29 +331,27 @@ class LogisticsRecommender:
         ]
         return ' '.join(parts)
 
-    def calculate_weighted_score(self, query: str, provider: LogisticsProvider) -> Tuple[float, List[str]]:
-        """計算加權分數"""
-        query_terms = self.tokenize(query)
-        doc_text = self.build_document(provider)
-        doc_terms = self.tokenize(doc_text)
+    def calculate_weighted_score(self, query_terms: List[str], document: ProviderDocument,
+                                 corpus: Optional[ProviderCorpus] = None,
+                                 base_score: Optional[float] = None) -> Tuple[float, List[str]]:
+        """
+        計算加權分數（query_terms 為已分詞的查詢，corpus 為 document 所屬的語料，預設為目前的）
 
+        base_score 為已算好的 BM25 基礎分數（批次推薦時由 BM25.term_impacts 整批計算），預設現算。
+        """
+        if corpus is None:
+            corpus = self.corpus
         # 計算 BM25 基礎分數
-        total_docs = len(self.providers)
-        avg_doc_len = sum(len(self.tokenize(self.build_document(p))) for p in self.providers) / total_docs
-        doc_len = len(doc_terms)
-
-        doc_freq = {}
-        for term in set(query_terms):
-            doc_freq[term] = sum(1 for p in self.providers if term in self.tokenize(self.build_document(p)))
-
-        base_score = self.bm25.score(query_terms, doc_terms, avg_doc_len, doc_len, total_docs, doc_freq)
+        if base_score is None:
+            base_score = self.bm25.score(query_terms, document.term_freqs, corpus.avg_doc_len,
+                                         document.length, len(corpus.documents), corpus.doc_freq)
 
         # 應用關鍵字權重
         weighted_score = base_score
         match_reasons = []
 
         for term in query_terms:
-            if term in doc_terms:
+            if term in document.term_freqs:
                 weight = self.KEYWORD_WEIGHTS.get(term, 1.0)
                 if weight > 1.0:
                     weighted_score += base_score * (weight - 1.0) * 0.1
@@ -225,10 +382,18 @@ class LogisticsRecommender:
         Returns:
             推薦結果清單
         """
-        results = []
+        self.refresh()
+        # 整次推薦只用同一份語料，途中被替換也不受影響
+        return self._rank(query, self.tokenize(query), self.corpus, top_k)
 
-        for provider in self.providers:
-            score, match_reasons = self.calculate_weighted_score(query, provider)
+    def _rank(self, query: str, query_terms: List[str], corpus: ProviderCorpus, top_k: int,
+              base_scores: Optional[List[float]] = None) -> List[RecommendResult]:
+        """為語料中每家服務商評分並取前 K 名；base_scores 為各文件已算好的 BM25 基礎分數"""
+        results = []
+        for i, document in enumerate(corpus.documents):
+            provider = document.provider
+            base_score = None if base_scores is None else base_scores[i]
+            score, match_reasons = self.calculate_weighted_score(query_terms, document, corpus, base_score)
             warnings = self.check_anti_patterns(query, provider.provider.lower())
 
             results.append(
@@ -247,6 +412,57 @@ class LogisticsRecommender:
 
         return results[:top_k]
 
+    def recommend_batch(self, queries: Iterable[str], top_k: int = 3,
+                        processes: Optional[int] = None) -> List[List[RecommendResult]]:
+        """
+        批次推薦：整批共用同一份服務商語料，整批查詢詞的聯集對各服務商的 BM25
+        貢獻只計算一次（各查詢再依自己的詞加總）；相同的需求描述只計算一次
+
+        Args:
+            queries: 需求描述
+            top_k: 每筆回傳前 K 個推薦結果
+            processes: 大於 1 且批次達 BATCH_PROCESS_THRESHOLD 筆時，分塊交給多個子行程
+                （子行程各自載入 providers.csv 一次）
+
+        Returns:
+            與 queries 順序相同的結果列表，每項等同 recommend() 的回傳值
+        """
+        from core import map_batch
+
+        queries = list(queries)
+        if processes and processes > 1:
+            return map_batch(partial(_recommend_chunk, self.data_dir, top_k), queries, processes)
+        return self._recommend_many(queries, top_k)
+
+    def _recommend_many(self, queries: List[str], top_k: int) -> List[List[RecommendResult]]:
+        import copy
+
+        self.refresh()
+        corpus = self.corpus
+        unique = list(dict.fromkeys(queries))
+        terms = {query: self.tokenize(query) for query in unique}
+        impacts = {term: self.bm25.term_impacts(term, corpus.documents, corpus.avg_doc_len, corpus.doc_freq)
+                   for term in set().union(*terms.values())}
+
+        computed: Dict[str, List[RecommendResult]] = {}
+        for query in unique:
+            # 依查詢詞的順序累加，與 BM25.score() 的加總順序相同，分數逐位元一致
+            base_scores = [0.0] * len(corpus.documents)
+            for term in terms[query]:
+                for i, impact in impacts[term].items():
+                    base_scores[i] += impact
+            computed[query] = self._rank(query, terms[query], corpus, top_k, base_scores)
+
+        seen = set()
+        results = []
+        for query in queries:
+            if query in seen:
+                results.append(copy.deepcopy(computed[query]))
+            else:
+                seen.add(query)
+                results.append(computed[query])
+        return results
+
     def format_output(self, results: List[RecommendResult], format_type: str = 'detailed') -> str:
         """
         格式化輸出
@@ -259,21 +475,7 @@ class LogisticsRecommender:
             格式化的推薦結果
         """
         if format_type == 'json':
-            return json.dumps(
-                [
-                    {
-                        'provider': r.provider,
-                        'display_name': r.display_name,
-                        'score': round(r.score, 2),
-                        'match_reasons': r.match_reasons,
-                        'features': r.features,
-                        'warnings': r.warnings
-                    }
-                    for r in results
-                ],
-                ensure_ascii=False,
-                indent=2
-            )
+            return json.dumps([r.as_dict() for r in results], ensure_ascii=False, indent=2)
 
         elif format_type == 'simple':
             lines = []
@@ -315,6 +517,73 @@ class LogisticsRecommender:
             return '\n'.join(lines)
 
 
+def _recommend_chunk(data_dir: Path, top_k: int, queries: List[str]) -> List[List[RecommendResult]]:
+    """recommend_batch 的子行程入口（須為模組層級函數才能被 pickle）"""
+    return LogisticsRecommender(data_dir)._recommend_many(queries, top_k)
+
+
+# ============================================================================
+# 批次模式 (JSONL)
+# ============================================================================
+
+def parse_batch_line(line: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """解析一行 JSONL：JSON 字串或含 query（必要）、id 的物件，回傳 (item, error)"""
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return None, f'invalid JSON: {e}'
+    if isinstance(item, str):
+        item = {'query': item}
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+        return None, "expected a string or an object with a string 'query'"
+    return item, ''
+
+
+def _chunked(lines: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(recommender: LogisticsRecommender, stream: TextIO, out: TextIO, top_k: int = 3,
+              processes: Optional[int] = None, chunk_size: int = 1000) -> int:
+    """
+    JSONL 批次模式：stdin 每行一筆需求，stdout 每行一筆 {"query", "recommendations"}
+
+    每讀滿一段就推薦並輸出一次，大檔案也能邊讀邊寫；無法解析的行輸出
+    {"line", "error"}，不中斷整批。回傳錯誤行數。
+    """
+    from core import BATCH_PROCESS_THRESHOLD
+
+    if processes and processes > 1:
+        # 每段至少要達多行程門檻，子行程才派得上用場
+        chunk_size = max(chunk_size, BATCH_PROCESS_THRESHOLD * processes)
+    errors = 0
+    lines = ((n, line) for n, line in enumerate(stream, 1) if line.strip())
+    for chunk in _chunked(lines, chunk_size):
+        parsed = [(n, *parse_batch_line(line)) for n, line in chunk]
+        queries = [item['query'] for _, item, _ in parsed if item is not None]
+        results = iter(recommender.recommend_batch(queries, top_k, processes))
+
+        for n, item, error in parsed:
+            if item is None:
+                errors += 1
+                record = {'line': n, 'error': error}
+            else:
+                record = {'id': item['id']} if 'id' in item else {}
+                record['query'] = item['query']
+                record['recommendations'] = [r.as_dict() for r in next(results)]
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+    return errors
+
+
 # ============================================================================
 # CLI 介面
 # ============================================================================
@@ -329,6 +598,8 @@ def main():
   python recommend.py "7-11 B2C 大量訂單" --format json
   python recommend.py "生鮮電商 溫控 穩定" --format simple
   python recommend.py "新創公司 API 設計" --top 2
+  python recommend.py "超商取貨 電商" --profile    # 各階段耗時輸出到 stderr
+  python recommend.py --batch < merchants.jsonl   # 每行一筆需求 (字串或 {"id", "query"})，JSONL 輸出
 
 關鍵字建議:
   ECPay:    穩定、市佔、高交易量、電商、文檔、SDK、超商、宅配
@@ -337,17 +608,46 @@ def main():
         """
     )
 
-    parser.add_argument('query', type=str, help='需求描述 (關鍵字以空格分隔)')
+    parser.add_argument('query', type=str, nargs='?', help='需求描述 (關鍵字以空格分隔)')
     parser.add_argument('--format', type=str, choices=['detailed', 'simple', 'json'],
                         default='detailed', help='輸出格式 (預設: detailed)')
     parser.add_argument('--top', type=int, default=3, help='回傳前 K 個推薦 (預設: 3)')
+    parser.add_argument('--profile', nargs='?', const='table', metavar='MODE',
+                        help='各階段耗時輸出到 stderr：table (預設)、json、cprofile[:路徑]；'
+                             '亦可設定 $TAIWAN_SEARCH_PROFILE')
+    parser.add_argument('--batch', action='store_true',
+                        help='從 stdin 讀取 JSONL 需求，逐行輸出 JSONL 推薦結果')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='--batch 輸入量大時使用的子行程數')
 
     args = parser.parse_args()
+    if args.query is None and not args.batch:
+        parser.error('需要需求描述，或使用 --batch 從 stdin 讀取')
+
+    profile = args.profile or os.environ.get('TAIWAN_SEARCH_PROFILE')
+    if profile:
+        from core import PROFILER, start_profiling
+
+        try:
+            start_profiling(profile, __file__)
+        except ValueError as e:
+            parser.error(str(e))
+        PROFILER.instrument(LogisticsRecommender, ['tokenize'], 'tokenize')
+        PROFILER.instrument(LogisticsRecommender, ['load_data'], 'load_csv')
+        PROFILER.instrument(LogisticsRecommender, ['build_corpus'], 'build_index')
+        PROFILER.instrument(LogisticsRecommender, ['calculate_weighted_score'], 'weighted_score')
+        PROFILER.instrument(LogisticsRecommender, ['format_output'], 'format')
+        PROFILER.instrument(BM25, ['score'], 'bm25_score')
 
     try:
         # 初始化推薦引擎
         recommender = LogisticsRecommender()
 
+        # JSONL 批次模式
+        if args.batch:
+            errors = run_batch(recommender, sys.stdin, sys.stdout, args.top, args.processes)
+            return 1 if errors else 0
+
         # 執行推薦
         results = recommender.recommend(args.query, top_k=args.top)
 
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+Taiwan 電商 Skill 搜索常駐服務
+
+每次工具呼叫都要重新啟動直譯器、載入 core 與索引。常駐服務把 invoice /
+payment / logistics 三個 skill 的索引留在記憶體，以 localhost HTTP + JSON
+回應查詢。search.py 加上 --daemon（或設定 TAIWAN_SEARCH_DAEMON=1）時
+先詢問服務，服務未啟動時改為行程內搜索；未明確開啟時不連線，以免把查詢
+交給佔用同一埠的其他程式。
+
+三個 skill 各附一份內容相同的 server.py（各自獨立安裝、發布），
+服務會載入同一個 skills 目錄下所有找得到的 taiwan-* skill。
+
+協定:
+    POST /search  {"skill", "query", "domain"?, "max_results"?, "all"?, "field_weights"?, "fuzzy"?,
+                   "data_dir"?}
+    POST /batch   {"skill", "queries", "domain"?, "max_results"?, "data_dir"?}
+    POST /suggest {"skill", "prefix", "domain"?, "limit"?, "data_dir"?}
+    GET  /health
+
+    回應皆為 JSON，並帶 elapsed_ms（服務端處理時間）；格式錯誤的請求回 400。CSV 變動時
+    core.get_index() 會自動重建該域索引，回應的 reloaded 列出被重建的域。
+    客戶端見 search.py 的 query_daemon()。
+
+用法:
+    python search.py serve                  # 啟動於 127.0.0.1:47310
+    python server.py --port 9000 --skills invoice,payment
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional
+
+SKILLS = ('invoice', 'payment', 'logistics')
+SKILLS_ROOT = Path(__file__).resolve().parent.parent.parent
+
+DEFAULT_HOST = os.environ.get('TAIWAN_SEARCH_HOST', '127.0.0.1')
+DEFAULT_PORT = int(os.environ.get('TAIWAN_SEARCH_PORT', '47310'))
+
+
+def _same_path(a: Any, b: Any) -> bool:
+    try:
+        return os.path.realpath(str(a)) == os.path.realpath(str(b))
+    except ValueError:  # 路徑含 NUL 字元
+        return False
+
+
+def _is_count(value: Any) -> bool:
+    """JSON 的正整數（排除 true / false）"""
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 1
+
+
+class SkillEngine:
+    """單一 skill 的 core 模組與請求統計"""
+
+    def __init__(self, skill: str, core_path: Path):
+        # core.py 以 `from engine import ...` 載入共用引擎；三個 skill 的 engine.py
+        # 內容相同，同一行程內只載入一次，各 skill 的索引由各自的 SearchEngine 持有
+        if str(core_path.parent) not in sys.path:
+            sys.path.insert(0, str(core_path.parent))
+        spec = importlib.util.spec_from_file_location(f'taiwan_{skill}_core', core_path)
+        self.core = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.core)
+        self.skill = skill
+        # 索引重建會寫檔，同一 skill 的請求逐一處理；BM25 評分本來就受 GIL 限制
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def warm(self) -> int:
+        """預先載入所有域的索引，回傳總筆數"""
+        return sum(len(self.core.get_index(domain).rows) for domain in self.core.CSV_CONFIG)
+
+    def _check_domain(self, domain: Any):
+        if domain is not None and not (isinstance(domain, str) and domain in self.core.CSV_CONFIG):
+            raise ValueError(f'unknown domain: {domain}')
+
+    def _check_batch_item(self, item: Any):
+        """批次項目須為查詢字串，或 {'query', 'domain'?, 'max_results'?} object"""
+        if isinstance(item, str):
+            return
+        if not isinstance(item, dict) or not isinstance(item.get('query', ''), str):
+            raise ValueError("'queries' items must be strings or objects with a string 'query'")
+        self._check_domain(item.get('domain'))
+        if item.get('max_results') is not None and not _is_count(item['max_results']):
+            raise ValueError('max_results must be a positive integer')
+
+    def handle(self, op: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """執行查詢，回傳含 results、reloaded 的 dict；參數錯誤時拋出 ValueError"""
+        core = self.core
+        domain = payload.get('domain')
+        self._check_domain(domain)
+        max_results = payload.get('max_results', 5)
+        if not _is_count(max_results):
+            raise ValueError('max_results must be a positive integer')
+        field_weights = payload.get('field_weights')
+        if field_weights is not None and not (
+                isinstance(field_weights, dict)
+                and all(isinstance(w, (int, float)) for w in field_weights.values())):
+            raise ValueError("'field_weights' must be an object of numbers")
+        fuzzy = payload.get('fuzzy', False)
+        if not isinstance(fuzzy, bool):
+            raise ValueError("'fuzzy' must be a boolean")
+
+        with self.lock:
+            before = dict(core.ENGINE.indexes)
+            if op == 'suggest':
+                prefix = payload.get('prefix')
+                if not isinstance(prefix, str):
+                    raise ValueError("'prefix' must be a string")
+                limit = payload.get('limit', 10)
+                if not _is_count(limit):
+                    raise ValueError('limit must be a positive integer')
+                results = core.suggest(prefix, domain, limit)
+            elif op == 'batch':
+                queries = payload.get('queries')
+                if not isinstance(queries, list):
+                    raise ValueError("'queries' must be a list")
+                for item in queries:
+                    self._check_batch_item(item)
+                results = core.search_batch(queries, domain, max_results)
+            else:
+                query = payload.get('query')
+                if not isinstance(query, str):
+                    raise ValueError("'query' must be a string")
+                if payload.get('all'):
+                    results = core.search_all(query, max_results, fuzzy=fuzzy)
+                else:
+                    results = core.search(query, domain, max_results, field_weights=field_weights,
+                                          fuzzy=fuzzy)
+            reloaded = [d for d, index in core.ENGINE.indexes.items() if before.get(d) is not index]
+
+        return {'results': results, 'reloaded': reloaded}
+
+    def record(self, elapsed_ms: float):
+        with self.lock:
+            self.requests += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            'data_dir': str(self.core.ENGINE.data_dir),
+            'domains': list(self.core.CSV_CONFIG),
+            'requests': self.requests,
+            'avg_ms': round(self.total_ms / self.requests, 3) if self.requests else 0.0,
+            'max_ms': round(self.max_ms, 3),
+        }
+
+
+def discover_skills(skills: Optional[Iterable[str]] = None) -> Dict[str, Path]:
+    """尋找同一個 skills 目錄下已安裝的 taiwan-* skill，回傳 skill -> core.py"""
+    found = {}
+    for skill in skills or SKILLS:
+        core_path = SKILLS_ROOT / f'taiwan-{skill}' / 'scripts' / 'core.py'
+        if core_path.exists():
+            found[skill] = core_path
+    return found
+
+
+class SearchHandler(BaseHTTPRequestHandler):
+    server_version = 'TaiwanSkillSearch/1.0'
+
+    def log_message(self, format, *args):
+        # 改由 _log 記錄含延遲的單行日誌
+        pass
+
+    def _log(self, message: str):
+        if not self.server.quiet:
+            print(f'[{time.strftime("%H:%M:%S")}] {message}', file=sys.stderr, flush=True)
+
+    def _reply(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        if 'elapsed_ms' in body:
+            self.send_header('X-Elapsed-Ms', str(body['elapsed_ms']))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._reply(404, {'error': f'unknown path: {self.path}'})
+            return
+        self._reply(200, {
+            'status': 'ok',
+            'pid': os.getpid(),
+            'uptime_s': round(time.monotonic() - self.server.started, 1),
+            'skills': {skill: engine.info() for skill, engine in self.server.engines.items()},
+        })
+
+    def do_POST(self):
+        start = time.perf_counter()
+        op = self.path.strip('/')
+        if op not in ('search', 'batch', 'suggest'):
+            self._reply(404, {'error': f'unknown path: {self.path}'})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(payload, dict):
+                raise ValueError('request body must be a JSON object')
+        except ValueError as e:
+            self._reply(400, {'error': f'invalid request: {e}'})
+            return
+
+        skill = payload.get('skill')
+        engine = self.server.engines.get(skill) if isinstance(skill, str) else None
+        if engine is None:
+            self._reply(404, {'error': f'skill not loaded: {skill}'})
+            return
+        # 客戶端與服務載入的是不同安裝（例如不同專案）時，資料可能不同版本
+        if 'data_dir' in payload and not _same_path(payload['data_dir'], engine.core.ENGINE.data_dir):
+            self._reply(409, {'error': 'data_dir mismatch', 'data_dir': str(engine.core.ENGINE.data_dir)})
+            return
+
+        try:
+            body = engine.handle(op, payload)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            # handle() 未逐一檢查到的格式錯誤同樣回 400，不讓連線無回應地斷開
+            self._reply(400, {'error': str(e)})
+            return
+        except Exception as e:  # noqa: BLE001 -- 服務不因單一請求中止，回報錯誤後繼續
+            self._reply(500, {'error': f'internal error: {e}'})
+            return
+
+        elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+        engine.record(elapsed_ms)
+        body.update(skill=skill, elapsed_ms=elapsed_ms)
+        self._reply(200, body)
+
+        reloaded = f' reloaded={",".join(body["reloaded"])}' if body['reloaded'] else ''
+        self._log(f'{op} {skill} {elapsed_ms:.2f}ms{reloaded}')
+
+
+def make_server(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                skills: Optional[Iterable[str]] = None, quiet: bool = False) -> ThreadingHTTPServer:
+    """建立服務並預熱索引（尚未開始處理請求；port=0 表示隨機埠）"""
+    engines = {}
+    for skill, core_path in discover_skills(skills).items():
+        engine = SkillEngine(skill, core_path)
+        engine.warm()
+        engines[skill] = engine
+    if not engines:
+        raise RuntimeError(f'在 {SKILLS_ROOT} 下找不到任何 taiwan-* skill')
+
+    server = ThreadingHTTPServer((host, port), SearchHandler)
+    server.daemon_threads = True
+    server.engines = engines
+    server.quiet = quiet
+    server.started = time.monotonic()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Taiwan 電商 Skill 搜索常駐服務')
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'監聽位址 (預設: {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f'監聽埠 (預設: {DEFAULT_PORT})')
+    parser.add_argument('--skills', default=','.join(SKILLS),
+                        help='要載入的 skill，以逗號分隔 (預設: 全部)')
+    parser.add_argument('--quiet', '-q', action='store_true', help='不輸出每個請求的日誌')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    try:
+        server = make_server(args.host, args.port, args.skills.split(','), args.quiet)
+    except (OSError, RuntimeError) as e:
+        print(f'無法啟動服務: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    host, port = server.server_address[:2]
+    print(f'搜索服務已啟動: http://{host}:{port} ({(time.perf_counter() - start) * 1000:.0f}ms)',
+          file=sys.stderr)
+    for skill, engine in server.engines.items():
+        print(f'  {skill:<10} {engine.core.ENGINE.data_dir}', file=sys.stderr)
+    print('查詢時加 --daemon 或設定 TAIWAN_SEARCH_DAEMON=1 才會改走服務', file=sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
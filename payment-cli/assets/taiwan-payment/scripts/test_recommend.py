@@ -9,18 +9,32 @@
 現行做法見 core.rule_match_score()：同時比對 scenario 與 use_cases，
 以查詢被規則解釋的比例加權，並要求最低命中詞數。
 
+關鍵字規則（RECOMMENDATION_RULES / ANTI_PATTERNS）編成單一自動機
+（core.KeywordRules），命中的規則與反模式警告須與逐條 `keyword in query` 相同。
+
 使用方法:
     python test_recommend.py
 """
 
+import io
+import json
+import os
+import shutil
 import sys
+import tempfile
 from pathlib import Path
 
 SCRIPT_DIR = Path(__file__).parent
 sys.path.insert(0, str(SCRIPT_DIR))
 
-from core import rule_match_score, MIN_RULE_MATCH  # noqa: E402
-from recommend import analyze_requirements  # noqa: E402
+from core import (  # noqa: E402
+    BATCH_PROCESS_THRESHOLD, RuleTable, read_csv, rule_match_score, MIN_RULE_MATCH,
+)
+import recommend  # noqa: E402
+from recommend import (  # noqa: E402
+    ANTI_PATTERNS, RECOMMENDATION_RULES, analyze_requirements, get_anti_pattern_warnings, keyword_rules,
+    recommend_batch, recommendation_record, run_batch,
+)
 
 
 # (查詢, 期望推薦的服務商)
@@ -82,6 +96,175 @@ def test_verbose_rule_not_penalised():
     return [] if ok else [('verbose rule', short_rule, long_rule)]
 
 
+def test_rule_table():
+    """編譯後的規則表（倒排索引只為候選規則計分）與逐條 rule_match_score 相同"""
+    failures = []
+    path = SCRIPT_DIR.parent / 'data' / 'reasoning.csv'
+    rules = read_csv(path)
+    table = RuleTable(path)
+
+    queries = [q for q, _ in EXPECTED] + [r.get('scenario', '') for r in rules] + ['', 'xyz']
+    mismatched = []
+    for query in queries:
+        expected = []
+        for rule in rules:
+            strength = rule_match_score(query, rule.get('scenario', ''), rule.get('use_cases', ''))
+            if strength >= MIN_RULE_MATCH:
+                expected.append((rule, strength))
+        if table.match(query) != expected:
+            mismatched.append(query)
+    ok = not mismatched
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐條計分相同")
+    if not ok:
+        failures.append(('rule table', 'same as rule_match_score', mismatched[:3]))
+
+    # 規則檔變動後自動重新編譯
+    tmp = tempfile.mkdtemp()
+    try:
+        copy = shutil.copy(path, tmp)
+        table = RuleTable(copy)
+        before = len(table.match('規則表失效測試 專用情境'))
+        with open(copy, 'a', encoding='utf-8') as f:
+            f.write('規則表失效測試 專用情境,ecpay,HIGH,測試用\n')
+        after = len(table.match('規則表失效測試 專用情境'))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    ok = before == 0 and after == 1
+    print(f"   [{'PASS' if ok else 'FAIL'}] 規則檔變動後重新載入 (before={before} after={after})")
+    if not ok:
+        failures.append(('rule table reload', '0 -> 1', (before, after)))
+
+    return failures
+
+
+def test_keyword_rules():
+    """自動機命中的關鍵字規則與反模式警告與逐條子字串比對相同，且依定義的順序"""
+    queries = [q for q, _ in EXPECTED] + ['', 'xyz', 'Apple Pay google pay ICASH', 'AES-GCM gcm 銀聯 UnionPay',
+                                          'php node python app', '定期 訂閱 分期 BNPL',
+                                          '無技術資源 極簡需求', '簡單 api 單一支付 大型專案 完整文檔']
+
+    def expected(query):
+        q = query.lower()
+        rules = [(k, tuple(v)) for k, v in RECOMMENDATION_RULES.items() if k in q]
+        warnings = {p: [f'{k}: {w}' for k, w in patterns if k.lower() in q] for p, patterns in ANTI_PATTERNS.items()}
+        return rules, warnings
+
+    mismatched = [q for q in queries
+                  if (keyword_rules().match(q),
+                      {p: get_anti_pattern_warnings(q, p) for p in ANTI_PATTERNS}) != expected(q)]
+    ok = not mismatched
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐條比對相同")
+    return [] if ok else [('keyword rules', 'same as substring scan', mismatched[:3])]
+
+
+def test_batch():
+    """批次結果與逐筆 analyze_requirements() 相同，輸出格式化不再逐名次重讀 providers.csv"""
+    failures = []
+    queries = [q for q, _ in EXPECTED] + ['', 'xyz', EXPECTED[0][0]]
+    expected = [analyze_requirements(q) for q in queries]
+    ok = recommend_batch(queries) == expected
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐筆分析相同")
+    if not ok:
+        failures.append(('batch', 'same as analyze_requirements()', len(queries)))
+
+    loads = []
+    original = recommend.load_providers_csv
+
+    def counting_load():
+        loads.append(1)
+        return original()
+
+    recommend.load_providers_csv = counting_load
+    try:
+        for fmt in ('ascii', 'json', 'simple'):
+            getattr(recommend, f'format_recommendation_{fmt}')(expected[0], queries[0])
+    finally:
+        recommend.load_providers_csv = original
+    ok = len(loads) == 3
+    print(f"   [{'PASS' if ok else 'FAIL'}] 三種輸出格式各只讀取 providers.csv {len(loads) // 3} 次")
+    if not ok:
+        failures.append(('format', 'one providers load per call', len(loads)))
+
+    stream = io.StringIO(f'{json.dumps(queries[0], ensure_ascii=False)}\n'
+                         f'{{"id": 7, "query": "{queries[1]}"}}\n[]\n')
+    out = io.StringIO()
+    errors = run_batch(stream, out)
+    names = recommend.provider_names()
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    ok = (errors == 1 and len(records) == 3
+          and records[0] == recommendation_record(expected[0], queries[0], names)
+          and records[1] == {'id': 7, **recommendation_record(expected[1], queries[1], names)}
+          and records[2].get('line') == 3)
+    print(f"   [{'PASS' if ok else 'FAIL'}] JSONL 批次：{len(records)} 行輸出，{errors} 行錯誤")
+    if not ok:
+        failures.append(('run_batch', 'jsonl records', records))
+
+    many = queries * (BATCH_PROCESS_THRESHOLD // len(queries) + 1)
+    ok = recommend_batch(many, processes=2) == recommend_batch(many)
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(many)} 筆以 2 個子行程推薦與單一行程相同")
+    if not ok:
+        failures.append(('batch', 'processes=2', len(many)))
+    return failures
+
+
+def test_refresh():
+    """providers.csv 只在變動時重新讀取，refresh() 只重建有變動的檔案"""
+    import recommend as module
+
+    tmp = tempfile.mkdtemp()
+    original = module.DATA_DIR
+    try:
+        for name in ('providers.csv', 'reasoning.csv'):
+            shutil.copy(os.path.join(original, name), tmp)
+        module.DATA_DIR = Path(tmp)
+        first = module.refresh()
+        providers = module.load_providers_csv()
+        unchanged = module.load_providers_csv() is providers and module.refresh() == []
+        with open(os.path.join(tmp, 'providers.csv'), 'a', encoding='utf-8') as f:
+            f.write('newpay,測試服務商' + ',' * (len(providers[0]) - 2) + '\n')
+        reloaded = module.refresh()
+        after = module.load_providers_csv()
+        scores = module.analyze_requirements('xyz')
+    finally:
+        module.DATA_DIR = original
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = (sorted(first) == ['providers.csv', 'reasoning.csv'] and unchanged
+          and reloaded == ['providers.csv'] and len(after) == len(providers) + 1
+          and 'newpay' in scores)
+    print(f"   [{'PASS' if ok else 'FAIL'}] 未變動時沿用同一份資料，改動 providers.csv 只重建該檔 ({reloaded})")
+    return [] if ok else [('refresh', 'providers.csv only', (first, unchanged, reloaded, len(after)))]
+
+
+def test_missing_source():
+    """來源檔暫時不存在（例如正被刪除重建）時沿用上一版，檔案回來後照常運作"""
+    import recommend as module
+
+    query = EXPECTED[0][0]
+    names = ('providers.csv', 'reasoning.csv')
+    tmp = tempfile.mkdtemp()
+    original = module.DATA_DIR
+    try:
+        for name in names:
+            shutil.copy(os.path.join(original, name), tmp)
+        module.DATA_DIR = Path(tmp)
+        providers = module.load_providers_csv()
+        expected = module.analyze_requirements(query)
+        for name in names:
+            os.replace(os.path.join(tmp, name), os.path.join(tmp, name + '.bak'))
+        missing = (len(module.load_providers_csv()), module.refresh(), module.analyze_requirements(query))
+        for name in names:
+            os.replace(os.path.join(tmp, name + '.bak'), os.path.join(tmp, name))
+        back = (module.refresh(), module.analyze_requirements(query))
+    finally:
+        module.DATA_DIR = original
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = missing == (len(providers), [], expected) and back == ([], expected)
+    print(f"   [{'PASS' if ok else 'FAIL'}] 來源檔暫時不存在時沿用上一版 ({missing[0]} 家服務商)")
+    return [] if ok else [('missing source', 'previous version kept', (missing[:2], back[0]))]
+
+
 def main():
     print('=' * 60)
     print('推薦系統回歸測試 (taiwan-payment)')
@@ -99,6 +282,19 @@ def main():
     print('\n3. 規則長度中立性')
     failures += test_verbose_rule_not_penalised()
 
+    print('\n4. 編譯後的規則表')
+    failures += test_rule_table()
+
+    print('\n5. 關鍵字規則自動機')
+    failures += test_keyword_rules()
+
+    print('\n6. 批次推薦')
+    failures += test_batch()
+
+    print('\n7. 來源檔變動時重新載入')
+    failures += test_refresh()
+    failures += test_missing_source()
+
     print('\n' + '=' * 60)
     if failures:
         print(f'[FAIL] {len(failures)} 項未通過')
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+三個 skill 的搜索與推薦效能基準。
+
+test_search.py、test_recommend.py 只驗證結果正確，效能退步（例如某次改動讓
+索引每次查詢都重建）不會有任何測試失敗。這支腳本量測：
+
+1. 冷啟動 —— 新行程從 import core 到第一筆結果的時間，分為沒有編譯索引檔
+   （cold_build，從 CSV 建索引）與索引檔已存在（cold_load）兩種。
+2. 暖查詢 —— 同一行程內的 search()、search_all()、detect_domain()，以及
+   recommend.py 的 analyze_requirements()（invoice / payment）與
+   LogisticsRecommender.recommend()（logistics）。查詢結果快取在量測時停用，
+   量到的是引擎本身而非快取命中。
+3. 峰值 RSS —— 每個量測行程結束時的最大常駐記憶體。
+
+每個 skill、每個資料倍數各在獨立的子行程執行（三個 skill 的模組同名，且冷啟動
+本來就要新行程）。合成資料把每份 CSV 複製成 N 倍：第 r 份複本的第一欄加上
+'-r' 後綴（維持主鍵唯一），最後一欄附加 ' r{r}' token（詞彙隨倍數成長），
+其餘內容不變，因此 postings 長度與資料量等比例放大。
+
+結果以 JSON 輸出（--output），可作為基準檔；--baseline 指定先前的基準檔時，
+p50 延遲或峰值 RSS 超過基準 × 容許倍數即視為退步，exit code 為 1，供 CI 使用。
+
+用法:
+    python scripts/benchmark.py                                  # 1x / 10x / 100x / 1000x
+    python scripts/benchmark.py --scales 1,10 --output bench.json
+    python scripts/benchmark.py --scales 1,10 --baseline scripts/benchmark-baseline.json
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SKILLS = ('invoice', 'payment', 'logistics')
+
+# 各 skill 的代表性查詢：錯誤碼、中英混合、自動偵測域與推薦情境
+QUERIES = {
+    'invoice': {
+        'search': [('ecpay 折讓', None), ('10000016', 'error'), ('統編', 'field'),
+                   ('B2B 稅額計算', 'tax'), ('列印空白', 'troubleshoot'), ('開立發票 API', None)],
+        'recommend': ['電商平台 大量開立 API 穩定', '小型商家 簡單 便宜', '需要 B2B 與 B2C 都支援'],
+    },
+    'payment': {
+        'search': [('ecpay 退款', None), ('10100058', 'error'), ('MerchantTradeNo', 'field'),
+                   ('CheckMacValue 錯誤', 'troubleshoot'), ('信用卡 分期', None), ('查詢訂單', 'operation')],
+        'recommend': ['電商平台 信用卡 分期', '訂閱制 定期定額', '行動支付 LINE Pay 街口'],
+    },
+    'logistics': {
+        'search': [('7-11 取貨', None), ('300', 'status'), ('ReceiverStoreID', 'field'),
+                   ('建立物流訂單', 'operation'), ('黑貓 宅配', None), ('配送中', 'status')],
+        'recommend': ['超商取貨 電商', '冷凍 生鮮 宅配', '即時外送 同城'],
+    },
+}
+
+# 每項暖查詢量測的次數上限與時間預算（秒）；大倍數時以時間預算為準，但至少量 MIN_SAMPLES 次
+MAX_SAMPLES = 300
+MIN_SAMPLES = 5
+TIME_BUDGET = 2.0
+COLD_REPEATS = 3
+
+# 某倍數下單次呼叫的 p50 已超過此值 (ms) 的指標，更大的倍數不再量測（記為 null）：
+# 複雜度高於線性的實作在 1000x 下一次呼叫可能要數小時
+SLOW_CALL_MS = 1000
+
+# 比對基準時忽略的絕對差距 (ms)：微秒級的量測雜訊不算退步
+MIN_DELTA_MS = 0.05
+
+
+# ── 合成資料 ────────────────────────────────────────────────
+
+
+def scale_data(src_dir, dst_dir, factor):
+    """將 src_dir 下每份 CSV 複製成 factor 倍寫入 dst_dir，回傳總列數"""
+    os.makedirs(dst_dir, exist_ok=True)
+    total = 0
+    for name in sorted(os.listdir(src_dir)):
+        src = os.path.join(src_dir, name)
+        dst = os.path.join(dst_dir, name)
+        if not name.endswith('.csv'):
+            if os.path.isfile(src):
+                shutil.copyfile(src, dst)
+            continue
+        with open(src, encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+        if not rows:
+            shutil.copyfile(src, dst)
+            continue
+        header, body = rows[0], [r for r in rows[1:] if r]
+        with open(dst, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for r in range(factor):
+                for row in body:
+                    if r:
+                        row = list(row)
+                        row[0] = f'{row[0]}-{r}'
+                        row[-1] = f'{row[-1]} r{r}'
+                    writer.writerow(row)
+        total += len(body) * factor
+    return total
+
+
+# ── 量測（子行程內執行） ────────────────────────────────────
+
+
+def _percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+    p99 = ordered[min(len(ordered) - 1, int(round(0.99 * (len(ordered) - 1))))]
+    return {'p50': round(statistics.median(ordered), 4), 'p99': round(p99, 4), 'n': len(ordered)}
+
+
+def _time_calls(fn, args_list):
+    """輪流以 args_list 呼叫 fn，回傳每次呼叫的延遲 (ms) 統計"""
+    samples = []
+    deadline = time.perf_counter() + TIME_BUDGET
+    i = 0
+    while len(samples) < MAX_SAMPLES and (len(samples) < MIN_SAMPLES or time.perf_counter() < deadline):
+        args = args_list[i % len(args_list)]
+        start = time.perf_counter()
+        fn(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+        i += 1
+    return _percentiles(samples)
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 回報，macOS 以 bytes 回報
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _load_skill(skill, data_dir, index_dir):
+    """匯入 skill 的 core 並改指到合成資料目錄"""
+    sys.path.insert(0, os.path.join(ROOT, f'taiwan-{skill}', 'scripts'))
+    import core
+    core.ENGINE.data_dir = data_dir
+    core.ENGINE.index_dir = index_dir
+    core.ENGINE.indexes.clear()
+    return core
+
+
+def worker_cold(skill, data_dir, index_dir):
+    """新行程從 import 到第一筆結果的時間"""
+    start = time.perf_counter()
+    core = _load_skill(skill, data_dir, index_dir)
+    query, domain = QUERIES[skill]['search'][0]
+    core.search(query, domain)
+    return {'ms': (time.perf_counter() - start) * 1000}
+
+
+def worker_warm(skill, data_dir, index_dir, skip=()):
+    """同一行程內的各項查詢延遲；skip 內的指標不量測"""
+    from pathlib import Path
+
+    core = _load_skill(skill, data_dir, index_dir)
+    from engine import QueryCache
+    core.ENGINE.cache = QueryCache(0)
+    core.build_all_indexes()
+
+    import recommend
+    queries = QUERIES[skill]
+    searches = [(q, d) for q, d in queries['search']]
+    texts = [(q,) for q, _ in queries['search']]
+    requirements = [(q,) for q in queries['recommend']]
+    if skill == 'logistics':
+        recommender = recommend.LogisticsRecommender(data_dir=Path(data_dir))
+        benches = {'recommend': (recommender.recommend, requirements)}
+    else:
+        # invoice 的 DATA_DIR 是字串，payment 的是 Path
+        recommend.DATA_DIR = data_dir if skill == 'invoice' else Path(data_dir)
+        benches = {'analyze_requirements': (recommend.analyze_requirements, requirements)}
+    benches = {
+        'search': (core.search, searches),
+        'search_all': (core.search_all, texts),
+        'detect_domain': (core.detect_domain, texts),
+        **benches,
+    }
+
+    metrics = {name: None if name in skip else _time_calls(fn, calls)
+               for name, (fn, calls) in benches.items()}
+    metrics['peak_rss_mb'] = _peak_rss_mb()
+    return metrics
+
+
+def run_worker(mode, skill, data_dir, index_dir, skip=()):
+    command = [sys.executable, os.path.abspath(__file__), '--worker', mode,
+               '--skill', skill, '--data-dir', data_dir, '--index-dir', index_dir]
+    if skip:
+        command += ['--skip', ','.join(skip)]
+    proc = subprocess.run(command, capture_output=True, text=True, encoding='utf-8')
+    if proc.returncode != 0:
+        raise RuntimeError(f'{skill} {mode} 量測失敗:\n{proc.stderr}')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+# ── 主流程 ──────────────────────────────────────────────────
+
+
+def bench_skill(skill, factor, workdir, skip=()):
+    data_dir = os.path.join(workdir, f'{skill}-{factor}x', 'data')
+    index_dir = os.path.join(workdir, f'{skill}-{factor}x', '.index')
+    rows = scale_data(os.path.join(ROOT, f'taiwan-{skill}', 'data'), data_dir, factor)
+
+    cold_build = []
+    for _ in range(COLD_REPEATS):
+        shutil.rmtree(index_dir, ignore_errors=True)
+        cold_build.append(run_worker('cold', skill, data_dir, index_dir)['ms'])
+    # 上一輪已寫入索引檔，之後的冷啟動直接載入
+    cold_load = [run_worker('cold', skill, data_dir, index_dir)['ms'] for _ in range(COLD_REPEATS)]
+
+    result = {'rows': rows, 'cold_build': _percentiles(cold_build), 'cold_load': _percentiles(cold_load)}
+    result.update(run_worker('warm', skill, data_dir, index_dir, skip))
+    return result
+
+
+def compare(current, baseline, tolerance, rss_tolerance):
+    """回傳退步項目的說明列表；只比較兩邊都有的 skill / 倍數 / 指標"""
+    regressions = []
+    for skill, scales in current['results'].items():
+        for factor, metrics in scales.items():
+            base = baseline.get('results', {}).get(skill, {}).get(factor)
+            if not base:
+                continue
+            for name, value in metrics.items():
+                old = base.get(name)
+                if old is None or value is None:
+                    continue
+                if name == 'peak_rss_mb':
+                    if value > old * rss_tolerance:
+                        regressions.append(f'{skill} {factor}x {name}: {old} → {value} MB')
+                elif isinstance(value, dict) and 'p50' in value:
+                    now, before = value['p50'], old['p50']
+                    if now > before * tolerance and now - before > MIN_DELTA_MS:
+                        regressions.append(f'{skill} {factor}x {name} p50: {before} → {now} ms')
+    return regressions
+
+
+def print_table(results):
+    columns = ['cold_build', 'cold_load', 'search', 'search_all', 'detect_domain',
+               'analyze_requirements', 'recommend']
+    print(f'  {"skill":<10} {"scale":>6} {"rows":>8}  ' + '  '.join(f'{c:>20}' for c in columns)
+          + f'  {"peak_rss":>9}')
+    for skill, scales in results.items():
+        for factor, metrics in scales.items():
+            cells = []
+            for c in columns:
+                m = metrics.get(c, '')
+                if m is None:
+                    cells.append(f'{"(skipped)":>20}')
+                else:
+                    cells.append(f'{m["p50"]:>9.3f} / {m["p99"]:>8.3f}' if m else f'{"-":>20}')
+            rss = metrics.get('peak_rss_mb')
+            print(f'  {skill:<10} {factor + "x":>6} {metrics["rows"]:>8}  ' + '  '.join(cells)
+                  + f'  {rss if rss is not None else "-":>6} MB')
+    print(f'  （延遲為 p50 / p99，單位 ms；skipped 為較小倍數時 p50 已超過 {SLOW_CALL_MS} ms 的指標）')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Taiwan 電商 Skill 搜索與推薦效能基準')
+    parser.add_argument('--scales', default='1,10,100,1000', help='資料倍數，以逗號分隔 (預設: 1,10,100,1000)')
+    parser.add_argument('--skills', default=','.join(SKILLS), help='要量測的 skill (預設: 全部)')
+    parser.add_argument('--output', '-o', help='將結果寫成 JSON 檔 (可作為之後的基準)')
+    parser.add_argument('--baseline', '-b', help='比對的基準 JSON；有退步時 exit code 為 1')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='p50 延遲超過基準的幾倍視為退步 (預設: 1.5)')
+    parser.add_argument('--rss-tolerance', type=float, default=1.3,
+                        help='峰值 RSS 超過基準的幾倍視為退步 (預設: 1.3)')
+    # 子行程用
+    parser.add_argument('--worker', choices=['cold', 'warm'], help=argparse.SUPPRESS)
+    parser.add_argument('--skill', help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--index-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--skip', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker == 'cold':
+            result = worker_cold(args.skill, args.data_dir, args.index_dir)
+        else:
+            result = worker_warm(args.skill, args.data_dir, args.index_dir, args.skip.split(','))
+        print(json.dumps(result))
+        return 0
+
+    scales = [int(s) for s in args.scales.split(',') if s.strip()]
+    skills = [s for s in args.skills.split(',') if s in SKILLS]
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='taiwan-bench-')
+    try:
+        for skill in skills:
+            results[skill] = {}
+            skip = set()
+            for factor in sorted(scales):
+                print(f'  量測 {skill} {factor}x ...', file=sys.stderr, flush=True)
+                metrics = bench_skill(skill, factor, workdir, sorted(skip))
+                results[skill][str(factor)] = metrics
+                skip.update(name for name, m in metrics.items()
+                            if isinstance(m, dict) and m.get('p50', 0) > SLOW_CALL_MS)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'scales': scales,
+        },
+        'results': results,
+    }
+
+    print()
+    print_table(results)
+    print()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f'結果已寫入: {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.rss_tolerance)
+        if regressions:
+            print(f'[FAIL] {len(regressions)} 項效能退步（容許 {args.tolerance}x 延遲、'
+                  f'{args.rss_tolerance}x RSS）：')
+            for line in regressions:
+                print(f'   {line}')
+            return 1
+        print(f'[DONE] 未超過基準 ({args.baseline})')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -118,6 +118,7 @@ run('assets 同步', 'node', ['scripts/sync-assets.mjs', '--check']);
 run('資料檔完整性', PYTHON, ['scripts/validate-data.py']);
 run('推薦回歸（invoice）', PYTHON, ['taiwan-invoice/scripts/test_recommend.py']);
 run('推薦回歸（payment）', PYTHON, ['taiwan-payment/scripts/test_recommend.py']);
+run('推薦回歸（logistics）', PYTHON, ['taiwan-logistics/scripts/test_recommend.py']);
 
 for (const k of targets) {
   const { dir, pkg } = PACKAGES[k];
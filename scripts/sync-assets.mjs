@@ -13,6 +13,10 @@
  *
  * 只鏡像 assets/taiwan-<skill>/，不動 assets/templates/（後者為手工維護）。
  *
+ * 另外，SHARED_FILES 是三個 skill 各附一份、內容必須相同的檔案（共用的搜索
+ * 引擎與常駐服務）。以 taiwan-invoice 的為準，先複製到其餘 skill 再同步 assets；
+ * --check 時副本不一致也視為落差。
+ *
  * 用法:
  *   node scripts/sync-assets.mjs                 # 同步全部
  *   node scripts/sync-assets.mjs --only invoice  # 只同步單一套件
@@ -31,8 +35,13 @@ export const PACKAGES = [
   { key: 'logistics', src: 'taiwan-logistics', cli: 'logistics-cli', pkg: 'taiwan-logistics-skill' },
 ];
 
+// 三個 skill 共用、以 taiwan-invoice 為準的檔案（相對於 skill 根目錄）
+export const SHARED_FILES = ['scripts/engine.py', 'scripts/server.py', 'scripts/stack.py'];
+const SHARED_SOURCE = 'taiwan-invoice';
+
 // 這些是本機產物或作業系統垃圾檔，不該進入發布包
-const EXCLUDE_DIRS = new Set(['__pycache__', '.pytest_cache', 'node_modules', '.git']);
+// .index/ 是 search.py 執行時產生的編譯索引，與安裝環境綁定，不隨套件發布
+const EXCLUDE_DIRS = new Set(['__pycache__', '.pytest_cache', 'node_modules', '.git', '.index']);
 const EXCLUDE_FILES = /\.(pyc|pyo|pyd)$|^\.DS_Store$|^Thumbs\.db$/;
 
 function walk(dir, base = dir, out = []) {
@@ -55,6 +64,27 @@ function sameContent(a, b) {
   return readFileSync(a).equals(readFileSync(b));
 }
 
+/** 回傳各 skill 與 SHARED_SOURCE 不一致的共用檔 */
+function diffShared(targets = PACKAGES) {
+  const changed = [];
+  for (const { src } of targets) {
+    if (src === SHARED_SOURCE) continue;
+    for (const rel of SHARED_FILES) {
+      if (!sameContent(join(ROOT, SHARED_SOURCE, rel), join(ROOT, src, rel))) changed.push(`${src}/${rel}`);
+    }
+  }
+  return { added: [], changed, removed: [] };
+}
+
+function syncShared(targets = PACKAGES) {
+  const result = diffShared(targets);
+  for (const path of result.changed) {
+    const rel = path.slice(path.indexOf('/') + 1);
+    copyFileSync(join(ROOT, SHARED_SOURCE, rel), join(ROOT, path));
+  }
+  return result;
+}
+
 /** 回傳這個套件的落差清單（不修改任何檔案） */
 function diffPackage({ src, cli }) {
   const srcDir = join(ROOT, src);
@@ -101,6 +131,7 @@ export function syncOne(key) {
   const target = PACKAGES.find((p) => p.key === key);
   if (!target) throw new Error(`未知的套件: ${key}`);
 
+  syncShared([target]);
   const { added, changed, removed } = syncPackage(target);
   const total = added.length + changed.length + removed.length;
   console.log(total === 0 ? '  assets 已是最新' : `  assets 已同步（新增 ${added.length} / 變更 ${changed.length} / 移除 ${removed.length}）`);
@@ -141,6 +172,10 @@ function main() {
   console.log(check ? '檢查 CLI assets 是否與 source of truth 同步…' : '同步 CLI assets…');
 
   let drifted = 0;
+  const shared = check ? diffShared(targets) : syncShared(targets);
+  if (shared.changed.length > 0) drifted += 1;
+  console.log(describe('shared', shared));
+
   for (const target of targets) {
     const result = check ? diffPackage(target) : syncPackage(target);
     const total = result.added.length + result.changed.length + result.removed.length;
@@ -150,7 +185,7 @@ function main() {
 
   if (check && drifted > 0) {
     console.error(
-      `\n有 ${drifted} 個套件的 assets 與來源不一致。\n` +
+      `\n有 ${drifted} 組檔案與來源不一致。\n` +
         '執行 `node scripts/sync-assets.mjs` 後 commit，再重新發布。'
     );
     process.exit(1);
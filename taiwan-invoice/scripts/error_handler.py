@@ -20,6 +20,8 @@ Taiwan Invoice Skill - 系統化錯誤處理與自動重試機制
         pass
 """
 
+import os
+import sys
 import time
 import functools
 import logging
@@ -27,6 +29,10 @@ from typing import Callable, Optional, Dict, List
 from dataclasses import dataclass
 from enum import Enum
 
+# 未收錄於對照表的錯誤碼改查 data/error-codes.csv (透過 core 的碼索引)；
+# core 在第一次查 CSV 時才匯入，匯入本模組不會改動 sys.path
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class ErrorCategory(Enum):
     """錯誤類別"""
@@ -204,6 +210,12 @@ class InvoiceErrorHandler:
         ),
     }
 
+    # CSV category 欄位 -> ErrorCategory；其餘 (開立、作廢、折讓、查詢…) 多為資料驗證錯誤
+    CSV_CATEGORIES: Dict[str, ErrorCategory] = {
+        '認證': ErrorCategory.AUTHENTICATION,
+        '權限': ErrorCategory.PERMISSION,
+    }
+
     def __init__(self, provider: str = 'ecpay', logger: Optional[logging.Logger] = None):
         """
         初始化錯誤處理器
@@ -241,6 +253,9 @@ class InvoiceErrorHandler:
         """
         取得錯誤資訊
 
+        依序查詢：內建對照表 (含重試策略) → data/error-codes.csv。
+        CSV 中同一錯誤碼有多家服務商時，優先採用本處理器的 provider。
+
         Args:
             error_code: 錯誤碼
 
@@ -253,16 +268,44 @@ class InvoiceErrorHandler:
             >>> print(info.suggestion)
             檢查 B2C/B2B 金額計算
         """
-        return self.all_errors.get(
-            error_code,
-            ErrorInfo(
-                code=error_code,
-                message='未知錯誤',
-                category=ErrorCategory.UNKNOWN,
-                retry_strategy=RetryStrategy.NO_RETRY,
-                suggestion=f'錯誤碼 {error_code} 未記錄在系統中，請查閱官方文件',
-                is_retryable=False
-            )
+        if error_code in self.all_errors:
+            return self.all_errors[error_code]
+
+        csv_info = self._lookup_csv(error_code)
+        if csv_info is not None:
+            return csv_info
+
+        return ErrorInfo(
+            code=error_code,
+            message='未知錯誤',
+            category=ErrorCategory.UNKNOWN,
+            retry_strategy=RetryStrategy.NO_RETRY,
+            suggestion=f'錯誤碼 {error_code} 未記錄在系統中，請查閱官方文件',
+            is_retryable=False
+        )
+
+    def _lookup_csv(self, error_code: str) -> Optional[ErrorInfo]:
+        """
+        從 data/error-codes.csv 查詢錯誤碼；CSV 沒有重試資訊，一律視為不可重試
+        """
+        if SCRIPT_DIR not in sys.path:
+            sys.path.insert(0, SCRIPT_DIR)
+        from core import lookup_code
+
+        rows = lookup_code(error_code, provider=self.provider, domain='error')
+        if not rows:
+            rows = lookup_code(error_code, domain='error')
+        if not rows:
+            return None
+
+        row = rows[0]
+        return ErrorInfo(
+            code=error_code,
+            message=row.get('message_zh') or row.get('message_en') or '未知錯誤',
+            category=self.CSV_CATEGORIES.get(row.get('category', ''), ErrorCategory.VALIDATION),
+            retry_strategy=RetryStrategy.NO_RETRY,
+            suggestion=row.get('solution') or '請查閱服務商官方文件',
+            is_retryable=False
         )
 
     def should_retry(self, error_code: str) -> bool:
@@ -385,7 +428,7 @@ if __name__ == '__main__':
 
     handler = InvoiceErrorHandler(provider='ecpay')
 
-    error_codes = ['10000006', '10000016', '10000019', 'NETWORK_ERROR']
+    error_codes = ['10000006', '10000016', '10000019', 'NETWORK_ERROR', '-10066', 'INV10001']
 
     for code in error_codes:
         info = handler.get_error_info(code)
@@ -410,7 +453,7 @@ if __name__ == '__main__':
     @retry_on_error(max_retries=3, backoff_factor=1.5)
     def flaky_api_call():
         """模擬不穩定的 API 呼叫"""
-        nonlocal attempt
+        global attempt
         attempt += 1
 
         print(f"第 {attempt} 次呼叫...")
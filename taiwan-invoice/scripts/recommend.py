@@ -4,20 +4,24 @@ Taiwan Invoice Skill - 加值中心推薦系統
 基於使用者需求推薦最適合的電子發票加值中心
 
 無外部依賴，純 Python 實現
+
+用法:
+    python recommend.py "電商 高交易量 穩定"
+    python recommend.py --batch < merchants.jsonl > results.jsonl   # 批次，JSONL 進出
 """
 
-import csv
 import os
 import sys
 import argparse
-from typing import List, Dict, Any, Optional, Tuple
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, Iterator, Optional, TextIO, Tuple
 
 # 取得 data 目錄路徑
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), 'data')
 
+# core（連同搜索引擎）在實際推薦時才匯入，--help 與參數錯誤不必付出載入成本
 sys.path.insert(0, SCRIPT_DIR)
-from core import rule_match_score, MIN_RULE_MATCH  # noqa: E402
 
 # 推薦規則定義
 RECOMMENDATION_RULES = {
@@ -82,53 +86,90 @@ ANTI_PATTERNS = {
 }
 
 
+@lru_cache(maxsize=None)
+def keyword_rules():
+    """RECOMMENDATION_RULES 與 ANTI_PATTERNS 編成的關鍵字自動機（core.KeywordRules），行程內只編譯一次"""
+    from core import KeywordRules
+
+    return KeywordRules(RECOMMENDATION_RULES, ANTI_PATTERNS)
+
+
 def load_providers() -> List[Dict[str, str]]:
-    """載入加值中心資料"""
-    filepath = os.path.join(DATA_DIR, 'providers.csv')
-    if not os.path.exists(filepath):
-        return []
+    """
+    載入加值中心資料
+
+    providers.csv 在行程內只讀一次，檔案變動時才重新讀取（core.file_snapshot）；
+    回傳的是共用的列，請勿修改。
+    """
+    from core import file_snapshot
 
-    with open(filepath, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        return list(reader)
+    return file_snapshot(os.path.join(DATA_DIR, 'providers.csv')).get()
 
 
 def load_reasoning_rules() -> List[Dict[str, str]]:
     """載入推理規則"""
-    filepath = os.path.join(DATA_DIR, 'reasoning.csv')
-    if not os.path.exists(filepath):
-        return []
+    from core import rule_table
+
+    return [dict(rule) for rule in rule_table(os.path.join(DATA_DIR, 'reasoning.csv')).load()]
+
+
+def refresh() -> List[str]:
+    """
+    檢查 providers.csv 與 reasoning.csv，只重建有變動的那一份；回傳被重建的檔名
+
+    每次推薦本來就會比對來源檔並在變動時重建；長駐服務可改用 watch() 在背景
+    定期呼叫，讓重建發生在請求之外。
+    """
+    from core import file_snapshot, rule_table
+
+    sources = {
+        'providers.csv': file_snapshot(os.path.join(DATA_DIR, 'providers.csv')),
+        'reasoning.csv': rule_table(os.path.join(DATA_DIR, 'reasoning.csv')),
+    }
+    return [name for name, source in sources.items() if source.refresh()]
+
 
-    with open(filepath, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        return list(reader)
+def watch(interval: float = 1.0):
+    """在背景每 interval 秒執行一次 refresh()，回傳已啟動的 core.Watcher（以 stop() 停止）"""
+    from core import Watcher
 
+    return Watcher(refresh, interval).start()
 
-def analyze_requirements(query: str) -> Dict[str, Tuple[int, List[str]]]:
+
+def analyze_requirements(
+    query: str,
+    providers: Optional[List[Dict[str, str]]] = None,
+    rule_matches: Optional[List[Tuple[Dict[str, str], float]]] = None
+) -> Dict[str, Tuple[int, List[str]]]:
     """
     分析使用者需求，計算各加值中心分數
 
+    Args:
+        query: 使用者需求描述
+        providers: 已載入的 providers.csv，批次推薦時整批共用；預設重新載入
+        rule_matches: 已比對好的 reasoning.csv 規則（RuleTable.match() 的結果），
+                      批次推薦時由 RuleTable.match_batch() 整批比對；預設逐筆比對
+
     Returns:
         Dict[provider, (score, reasons)]
     """
-    query_lower = query.lower()
+    from core import rule_table
+
+    if providers is None:
+        providers = load_providers()
 
     # 由 providers.csv 動態建立，避免新增加值中心後推薦規則被靜默丟棄
-    scores = {p['provider']: (0, []) for p in load_providers()}
+    scores = {p['provider']: (0, []) for p in providers}
 
-    # 從 reasoning.csv 載入規則
-    reasoning_rules = load_reasoning_rules()
+    # reasoning.csv 規則表在行程內只編譯一次（檔案變動時自動重載），
+    # 且只為與查詢共用 token 的規則計分
     confidence_weights = {'HIGH': 3, 'MEDIUM': 2, 'LOW': 1}
 
-    for rule in reasoning_rules:
-        # 以匹配強度加權，而非命中任一詞就給滿分；後者會讓「開立」這類
-        # 高頻短詞使不相干的規則以同分勝出
-        strength = rule_match_score(
-            query, rule.get('scenario', ''), rule.get('use_cases', '')
-        )
-        if strength < MIN_RULE_MATCH:
-            continue
-
+    # 以匹配強度加權，而非命中任一詞就給滿分；後者會讓「開立」這類
+    # 高頻短詞使不相干的規則以同分勝出（見 core.rule_match_score）
+    if rule_matches is None:
+        rule_matches = rule_table(os.path.join(DATA_DIR, 'reasoning.csv')).match(query)
+    for rule, strength in rule_matches:
         provider = rule.get('recommended_provider', '')
         confidence = rule.get('confidence', 'LOW')
         reason = rule.get('reason', '')
@@ -139,43 +180,39 @@ def analyze_requirements(query: str) -> Dict[str, Tuple[int, List[str]]]:
             if reason and reason not in reasons:
                 scores[provider] = (current_score + weight, reasons + [reason])
 
-    # 根據關鍵字累計分數 (fallback)
-    for keyword, rules in RECOMMENDATION_RULES.items():
-        if keyword.lower() in query_lower:
-            for provider, weight, reason in rules:
-                current_score, reasons = scores[provider]
-                if reason not in reasons:
-                    scores[provider] = (current_score + weight, reasons + [reason])
+    # 根據關鍵字累計分數 (fallback)：所有關鍵字一次掃描，依 RECOMMENDATION_RULES 的順序套用
+    for _, rules in keyword_rules().match(query):
+        for provider, weight, reason in rules:
+            current_score, reasons = scores[provider]
+            if reason not in reasons:
+                scores[provider] = (current_score + weight, reasons + [reason])
 
     return scores
 
 
 def get_anti_pattern_warnings(query: str, recommended: str) -> List[str]:
-    """取得反模式警告"""
-    query_lower = query.lower()
-    warnings = []
-
-    if recommended in ANTI_PATTERNS:
-        for keyword, warning in ANTI_PATTERNS[recommended]:
-            if keyword.lower() in query_lower:
-                warnings.append(warning)
+    """取得反模式警告（與 analyze_requirements 共用同一次關鍵字掃描）"""
+    return [warning for _, warning in keyword_rules().warnings(query, recommended)]
 
-    return warnings
 
-
-def recommend(query: str, verbose: bool = False) -> Dict[str, Any]:
+def recommend(query: str, verbose: bool = False,
+              providers: Optional[List[Dict[str, str]]] = None,
+              rule_matches: Optional[List[Tuple[Dict[str, str], float]]] = None) -> Dict[str, Any]:
     """
     推薦加值中心
 
     Args:
         query: 使用者需求描述
         verbose: 是否輸出詳細資訊
+        providers: 已載入的 providers.csv，預設重新載入
+        rule_matches: 已比對好的 reasoning.csv 規則，見 analyze_requirements()
 
     Returns:
         推薦結果
     """
-    providers = load_providers()
-    scores = analyze_requirements(query)
+    if providers is None:
+        providers = load_providers()
+    scores = analyze_requirements(query, providers, rule_matches)
 
     # 排序取得推薦順序
     sorted_providers = sorted(
@@ -194,11 +231,11 @@ def recommend(query: str, verbose: bool = False) -> Dict[str, Any]:
         recommended_reasons = ['市佔率最高，適合大多數場景', '文檔完整，社群支援豐富']
         recommended_score = 1
 
-    # 取得加值中心詳細資訊
+    # 取得加值中心詳細資訊（複製一份：providers 是行程內共用的列）
     provider_info = None
     for p in providers:
         if p.get('provider') == recommended:
-            provider_info = p
+            provider_info = dict(p)
             break
 
     # 取得警告
@@ -226,6 +263,105 @@ def recommend(query: str, verbose: bool = False) -> Dict[str, Any]:
     return result
 
 
+def _recommend_chunk(queries: List[str]) -> List[Dict[str, Any]]:
+    """在本行程推薦一段查詢（recommend_batch 的子行程入口）"""
+    import copy
+
+    from core import rule_table
+
+    providers = load_providers()
+    unique = list(dict.fromkeys(queries))
+    # reasoning.csv 規則整批比對一次：token 聯集只查一次倒排索引
+    matches = dict(zip(unique, rule_table(os.path.join(DATA_DIR, 'reasoning.csv')).match_batch(unique)))
+    computed: Dict[str, Dict[str, Any]] = {}
+    results = []
+    for query in queries:
+        if query in computed:
+            results.append(copy.deepcopy(computed[query]))
+        else:
+            computed[query] = recommend(query, providers=providers, rule_matches=matches[query])
+            results.append(computed[query])
+    return results
+
+
+def recommend_batch(queries: Iterable[str], processes: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    批次推薦：providers.csv 整批只讀一次，reasoning.csv 規則整批比對一次
+    （RuleTable.match_batch），規則表與關鍵字自動機在行程內只編譯一次；
+    相同的需求描述只計算一次
+
+    Args:
+        queries: 需求描述
+        processes: 大於 1 且批次達 BATCH_PROCESS_THRESHOLD 筆時，分塊交給多個子行程
+
+    Returns:
+        與 queries 順序相同的結果列表，每項等同 recommend() 的回傳值
+    """
+    from core import map_batch
+
+    return map_batch(_recommend_chunk, queries, processes)
+
+
+def parse_batch_line(line: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """解析一行 JSONL：JSON 字串或含 query（必要）、id 的物件，回傳 (item, error)"""
+    import json
+
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return None, f'invalid JSON: {e}'
+    if isinstance(item, str):
+        item = {'query': item}
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+        return None, "expected a string or an object with a string 'query'"
+    return item, ''
+
+
+def _chunked(lines: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(stream: TextIO, out: TextIO, processes: Optional[int] = None,
+              chunk_size: int = 1000) -> int:
+    """
+    JSONL 批次模式：stdin 每行一筆需求，stdout 每行一筆推薦結果（同 --format json）
+
+    每讀滿一段就推薦並輸出一次，大檔案也能邊讀邊寫；無法解析的行輸出
+    {"line", "error"}，不中斷整批。回傳錯誤行數。
+    """
+    import json
+    from core import BATCH_PROCESS_THRESHOLD
+
+    if processes and processes > 1:
+        # 每段至少要達多行程門檻，子行程才派得上用場
+        chunk_size = max(chunk_size, BATCH_PROCESS_THRESHOLD * processes)
+    errors = 0
+    lines = ((n, line) for n, line in enumerate(stream, 1) if line.strip())
+    for chunk in _chunked(lines, chunk_size):
+        parsed = [(n, *parse_batch_line(line)) for n, line in chunk]
+        queries = [item['query'] for _, item, _ in parsed if item is not None]
+        results = iter(recommend_batch(queries, processes))
+
+        for n, item, error in parsed:
+            if item is None:
+                errors += 1
+                record = {'line': n, 'error': error}
+            else:
+                record = {'id': item['id']} if 'id' in item else {}
+                record.update(next(results))
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+    return errors
+
+
 def format_ascii_box(result: Dict[str, Any]) -> str:
     """格式化為 ASCII Box 輸出"""
     width = 70
@@ -342,6 +478,9 @@ def main():
   python recommend.py "電商 高交易量 穩定"
   python recommend.py "簡單整合 快速上線" --format json
   python recommend.py "API設計優先 MIG標準" --format simple
+  python recommend.py "電商 穩定" --profile           # 各階段耗時輸出到 stderr
+  python recommend.py --batch < merchants.jsonl       # 每行一筆需求 (字串或 {"id", "query"})，JSONL 輸出
+  python recommend.py --batch -j 4 < merchants.jsonl  # 大量需求時以 4 個子行程平行處理
 
 關鍵字範例:
   穩定性: 穩定, 市佔, 高交易量, 電商
@@ -351,7 +490,7 @@ def main():
 """
     )
 
-    parser.add_argument('query', help='需求描述 (關鍵字以空格分隔)')
+    parser.add_argument('query', nargs='?', help='需求描述 (關鍵字以空格分隔)')
     parser.add_argument(
         '-f', '--format',
         choices=['ascii', 'json', 'simple'],
@@ -363,9 +502,48 @@ def main():
         action='store_true',
         help='顯示詳細資訊'
     )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='table',
+        metavar='MODE',
+        help='各階段耗時輸出到 stderr：table (預設)、json、cprofile[:路徑]；亦可設定 $TAIWAN_SEARCH_PROFILE'
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='從 stdin 讀取 JSONL 需求，逐行輸出 JSONL 推薦結果'
+    )
+    parser.add_argument(
+        '-j', '--processes',
+        type=int,
+        default=None,
+        help='--batch 輸入量大時使用的子行程數'
+    )
 
     args = parser.parse_args()
 
+    profile = args.profile or os.environ.get('TAIWAN_SEARCH_PROFILE')
+    if profile:
+        from core import PROFILER, start_profiling
+
+        try:
+            start_profiling(profile, __file__)
+        except ValueError as e:
+            parser.error(str(e))
+        module = sys.modules[__name__]
+        PROFILER.instrument(module, ['load_providers', 'load_reasoning_rules'], 'load_csv')
+        PROFILER.instrument(module, ['analyze_requirements'], 'analyze_requirements')
+        PROFILER.instrument(module, ['format_ascii_box', 'format_json', 'format_simple'], 'format')
+
+    # JSONL 批次模式
+    if args.batch:
+        errors = run_batch(sys.stdin, sys.stdout, args.processes)
+        sys.exit(1 if errors else 0)
+
+    if args.query is None:
+        parser.error('需要需求描述，或使用 --batch 從 stdin 讀取')
+
     # 執行推薦
     result = recommend(args.query, args.verbose)
 
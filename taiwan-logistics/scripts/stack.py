@@ -0,0 +1,467 @@
+#!/usr/bin/env python3
+"""
+Taiwan 電商整合推薦：金流 + 發票 + 物流一次評分
+
+商家常一次詢問整套方案（「ECPay 金流 + 發票 + 超商物流」），原本要分別執行
+三個 skill 的 recommend.py 再手動對照。本工具載入同一個 skills 目錄下找得到的
+taiwan-* skill，沿用各自推薦器的評分，在相容性限制下搜尋服務商組合，一次回傳
+前 K 組並附上每個元件的推薦理由。
+
+三個 skill 各附一份內容相同的 stack.py（與 server.py 同理），只安裝部分 skill
+時只組合找得到的元件。
+
+評分:
+    各元件的推薦分數除以該元件的最高分，正規化為 0~1 後相加；查詢點名的服務商
+    加 MENTION_BONUS，由同一家服務商（見 VENDOR_GROUPS）負責的每一對元件再加
+    SAME_VENDOR_BONUS。--same-vendor 或查詢中的「一站式」「同一家」等字詞會把
+    同家變成硬性限制。
+
+搜尋:
+    各元件的候選依分數排序後做分支定界：已選元件的分數加上其餘元件的最高分與
+    最多可得的同家加分，仍不超過目前第 K 名就剪枝，不列舉完整的笛卡兒積。
+
+用法:
+    python stack.py "ECPay 金流 + 發票 + 超商物流"
+    python stack.py "訂閱制 發票 宅配" --top 5 --format json
+    python stack.py "電商 金流 發票" --same-vendor payment,invoice
+"""
+
+import argparse
+import heapq
+import importlib.util
+import json
+import re
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 組合時的元件順序，也是輸出順序
+SKILLS = ('payment', 'invoice', 'logistics')
+SKILLS_ROOT = Path(__file__).resolve().parent.parent.parent
+
+COMPONENT_LABELS = {'payment': '金流', 'invoice': '發票', 'logistics': '物流'}
+
+# 查詢提到這些字詞時只組合對應的元件；都沒提到時組合全部找得到的 skill
+COMPONENT_KEYWORDS = {
+    'payment': ['金流', '金物流', '支付', '付款', '收款', '刷卡', '信用卡', 'payment'],
+    'invoice': ['發票', '統編', '載具', '折讓', 'invoice'],
+    'logistics': ['物流', '取貨', '宅配', '配送', '店到店', '出貨', 'logistics'],
+}
+
+# 查詢出現這些字詞時，所有元件須由同一家服務商負責
+SAME_VENDOR_KEYWORDS = ['一站式', '同一家', '同一間', '單一窗口', '同一個帳號']
+
+# 各 skill 的服務商代碼大小寫不一，比對時轉小寫；不同代碼但屬同一集團的對應到同一個鍵。
+# ezPay 簡單付（金流與發票）是藍新集團的品牌，與 NewebPay 同加密
+VENDOR_GROUPS = {'ezpay': 'newebpay'}
+
+# 查詢以中文品牌稱呼服務商時對應的集團鍵（英文代碼直接比對）
+VENDOR_ALIASES = {
+    '綠界': 'ecpay', '藍新': 'newebpay', '簡單付': 'newebpay', '統一金流': 'payuni',
+    '速買配': 'smilepay', '拍錢包': 'pchomepay', '立吉富': 'paynow', '歐付寶': 'opay',
+    '紅陽': 'sunpay', '光貿': 'amego', '街口': 'jkopay',
+}
+
+# 不能當作組合元件的服務商：財政部大平台只做查詢與驗證，不能開立發票
+NOT_STACKABLE = {'invoice': {'mof'}}
+
+# 每一對由同一家服務商負責的元件加的分數（元件分數已正規化為 0~1）
+SAME_VENDOR_BONUS = 0.3
+
+# 查詢直接點名的服務商在各元件加的分數：與該元件最符合需求者等重
+MENTION_BONUS = 1.0
+
+
+def vendor_key(provider: str) -> str:
+    """服務商代碼 -> 集團鍵，相同者視為同一家"""
+    key = provider.lower()
+    return VENDOR_GROUPS.get(key, key)
+
+
+@dataclass
+class Candidate:
+    """單一元件的候選服務商"""
+    component: str
+    provider: str
+    display_name: str
+    score: float                     # 該 skill 推薦器的原始分數
+    reasons: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+    relevance: float = 0.0           # 除以該元件最高分後的 0~1 分數，點名者另加 MENTION_BONUS
+    vendor: str = field(init=False)
+
+    def __post_init__(self):
+        self.vendor = vendor_key(self.provider)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'provider': self.provider,
+            'display_name': self.display_name,
+            'score': round(self.score, 2),
+            'relevance': round(self.relevance, 3),
+            'reasons': self.reasons,
+            'warnings': self.warnings,
+        }
+
+
+@dataclass
+class Stack:
+    """一組服務商組合"""
+    components: Dict[str, Candidate]
+    score: float
+    bonus: float = SAME_VENDOR_BONUS
+
+    def shared_vendors(self) -> List[List[str]]:
+        """由同一家服務商負責的元件群組（兩個元件以上）"""
+        groups: Dict[str, List[str]] = {}
+        for component, candidate in self.components.items():
+            groups.setdefault(candidate.vendor, []).append(component)
+        return [components for components in groups.values() if len(components) > 1]
+
+    def reasons(self) -> List[str]:
+        reasons = []
+        for components in self.shared_vendors():
+            labels = ' + '.join(COMPONENT_LABELS.get(c, c) for c in components)
+            names = ' / '.join(self.components[c].display_name for c in components)
+            pairs = len(components) * (len(components) - 1) // 2
+            reasons.append(f'{labels} 由同一家服務商負責：{names} (+{pairs * self.bonus:.1f})')
+        return reasons
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'score': round(self.score, 3),
+            'reasons': self.reasons(),
+            'components': {c: candidate.as_dict() for c, candidate in self.components.items()},
+        }
+
+
+def best_stacks(candidates: Dict[str, Sequence[Candidate]], top_k: int = 3,
+                same_vendor: Iterable[str] = (),
+                bonus: float = SAME_VENDOR_BONUS) -> Tuple[List[Stack], int]:
+    """
+    以分支定界找出總分最高的前 K 組服務商組合
+
+    Args:
+        candidates: 元件 -> 候選服務商（relevance 已正規化），元件順序即搜尋順序
+        top_k: 回傳組數
+        same_vendor: 必須由同一家服務商負責的元件（少於兩個時不構成限制）
+        bonus: 每一對同家元件的加分
+
+    Returns:
+        (依總分排序的組合, 實際評估的候選節點數)；同分時依各元件候選的排序先後
+    """
+    components = list(candidates)
+    required = {c for c in same_vendor if c in candidates}
+    allowed = None
+    if len(required) > 1:
+        # 只保留每個必須同家的元件都有提供的服務商
+        allowed = set.intersection(*({cand.vendor for cand in candidates[c]} for c in required))
+    else:
+        required = set()
+
+    ranked = []
+    for component in components:
+        pool = [cand for cand in candidates[component]
+                if component not in required or cand.vendor in allowed]
+        # 穩定排序：同分時保留來源順序（各 skill providers.csv 的順序）
+        ranked.append(sorted(pool, key=lambda cand: -cand.relevance))
+    if not components or top_k < 1 or not all(ranked):
+        return [], 0
+
+    n = len(components)
+    is_required = [c in required for c in components]
+    # optimistic[i]：第 i 個元件起各元件的最高分，加上最多可得的同家加分
+    # （第 j 個元件最多與前面 j 個元件同家）
+    optimistic = [0.0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        optimistic[i] = optimistic[i + 1] + ranked[i][0].relevance + i * bonus
+
+    # (總分, 名次取負, 組合) 的 min-heap，heap[0] 為目前第 K 名。
+    # 深度優先依名次的字典序走訪，後到的同分組合名次較後，因此同分即可剪枝
+    heap: List[Tuple[float, Tuple[int, ...], List[Candidate]]] = []
+    picks: List[Candidate] = []
+    positions: List[int] = []
+    visited = 0
+
+    def extend(i: int, score: float, vendor: Optional[str]):
+        nonlocal visited
+        if i == n:
+            entry = (score, tuple(-p for p in positions), list(picks))
+            if len(heap) < top_k:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heapreplace(heap, entry)
+            return
+        full = len(heap) >= top_k
+        for position, cand in enumerate(ranked[i]):
+            if full and score + cand.relevance + i * bonus + optimistic[i + 1] <= heap[0][0]:
+                break  # 之後的候選分數只會更低
+            if is_required[i] and vendor is not None and cand.vendor != vendor:
+                continue
+            visited += 1
+            gained = cand.relevance + bonus * sum(p.vendor == cand.vendor for p in picks)
+            if full and score + gained + optimistic[i + 1] <= heap[0][0]:
+                continue
+            picks.append(cand)
+            positions.append(position)
+            extend(i + 1, score + gained, cand.vendor if is_required[i] else vendor)
+            picks.pop()
+            positions.pop()
+            full = len(heap) >= top_k
+
+    extend(0, 0.0, None)
+    stacks = [Stack(dict(zip(components, chosen)), score, bonus)
+              for score, _, chosen in sorted(heap, reverse=True)]
+    return stacks, visited
+
+
+def mentioned_vendors(query: str) -> set:
+    """查詢點名的服務商集團鍵：英文代碼（前後不接英數字）或 VENDOR_ALIASES 的中文品牌"""
+    q = query.lower()
+    vendors = {vendor for alias, vendor in VENDOR_ALIASES.items() if alias in q}
+    vendors.update(vendor_key(word) for word in re.findall(r'[a-z0-9_]+', q))
+    return vendors
+
+
+def detect_components(query: str, available: Iterable[str] = SKILLS) -> List[str]:
+    """查詢提到的元件（依 SKILLS 順序）；都沒提到時回傳全部可用的元件"""
+    q = query.lower()
+    available = [c for c in SKILLS if c in set(available)]
+    mentioned = [c for c in available if any(k in q for k in COMPONENT_KEYWORDS[c])]
+    return mentioned or available
+
+
+def discover_skills(skills: Optional[Iterable[str]] = None) -> Dict[str, Path]:
+    """尋找同一個 skills 目錄下已安裝的 taiwan-* skill，回傳 skill -> recommend.py"""
+    found = {}
+    for skill in skills or SKILLS:
+        path = SKILLS_ROOT / f'taiwan-{skill}' / 'scripts' / 'recommend.py'
+        if path.exists():
+            found[skill] = path
+    return found
+
+
+def _load_recommend(skill: str, path: Path):
+    # 各 skill 的 recommend.py 同名，以 taiwan_<skill>_recommend 載入避免互相覆蓋。
+    # 它們只向 core 取用共用引擎（engine.py，三份內容相同）的函數，
+    # 因此 `core` 不論解析到哪個 skill 都能運作
+    spec = importlib.util.spec_from_file_location(f'taiwan_{skill}_recommend', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class StackRecommender:
+    """載入各 skill 的推薦器，組合金流、發票、物流服務商"""
+
+    def __init__(self, skills: Optional[Iterable[str]] = None):
+        self.modules = {skill: _load_recommend(skill, path)
+                        for skill, path in discover_skills(skills).items()}
+        # 物流推薦器在建立時載入資料與語料，整個行程共用一份
+        self.logistics = None
+        if 'logistics' in self.modules:
+            self.logistics = self.modules['logistics'].LogisticsRecommender()
+
+    @property
+    def components(self) -> List[str]:
+        return [c for c in SKILLS if c in self.modules]
+
+    def refresh(self) -> Dict[str, List[str]]:
+        """各 skill 的 providers.csv / reasoning.csv 有變動者重建；回傳 元件 -> 被重建的檔名"""
+        reloaded = {}
+        for component, module in self.modules.items():
+            if component == 'logistics':
+                files = ['providers.csv'] if self.logistics.refresh() else []
+            else:
+                files = module.refresh()
+            if files:
+                reloaded[component] = files
+        return reloaded
+
+    def watch(self, interval: float = 1.0):
+        """在背景每 interval 秒執行一次 refresh()，回傳已啟動的 core.Watcher（以 stop() 停止）"""
+        from core import Watcher
+
+        return Watcher(self.refresh, interval).start()
+
+    def candidates(self, component: str, query: str) -> List[Candidate]:
+        """以該 skill 的推薦器為每家服務商評分（同分者依 providers.csv 的順序）"""
+        module = self.modules[component]
+        if component == 'logistics':
+            recommender = self.logistics
+            recommender.refresh()
+            corpus = recommender.corpus
+            # 無對外 API 的業者只能經聚合商串接，不單獨成為組合元件
+            unavailable = {p.provider for p in corpus.providers if not p.api_available}
+            found = [Candidate(component, r.provider, r.display_name, r.score, r.match_reasons, r.warnings)
+                     for r in recommender.recommend(query, len(corpus.providers))
+                     if r.provider not in unavailable]
+        elif component == 'invoice':
+            providers = module.load_providers()
+            scores = module.analyze_requirements(query, providers)
+            found = [Candidate(component, p['provider'], p['display_name'], *scores[p['provider']],
+                               module.get_anti_pattern_warnings(query, p['provider']))
+                     for p in providers]
+        else:
+            providers = module.load_providers_csv()
+            scores = module.analyze_requirements(query, providers)
+            # 理由去掉 '✓ ' 與分數尾碼，同 recommendation_record()
+            found = [Candidate(component, p['provider'], p['display_name'], scores[p['provider']][0],
+                               [r.replace('✓ ', '').split(' (+')[0] for r in scores[p['provider']][1]],
+                               module.get_anti_pattern_warnings(query, p['provider']))
+                     for p in providers]
+
+        excluded = NOT_STACKABLE.get(component, set())
+        found = [cand for cand in found if cand.provider.lower() not in excluded]
+        top = max((cand.score for cand in found), default=0.0)
+        mentioned = mentioned_vendors(query)
+        for cand in found:
+            cand.relevance = cand.score / top if top > 0 else 0.0
+            if cand.vendor in mentioned:
+                cand.relevance += MENTION_BONUS
+                cand.reasons = [f'需求指定 {cand.display_name} (+{MENTION_BONUS:.1f})'] + cand.reasons
+        return found
+
+    def recommend(self, query: str, top_k: int = 3, components: Optional[Iterable[str]] = None,
+                  same_vendor: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        """
+        推薦服務商組合
+
+        Args:
+            query: 需求描述
+            top_k: 回傳前 K 組
+            components: 要組合的元件，預設依查詢偵測（見 detect_components）
+            same_vendor: 必須由同一家服務商負責的元件；預設查詢含 SAME_VENDOR_KEYWORDS
+                時為全部元件，否則不限制（同家仍有加分）
+
+        Returns:
+            {'query', 'components', 'same_vendor', 'stacks', 'evaluated', 'combinations'}
+        """
+        if components is None:
+            components = detect_components(query, self.components)
+        else:
+            components = [c for c in SKILLS if c in set(components)]
+            missing = [c for c in components if c not in self.modules]
+            if missing:
+                raise ValueError(f'在 {SKILLS_ROOT} 下找不到 skill: {", ".join(missing)}')
+        if same_vendor is None:
+            same_vendor = components if any(k in query for k in SAME_VENDOR_KEYWORDS) else ()
+        same_vendor = [c for c in components if c in set(same_vendor)]
+
+        candidates = {c: self.candidates(c, query) for c in components}
+        stacks, evaluated = best_stacks(candidates, top_k, same_vendor)
+        combinations = 1
+        for pool in candidates.values():
+            combinations *= len(pool)
+
+        return {
+            'query': query,
+            'components': components,
+            'same_vendor': same_vendor if len(same_vendor) > 1 else [],
+            'stacks': [{'rank': rank, **stack.as_dict()} for rank, stack in enumerate(stacks, 1)],
+            'evaluated': evaluated,
+            'combinations': combinations,
+        }
+
+
+def format_ascii(result: Dict[str, Any]) -> str:
+    """格式化輸出 (ASCII Box)"""
+    labels = ' + '.join(COMPONENT_LABELS[c] for c in result['components'])
+    output = []
+    output.append('╔' + '═' * 78 + '╗')
+    output.append('║' + f' 台灣電商整合推薦 - {labels}'.center(76) + '║')
+    output.append('╠' + '═' * 78 + '╣')
+    output.append('║' + f' 查詢: {result["query"]}'.ljust(77) + '║')
+    if result['same_vendor']:
+        required = ' + '.join(COMPONENT_LABELS[c] for c in result['same_vendor'])
+        output.append('║' + f' 限制: {required} 同一家服務商'.ljust(77) + '║')
+    output.append('╚' + '═' * 78 + '╝')
+    output.append('')
+
+    if not result['stacks']:
+        output.append('沒有符合限制的組合')
+        output.append('')
+
+    for stack in result['stacks']:
+        rank = stack['rank']
+        emoji = '🥇' if rank == 1 else '🥈' if rank == 2 else '🥉'
+        output.append(f'{emoji} 組合 #{rank}: 總分 {stack["score"]:.2f}')
+        for component, candidate in stack['components'].items():
+            output.append(f'   {COMPONENT_LABELS[component]}  {candidate["display_name"]}'
+                          f' ({candidate["relevance"]:.2f})')
+            for reason in candidate['reasons']:
+                output.append(f'         ✓ {reason}')
+            for warning in candidate['warnings']:
+                output.append(f'         ⚠ {warning}')
+        for reason in stack['reasons']:
+            output.append(f'   🔗 {reason}')
+        output.append('─' * 80)
+
+    output.append(f'評估 {result["evaluated"]} 個候選節點（完整組合 {result["combinations"]} 種）')
+    return '\n'.join(output)
+
+
+def format_simple(result: Dict[str, Any]) -> str:
+    """格式化輸出 (Simple Text)"""
+    lines = []
+    for stack in result['stacks']:
+        parts = [f'{COMPONENT_LABELS[c]} {candidate["provider"]}'
+                 for c, candidate in stack['components'].items()]
+        lines.append(f'{stack["rank"]}. {" + ".join(parts)} ({stack["score"]:.2f})')
+    return '\n'.join(lines) if lines else '沒有符合限制的組合'
+
+
+def _component_list(value: str) -> List[str]:
+    components = list(SKILLS) if value == 'all' else [c.strip() for c in value.split(',') if c.strip()]
+    unknown = [c for c in components if c not in SKILLS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f'未知的元件: {", ".join(unknown)} (可用: {", ".join(SKILLS)}, all)')
+    return components
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Taiwan 電商整合推薦：金流 + 發票 + 物流服務商組合',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+範例:
+  python stack.py "ECPay 金流 + 發票 + 超商物流"
+  python stack.py "訂閱制 發票 宅配" --top 5 --format json
+  python stack.py "電商 金流 發票" --same-vendor payment,invoice
+  python stack.py "一站式 金流 發票 物流"          # 「一站式」「同一家」等字詞要求全部同家
+  python stack.py "小型商家 簡單" --components payment,logistics
+"""
+    )
+    parser.add_argument('query', help='需求描述 (關鍵字以空格分隔)')
+    parser.add_argument('-k', '--top', type=int, default=3, help='回傳前 K 組 (預設: 3)')
+    parser.add_argument('-f', '--format', choices=['ascii', 'json', 'simple'], default='ascii',
+                        help='輸出格式 (預設: ascii)')
+    parser.add_argument('--components', type=_component_list, default=None,
+                        help='要組合的元件，以逗號分隔 (預設: 依查詢偵測，未提及時為全部)')
+    parser.add_argument('--same-vendor', type=_component_list, default=None,
+                        help='必須由同一家服務商負責的元件，以逗號分隔，或 all')
+    args = parser.parse_args(argv)
+    if args.top < 1:
+        parser.error('--top 必須大於 0')
+
+    try:
+        recommender = StackRecommender()
+        if not recommender.modules:
+            raise ValueError(f'在 {SKILLS_ROOT} 下找不到任何 taiwan-* skill')
+        result = recommender.recommend(args.query, args.top, args.components, args.same_vendor)
+    except (OSError, ValueError) as e:
+        print(f'錯誤: {e}', file=sys.stderr)
+        return 1
+
+    if args.format == 'json':
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    elif args.format == 'simple':
+        print(format_simple(result))
+    else:
+        print(format_ascii(result))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
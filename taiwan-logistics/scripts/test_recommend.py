@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+推薦系統回歸測試
+
+鎖住 LogisticsRecommender 的評分。原本每次評分都重新分詞所有服務商的
+文件來算平均長度與文件頻率（一次推薦 O(服務商² × 查詢詞)）；現行做法
+在載入資料時建好語料（見 build_corpus()），分數必須與逐一重算的結果相同。
+批次推薦（recommend_batch / --batch）共用同一份語料，結果須與逐筆推薦相同。
+providers.csv 變動時重建語料並整組替換，並行的推薦只會看到某一版完整的語料。
+
+使用方法:
+    python test_recommend.py
+"""
+
+import io
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+from core import BATCH_PROCESS_THRESHOLD  # noqa: E402
+from recommend import LogisticsRecommender, run_batch  # noqa: E402
+
+
+QUERIES = [
+    '超商取貨 冷凍配送 高交易量',
+    '7-11 B2C 穩定',
+    '生鮮電商 溫控',
+    '新創公司 API 設計 JSON',
+    '黑貓 宅配 取貨付款',
+    'ecpay ecpay 綠界',
+    '',
+    'xyz',
+]
+
+
+def reference_scores(recommender, query):
+    """逐一重新分詞所有服務商計算 BM25 與關鍵字加權，作為預先建好語料的對照"""
+    tokenize = recommender.tokenize
+    providers = recommender.providers
+    docs = [tokenize(recommender.build_document(p)) for p in providers]
+    avg_doc_len = sum(len(doc) for doc in docs) / len(docs)
+    query_terms = tokenize(query)
+    k1, b = recommender.bm25.k1, recommender.bm25.b
+
+    scores = []
+    for provider, doc_terms in zip(providers, docs):
+        base = 0.0
+        for term in query_terms:
+            if term not in doc_terms:
+                continue
+            tf = doc_terms.count(term)
+            df = sum(1 for doc in docs if term in doc)
+            idf = math.log((len(docs) - df + 0.5) / (df + 0.5) + 1)
+            base += idf * (tf * (k1 + 1)) / (tf + k1 * (1 - b + b * (len(doc_terms) / avg_doc_len)))
+        weighted, reasons = base, []
+        for term in query_terms:
+            weight = recommender.KEYWORD_WEIGHTS.get(term, 1.0)
+            if term in doc_terms and weight > 1.0:
+                weighted += base * (weight - 1.0) * 0.1
+                reasons.append(f"關鍵字匹配: {term} (權重 {weight:.1f})")
+        scores.append((provider.provider, weighted, reasons))
+    return scores
+
+
+def test_corpus():
+    """語料只建一次：每家服務商一份文件，文件頻率與平均長度正確"""
+    recommender = LogisticsRecommender()
+    docs = [recommender.tokenize(recommender.build_document(p)) for p in recommender.providers]
+    expected_df = {}
+    for doc in docs:
+        for term in set(doc):
+            expected_df[term] = expected_df.get(term, 0) + 1
+
+    ok = (len(recommender.documents) == len(recommender.providers)
+          and [d.terms for d in recommender.documents] == docs
+          and recommender.doc_freq == expected_df
+          and recommender.avg_doc_len == sum(len(d) for d in docs) / len(docs))
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(docs)} 家服務商的詞頻、文件頻率與平均長度")
+    return [] if ok else [('corpus', 'precomputed stats', 'mismatch')]
+
+
+def test_scores_match_reference():
+    """每家服務商的分數與匹配原因須與逐一重算相同"""
+    recommender = LogisticsRecommender()
+    mismatched = []
+    for query in QUERIES:
+        top_k = len(recommender.providers)
+        actual = sorted((r.provider, r.score, r.match_reasons) for r in recommender.recommend(query, top_k))
+        expected = sorted(reference_scores(recommender, query))
+        if actual != expected:
+            mismatched.append(query)
+    ok = not mismatched
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(QUERIES)} 筆查詢與逐一重算相同")
+    return [] if ok else [('scores', 'same as reference', mismatched[:3])]
+
+
+def test_linear_in_providers():
+    """服務商增為 20 倍時，單次推薦的耗時不應接近平方成長 (400 倍)"""
+    recommender = LogisticsRecommender()
+
+    def per_call():
+        start = time.perf_counter()
+        for query in QUERIES:
+            recommender.recommend(query)
+        return time.perf_counter() - start
+
+    small = min(per_call() for _ in range(5))
+    recommender.build_corpus(recommender.providers * 20)
+    large = min(per_call() for _ in range(3))
+    ratio = large / small if small else 0.0
+    ok = ratio < 100
+    print(f"   [{'PASS' if ok else 'FAIL'}] 服務商 20 倍，耗時 {ratio:.1f} 倍")
+    return [] if ok else [('scaling', '< 100x', ratio)]
+
+
+def test_batch():
+    """批次結果與逐筆 recommend() 相同（含子行程），JSONL 模式保留 id 並回報壞行"""
+    failures = []
+    recommender = LogisticsRecommender()
+    queries = QUERIES + [QUERIES[0]]
+    expected = [recommender.recommend(q) for q in queries]
+    ok = recommender.recommend_batch(queries) == expected
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(queries)} 筆查詢與逐筆推薦相同")
+    if not ok:
+        failures.append(('batch', 'same as recommend()', len(queries)))
+
+    # 整批共用的 BM25 貢獻加總後與逐筆評分逐位元相同（取全部服務商比對每個分數）
+    ok = recommender.recommend_batch(queries, 100) == [recommender.recommend(q, 100) for q in queries]
+    print(f"   [{'PASS' if ok else 'FAIL'}] 全部服務商的分數與逐筆評分相同")
+    if not ok:
+        failures.append(('batch', 'all scores same as recommend()', len(queries)))
+
+    many = queries * (BATCH_PROCESS_THRESHOLD // len(queries) + 1)
+    ok = recommender.recommend_batch(many, processes=2) == recommender.recommend_batch(many)
+    print(f"   [{'PASS' if ok else 'FAIL'}] {len(many)} 筆以 2 個子行程推薦與單一行程相同")
+    if not ok:
+        failures.append(('batch', 'processes=2', len(many)))
+
+    stream = io.StringIO(f'{{"id": "a", "query": "{QUERIES[0]}"}}\n{{"query": 1}}\n')
+    out = io.StringIO()
+    errors = run_batch(recommender, stream, out, top_k=2)
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    ok = (errors == 1 and len(records) == 2
+          and records[0] == {'id': 'a', 'query': QUERIES[0],
+                             'recommendations': [r.as_dict() for r in expected[0][:2]]}
+          and records[1].get('line') == 2)
+    print(f"   [{'PASS' if ok else 'FAIL'}] JSONL 批次：{len(records)} 行輸出，{errors} 行錯誤")
+    if not ok:
+        failures.append(('run_batch', 'jsonl records', records))
+    return failures
+
+
+def test_refresh():
+    """
+    providers.csv 變動時自動換用新語料；替換期間並行的推薦只會看到某一版完整的結果
+
+    替換分兩種：os.replace 整檔替換，以及先刪除再建立（檢查簽章與開檔之間檔案
+    可能暫時不存在，此時沿用目前的語料，推薦不會失敗）。
+    """
+    failures = []
+    query = '冷凍 溫控 宅配'
+    original = (SCRIPT_DIR.parent / 'data' / 'providers.csv').read_text(encoding='utf-8')
+    row = ['testfreeze', '測試冷凍物流', '', 'aggregator', 'true'] + [''] * 5 + ['冷凍|溫控|宅配'] + [''] * 4
+    versions = [original, original.rstrip('\n') + '\n' + ','.join(row) + '\n']
+    tmp = Path(tempfile.mkdtemp())
+    path = tmp / 'providers.csv'
+
+    def write(version, recreate=False):
+        # 先寫暫存檔再替換，讀取端不會讀到寫一半的檔案；recreate 時先刪除原檔
+        if recreate:
+            path.unlink()
+        staged = tmp / 'providers.csv.tmp'
+        staged.write_text(versions[version], encoding='utf-8')
+        os.replace(staged, path)
+
+    try:
+        write(0)
+        recommender = LogisticsRecommender(tmp)
+        expected = []
+        for version in (0, 1):
+            write(version)
+            expected.append([(r.provider, r.score) for r in recommender.recommend(query, 100)])
+        ok = (len(expected[1]) == len(expected[0]) + 1 and expected[1][0][0] == 'testfreeze'
+              and not recommender.refresh())
+        print(f"   [{'PASS' if ok else 'FAIL'}] 新增服務商後 recommend() 自動換用新語料")
+        if not ok:
+            failures.append(('refresh', 'new provider picked up', expected[1][:1]))
+
+        # 檢查簽章之後、開檔之前檔案被刪除：refresh() 沿用目前的語料
+        write(0)
+        recommender.refresh()
+        write(1)
+        stale = recommender._source_signature()
+
+        def vanish():
+            # 簽章是刪除前 stat 到的，開檔時檔案已不存在
+            if path.exists():
+                path.unlink()
+            return stale
+
+        recommender._source_signature = vanish
+        try:
+            reloaded = recommender.refresh()
+            kept = [(r.provider, r.score) for r in recommender.recommend(query, 100)]
+        except OSError as exc:
+            reloaded, kept = exc, None
+        finally:
+            del recommender._source_signature
+        ok = reloaded is False and kept == expected[0]
+        print(f"   [{'PASS' if ok else 'FAIL'}] 檢查後、開檔前檔案被刪除時沿用目前的語料")
+        if not ok:
+            failures.append(('refresh', 'file removed before open', reloaded))
+
+        seen, errors, stop = [], [], threading.Event()
+
+        def reader():
+            while not stop.is_set():
+                try:
+                    seen.append([(r.provider, r.score) for r in recommender.recommend(query, 100)])
+                except Exception as exc:
+                    errors.append(exc)
+
+        threads = [threading.Thread(target=reader) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for i in range(80):
+            write(i % 2, recreate=i >= 40)
+            time.sleep(0.005)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        torn = [result for result in seen if result not in expected]
+        ok = seen and not torn and not errors
+        print(f"   [{'PASS' if ok else 'FAIL'}] 替換與刪除重建各 40 次期間 {len(seen)} 次並行推薦皆為完整的某一版")
+        if not ok:
+            failures.append(('refresh', 'atomic swap', (len(torn), errors[:1])))
+
+        write(0)
+        recommender.refresh()
+        watcher = recommender.watch(0.01)
+        try:
+            write(1)
+            deadline = time.monotonic() + 5
+            while len(recommender.providers) == len(expected[0]) and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            watcher.stop()
+        ok = len(recommender.providers) == len(expected[1]) and watcher.error is None
+        print(f"   [{'PASS' if ok else 'FAIL'}] watch() 在背景載入變動，不需等到下一次推薦")
+        if not ok:
+            failures.append(('watch', 'background reload', len(recommender.providers)))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return failures
+
+
+def main():
+    print('=' * 60)
+    print('推薦系統回歸測試 (taiwan-logistics)')
+    print('=' * 60)
+
+    failures = []
+
+    print('\n1. 預先建立的服務商語料')
+    failures += test_corpus()
+
+    print('\n2. 分數與逐一重算相同')
+    failures += test_scores_match_reference()
+
+    print('\n3. 推薦耗時隨服務商數線性成長')
+    failures += test_linear_in_providers()
+
+    print('\n4. 批次推薦')
+    failures += test_batch()
+
+    print('\n5. 來源檔變動時重新載入')
+    failures += test_refresh()
+
+    print('\n' + '=' * 60)
+    if failures:
+        print(f'[FAIL] {len(failures)} 項未通過')
+        for item in failures:
+            print(f'   {item}')
+        return 1
+
+    print('[DONE] 全部通過')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
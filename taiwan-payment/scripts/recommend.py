@@ -9,21 +9,23 @@ Taiwan Payment 推薦系統
     python recommend.py "高交易量電商"
     python recommend.py "快速整合 LINE Pay" --format json
     python recommend.py "新創公司 API" --format simple
+    python recommend.py --batch < merchants.jsonl > results.jsonl   # 批次，JSONL 進出
 """
 
 import argparse
-import csv
 import json
+import os
 import sys
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
 
 # 路徑設定
 SCRIPT_DIR = Path(__file__).parent
 DATA_DIR = SCRIPT_DIR.parent / 'data'
 
+# core（連同搜索引擎）在實際推薦時才匯入，--help 與參數錯誤不必付出載入成本
 sys.path.insert(0, str(SCRIPT_DIR))
-from core import rule_match_score, MIN_RULE_MATCH  # noqa: E402
 
 # 推薦規則 (關鍵字 -> [(provider, 權重, 理由)])
 RECOMMENDATION_RULES = {
@@ -85,62 +87,100 @@ ANTI_PATTERNS = {
 }
 
 
+@lru_cache(maxsize=None)
+def keyword_rules():
+    """RECOMMENDATION_RULES 與 ANTI_PATTERNS 編成的關鍵字自動機（core.KeywordRules），行程內只編譯一次"""
+    from core import KeywordRules
+
+    return KeywordRules(RECOMMENDATION_RULES, ANTI_PATTERNS)
+
+
 def load_providers_csv() -> List[Dict]:
-    """從 providers.csv 載入服務商清單"""
-    csv_path = DATA_DIR / 'providers.csv'
-    if not csv_path.exists():
-        return []
+    """
+    從 providers.csv 載入服務商清單
+
+    檔案在行程內只讀一次，變動時才重新讀取（core.file_snapshot）；回傳的是共用的列，請勿修改。
+    """
+    from core import file_snapshot
+
+    return file_snapshot(DATA_DIR / 'providers.csv').get()
 
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        return list(csv.DictReader(f))
+
+def provider_names(providers: Optional[List[Dict]] = None) -> Dict[str, str]:
+    """provider -> display_name；providers 為已載入的 providers.csv，預設重新載入"""
+    if providers is None:
+        providers = load_providers_csv()
+    return {p['provider']: p['display_name'] for p in providers}
 
 
 def load_reasoning_csv() -> List[Dict]:
     """從 reasoning.csv 載入推薦規則"""
-    csv_path = DATA_DIR / 'reasoning.csv'
-    if not csv_path.exists():
-        return []
+    from core import rule_table
+
+    return [dict(rule) for rule in rule_table(DATA_DIR / 'reasoning.csv').load()]
+
+
+def refresh() -> List[str]:
+    """
+    檢查 providers.csv 與 reasoning.csv，只重建有變動的那一份；回傳被重建的檔名
+
+    每次推薦本來就會比對來源檔並在變動時重建；長駐服務可改用 watch() 在背景
+    定期呼叫，讓重建發生在請求之外。
+    """
+    from core import file_snapshot, rule_table
+
+    sources = {
+        'providers.csv': file_snapshot(DATA_DIR / 'providers.csv'),
+        'reasoning.csv': rule_table(DATA_DIR / 'reasoning.csv'),
+    }
+    return [name for name, source in sources.items() if source.refresh()]
+
 
-    rules = []
-    with open(csv_path, 'r', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            rules.append(row)
+def watch(interval: float = 1.0):
+    """在背景每 interval 秒執行一次 refresh()，回傳已啟動的 core.Watcher（以 stop() 停止）"""
+    from core import Watcher
 
-    return rules
+    return Watcher(refresh, interval).start()
 
 
-def analyze_requirements(query: str) -> Dict[str, Tuple[int, List[str]]]:
+def analyze_requirements(query: str,
+                         providers: Optional[List[Dict]] = None,
+                         rule_matches: Optional[List[Tuple[Dict[str, str], float]]] = None
+                         ) -> Dict[str, Tuple[int, List[str]]]:
     """
     分析需求並計算各服務商的推薦分數
 
+    Args:
+        query: 需求描述
+        providers: 已載入的 providers.csv，批次推薦時整批共用；預設重新載入
+        rule_matches: 已比對好的 reasoning.csv 規則（RuleTable.match() 的結果），
+                      批次推薦時由 RuleTable.match_batch() 整批比對；預設逐筆比對
+
     Returns:
         {provider: (score, [reasons])}
     """
-    query_lower = query.lower()
+    from core import rule_table
+
+    if providers is None:
+        providers = load_providers_csv()
     # 由 providers.csv 動態建立，避免新增服務商後推薦規則被靜默丟棄
-    providers = [p['provider'] for p in load_providers_csv()]
+    providers = [p['provider'] for p in providers]
     scores = {p: 0 for p in providers}
     reasons = {p: [] for p in providers}
 
-    # 基於關鍵字規則計分
-    for keyword, recommendations in RECOMMENDATION_RULES.items():
-        if keyword in query_lower:
-            for provider, weight, reason in recommendations:
-                scores[provider] += weight
-                reasons[provider].append(f'✓ {reason} (+{weight})')
-
-    # 從 CSV 載入額外規則
-    csv_rules = load_reasoning_csv()
-    for rule in csv_rules:
-        # 以匹配強度加權。原本只比對 scenario 且命中任一詞就給滿分，
-        # use_cases 整欄被忽略，導致規則命中率與分數都失真
-        strength = rule_match_score(
-            query, rule.get('scenario', ''), rule.get('use_cases', '')
-        )
-        if strength < MIN_RULE_MATCH:
-            continue
-
+    # 基於關鍵字規則計分：所有關鍵字一次掃描，依 RECOMMENDATION_RULES 的順序套用
+    for _, recommendations in keyword_rules().match(query):
+        for provider, weight, reason in recommendations:
+            scores[provider] += weight
+            reasons[provider].append(f'✓ {reason} (+{weight})')
+
+    # reasoning.csv 的額外規則：規則表在行程內只編譯一次（檔案變動時自動重載），
+    # 且只為與查詢共用 token 的規則計分。
+    # 以匹配強度加權。原本只比對 scenario 且命中任一詞就給滿分，
+    # use_cases 整欄被忽略，導致規則命中率與分數都失真
+    if rule_matches is None:
+        rule_matches = rule_table(DATA_DIR / 'reasoning.csv').match(query)
+    for rule, strength in rule_matches:
         provider = rule.get('recommended_provider', '').lower()
         if provider in scores:
             confidence = rule.get('confidence', 'MEDIUM')
@@ -160,8 +200,16 @@ def get_anti_patterns(provider: str) -> List[str]:
     return [f'⚠ {pattern}: {desc}' for pattern, desc in ANTI_PATTERNS.get(provider, [])]
 
 
-def format_recommendation_ascii(results: Dict[str, Tuple[int, List[str]]], query: str) -> str:
-    """格式化輸出 (ASCII Box)"""
+def get_anti_pattern_warnings(query: str, provider: str) -> List[str]:
+    """只取查詢中出現的反模式，格式同 recommendation_record 的 anti_patterns（與 analyze_requirements 共用同一次關鍵字掃描）"""
+    return [f'{pattern}: {desc}' for pattern, desc in keyword_rules().warnings(query, provider)]
+
+
+def format_recommendation_ascii(results: Dict[str, Tuple[int, List[str]]], query: str,
+                                names: Optional[Dict[str, str]] = None) -> str:
+    """格式化輸出 (ASCII Box)；names 為 provider_names()，預設讀取 providers.csv 一次"""
+    if names is None:
+        names = provider_names()
     # 排序
     sorted_results = sorted(results.items(), key=lambda x: x[1][0], reverse=True)
 
@@ -177,10 +225,7 @@ def format_recommendation_ascii(results: Dict[str, Tuple[int, List[str]]], query
         if score == 0:
             continue
 
-        # Provider 名稱
-        provider_names = {p['provider']: p['display_name']
-                          for p in load_providers_csv()}
-        display_name = provider_names.get(provider, provider)
+        display_name = names.get(provider, provider)
 
         # Emoji
         emoji = '🥇' if rank == 1 else '🥈' if rank == 2 else '🥉'
@@ -208,8 +253,9 @@ def format_recommendation_ascii(results: Dict[str, Tuple[int, List[str]]], query
     return '\n'.join(output)
 
 
-def format_recommendation_json(results: Dict[str, Tuple[int, List[str]]], query: str) -> str:
-    """格式化輸出 (JSON)"""
+def recommendation_record(results: Dict[str, Tuple[int, List[str]]], query: str,
+                          names: Dict[str, str]) -> Dict[str, Any]:
+    """--format json 與 --batch 的輸出結構：{'query', 'recommendations': [...]}"""
     sorted_results = sorted(results.items(), key=lambda x: x[1][0], reverse=True)
 
     output_data = {
@@ -221,24 +267,32 @@ def format_recommendation_json(results: Dict[str, Tuple[int, List[str]]], query:
         if score == 0:
             continue
 
-        provider_names = {p['provider']: p['display_name']
-                          for p in load_providers_csv()}
-
         rec = {
             'rank': rank,
             'provider': provider,
-            'display_name': provider_names.get(provider, provider),
+            'display_name': names.get(provider, provider),
             'score': score,
             'reasons': [r.replace('✓ ', '').split(' (+')[0] for r in reason_list],
             'anti_patterns': [a.replace('⚠ ', '') for a in get_anti_patterns(provider)]
         }
         output_data['recommendations'].append(rec)
 
-    return json.dumps(output_data, ensure_ascii=False, indent=2)
+    return output_data
 
 
-def format_recommendation_simple(results: Dict[str, Tuple[int, List[str]]], query: str) -> str:
+def format_recommendation_json(results: Dict[str, Tuple[int, List[str]]], query: str,
+                               names: Optional[Dict[str, str]] = None) -> str:
+    """格式化輸出 (JSON)"""
+    if names is None:
+        names = provider_names()
+    return json.dumps(recommendation_record(results, query, names), ensure_ascii=False, indent=2)
+
+
+def format_recommendation_simple(results: Dict[str, Tuple[int, List[str]]], query: str,
+                                 names: Optional[Dict[str, str]] = None) -> str:
     """格式化輸出 (Simple Text)"""
+    if names is None:
+        names = provider_names()
     sorted_results = sorted(results.items(), key=lambda x: x[1][0], reverse=True)
 
     output = [f'查詢: {query}\n']
@@ -247,10 +301,7 @@ def format_recommendation_simple(results: Dict[str, Tuple[int, List[str]]], quer
         if score == 0:
             continue
 
-        provider_names = {p['provider']: p['display_name']
-                          for p in load_providers_csv()}
-
-        output.append(f'推薦 #{rank}: {provider_names.get(provider, provider)} ({score:.1f} 分)')
+        output.append(f'推薦 #{rank}: {names.get(provider, provider)} ({score:.1f} 分)')
 
         if reason_list:
             for reason in reason_list:
@@ -266,13 +317,139 @@ def format_recommendation_simple(results: Dict[str, Tuple[int, List[str]]], quer
     return '\n'.join(output)
 
 
+def _recommend_chunk(queries: List[str]) -> List[Dict[str, Tuple[int, List[str]]]]:
+    """在本行程分析一段查詢（recommend_batch 的子行程入口）"""
+    import copy
+
+    from core import rule_table
+
+    providers = load_providers_csv()
+    unique = list(dict.fromkeys(queries))
+    # reasoning.csv 規則整批比對一次：token 聯集只查一次倒排索引
+    matches = dict(zip(unique, rule_table(DATA_DIR / 'reasoning.csv').match_batch(unique)))
+    computed: Dict[str, Dict[str, Tuple[int, List[str]]]] = {}
+    results = []
+    for query in queries:
+        if query in computed:
+            results.append(copy.deepcopy(computed[query]))
+        else:
+            computed[query] = analyze_requirements(query, providers, matches[query])
+            results.append(computed[query])
+    return results
+
+
+def recommend_batch(queries: Iterable[str],
+                    processes: Optional[int] = None) -> List[Dict[str, Tuple[int, List[str]]]]:
+    """
+    批次推薦：providers.csv 整批只讀一次，reasoning.csv 規則整批比對一次
+    （RuleTable.match_batch），規則表與關鍵字自動機在行程內只編譯一次；
+    相同的需求描述只計算一次
+
+    Args:
+        queries: 需求描述
+        processes: 大於 1 且批次達 BATCH_PROCESS_THRESHOLD 筆時，分塊交給多個子行程
+
+    Returns:
+        與 queries 順序相同的結果列表，每項等同 analyze_requirements() 的回傳值
+    """
+    from core import map_batch
+
+    return map_batch(_recommend_chunk, queries, processes)
+
+
+def parse_batch_line(line: str) -> Tuple[Optional[Dict[str, Any]], str]:
+    """解析一行 JSONL：JSON 字串或含 query（必要）、id 的物件，回傳 (item, error)"""
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return None, f'invalid JSON: {e}'
+    if isinstance(item, str):
+        item = {'query': item}
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+        return None, "expected a string or an object with a string 'query'"
+    return item, ''
+
+
+def _chunked(lines: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(stream: TextIO, out: TextIO, processes: Optional[int] = None,
+              chunk_size: int = 1000) -> int:
+    """
+    JSONL 批次模式：stdin 每行一筆需求，stdout 每行一筆推薦結果（同 --format json）
+
+    每讀滿一段就推薦並輸出一次，大檔案也能邊讀邊寫；無法解析的行輸出
+    {"line", "error"}，不中斷整批。回傳錯誤行數。
+    """
+    from core import BATCH_PROCESS_THRESHOLD
+
+    if processes and processes > 1:
+        # 每段至少要達多行程門檻，子行程才派得上用場
+        chunk_size = max(chunk_size, BATCH_PROCESS_THRESHOLD * processes)
+    names = provider_names()
+    errors = 0
+    lines = ((n, line) for n, line in enumerate(stream, 1) if line.strip())
+    for chunk in _chunked(lines, chunk_size):
+        parsed = [(n, *parse_batch_line(line)) for n, line in chunk]
+        queries = [item['query'] for _, item, _ in parsed if item is not None]
+        results = iter(recommend_batch(queries, processes))
+
+        for n, item, error in parsed:
+            if item is None:
+                errors += 1
+                record = {'line': n, 'error': error}
+            else:
+                record = {'id': item['id']} if 'id' in item else {}
+                record.update(recommendation_record(next(results), item['query'], names))
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+    return errors
+
+
 def main():
     parser = argparse.ArgumentParser(description='台灣金流推薦系統')
-    parser.add_argument('query', type=str, help='需求描述')
+    parser.add_argument('query', type=str, nargs='?', help='需求描述')
     parser.add_argument('--format', choices=['ascii', 'json', 'simple'], default='ascii', help='輸出格式')
+    parser.add_argument('--profile', nargs='?', const='table', metavar='MODE',
+                        help='各階段耗時輸出到 stderr：table (預設)、json、cprofile[:路徑]；'
+                             '亦可設定 $TAIWAN_SEARCH_PROFILE')
+    parser.add_argument('--batch', action='store_true',
+                        help='從 stdin 讀取 JSONL 需求 (字串或 {"id", "query"})，逐行輸出 JSONL 推薦結果')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='--batch 輸入量大時使用的子行程數')
 
     args = parser.parse_args()
 
+    profile = args.profile or os.environ.get('TAIWAN_SEARCH_PROFILE')
+    if profile:
+        from core import PROFILER, start_profiling
+
+        try:
+            start_profiling(profile, __file__)
+        except ValueError as e:
+            parser.error(str(e))
+        module = sys.modules[__name__]
+        PROFILER.instrument(module, ['load_providers_csv', 'load_reasoning_csv'], 'load_csv')
+        PROFILER.instrument(module, ['analyze_requirements'], 'analyze_requirements')
+        PROFILER.instrument(module, [n for n in vars(module) if n.startswith('format_')], 'format')
+
+    # JSONL 批次模式
+    if args.batch:
+        errors = run_batch(sys.stdin, sys.stdout, args.processes)
+        sys.exit(1 if errors else 0)
+
+    if args.query is None:
+        parser.error('需要需求描述，或使用 --batch 從 stdin 讀取')
+
     # 分析需求
     results = analyze_requirements(args.query)
 
@@ -9,18 +9,46 @@ Taiwan Payment 搜索 CLI
     python search.py "10100058" --domain error   # 指定域
     python search.py "金額" --format json        # JSON 輸出
     python search.py "ECPay" --domain all        # 全域搜索
+    python search.py --build-index               # 預先建立搜索索引
+    python search.py --batch < queries.jsonl     # JSONL 批次查詢
+    python search.py "merchantt" --suggest       # 輸入建議 (欄位名、端點、錯誤碼)
+    python search.py serve                       # 常駐服務，搭配 --daemon 免重新載入
 """
 
-import argparse
+import os
 import sys
 from pathlib import Path
-import json
-from typing import List, Dict, Tuple
+from typing import List, Dict, Iterable, Iterator, Optional, TextIO, Tuple
 
 # 添加父目錄到 path
 sys.path.insert(0, str(Path(__file__).parent))
 
-from core import search, search_all, CSV_CONFIG
+from core import (search, search_all, search_batch, suggest, resolve_domain, build_all_indexes,
+                  cli_field_weights, parse_field_weights, parse_simple_args, start_profiling,
+                  CSV_CONFIG, DATA_DIR, INDEX_DIR, PROFILE_ENV, PROFILER)
+
+# 常駐服務位址，與 server.py 相同
+SKILL = 'payment'
+DAEMON_HOST = os.environ.get('TAIWAN_SEARCH_HOST', '127.0.0.1')
+DAEMON_PORT = int(os.environ.get('TAIWAN_SEARCH_PORT', '47310'))
+# 埠上的程式不一定是我們的服務：以 --daemon 或 TAIWAN_SEARCH_DAEMON=1 明確開啟才把查詢交給它
+DAEMON_ENV = 'TAIWAN_SEARCH_DAEMON'
+
+# 常見的單筆查詢（查詢字串加上這些選項）不經 argparse 解析，見 core.parse_simple_args()；
+# 其餘參數組合、--help 與錯誤訊息照常交給 build_parser()
+DOMAINS = (*CSV_CONFIG, 'all')
+FORMATS = ('ascii', 'json')
+FAST_OPTIONS = {
+    '-d': ('domain', DOMAINS), '--domain': ('domain', DOMAINS),
+    '-m': ('max', int), '--max': ('max', int),
+    '-f': ('format', FORMATS), '--format': ('format', FORMATS),
+    '--fuzzy': ('fuzzy', None), '--daemon': ('daemon', None), '--no-daemon': ('no_daemon', None),
+}
+FAST_DEFAULTS = {
+    'domain': None, 'format': 'ascii', 'max': 5, 'build_index': False, 'boost': None,
+    'bm25f': False, 'fuzzy': False, 'suggest': False, 'daemon': False, 'no_daemon': False,
+    'batch': False, 'processes': None, 'profile': None,
+}
 
 
 def format_ascii_box(title: str, content: List[str], width: int = 80, style: str = 'double') -> str:
@@ -127,7 +155,178 @@ def format_all_results_ascii(all_results: Dict[str, List]) -> str:
     return '\n'.join(output)
 
 
-def main():
+def parse_batch_line(line: str, domain: Optional[str], max_results: int) -> Tuple[Optional[Dict], str]:
+    """解析一行 JSONL 查詢，回傳 (job, error)
+
+    每行可為 JSON 字串，或含 query（必要）、domain、max_results、id 的物件。
+    """
+    import json
+
+    try:
+        item = json.loads(line)
+    except ValueError as e:
+        return None, f'JSON 格式錯誤: {e}'
+    if isinstance(item, str):
+        item = {'query': item}
+    if not isinstance(item, dict) or not isinstance(item.get('query'), str):
+        return None, '每行須為字串，或含字串 query 欄位的物件'
+
+    job_domain = item.get('domain') or domain or resolve_domain(item['query'])
+    if job_domain not in CSV_CONFIG:
+        return None, f'未知的搜索域: {job_domain}'
+    job_max = item.get('max_results', max_results)
+    if not isinstance(job_max, int) or job_max < 1:
+        return None, 'max_results 須為正整數'
+
+    job = {'query': item['query'], 'domain': job_domain, 'max_results': job_max}
+    if 'id' in item:
+        job['id'] = item['id']
+    return job, ''
+
+
+def _chunked(lines: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_batch(
+    stream: TextIO,
+    out: TextIO,
+    domain: Optional[str] = None,
+    max_results: int = 5,
+    processes: Optional[int] = None,
+    chunk_size: int = 1000
+) -> int:
+    """JSONL 批次模式：stdin 每行一筆查詢，stdout 每行一筆結果
+
+    每讀滿 chunk_size 行就評分並輸出一次，大檔案也能邊讀邊寫。輸出與輸入
+    逐行對應（空白行略過）；無法解析的行輸出 {"line", "error"}，不中斷整批。
+    回傳錯誤行數。
+    """
+    import json
+
+    from core import BATCH_PROCESS_THRESHOLD
+
+    if processes and processes > 1:
+        # 每段至少要達多行程門檻，子行程才派得上用場
+        chunk_size = max(chunk_size, BATCH_PROCESS_THRESHOLD * processes)
+    errors = 0
+    lines = ((n, line) for n, line in enumerate(stream, 1) if line.strip())
+    for chunk in _chunked(lines, chunk_size):
+        parsed = [(n, *parse_batch_line(line, domain, max_results)) for n, line in chunk]
+        jobs = [job for _, job, _ in parsed if job is not None]
+        results = iter(search_batch(jobs, processes=processes))
+
+        for n, job, error in parsed:
+            if job is None:
+                errors += 1
+                record = {'line': n, 'error': error}
+            else:
+                record = {k: job[k] for k in ('id', 'query', 'domain') if k in job}
+                record['results'] = next(results)
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+    return errors
+
+
+def query_daemon(
+    path: str,
+    payload: Dict,
+    host: str = DAEMON_HOST,
+    port: int = DAEMON_PORT,
+    timeout: float = 5.0
+) -> Optional[Dict]:
+    """向常駐服務 (search.py serve) 發送請求
+
+    服務未啟動、回應非 200 或格式不符時回傳 None，呼叫端改為行程內搜索。
+    直接以 socket 送出 HTTP/1.0 請求：光是匯入 http.client 就比一次查詢還慢。
+    """
+    import socket
+
+    chunks = []
+    try:
+        # 服務未啟動時 localhost 連線會立即被拒，逾時只在服務卡住時才用到。
+        # 連上後才編碼請求：服務沒在跑（最常見的情況）時連 json 都不必匯入
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            import json
+
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            head = (f'POST {path} HTTP/1.0\r\nHost: {host}\r\n'
+                    f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n')
+            sock.sendall(head.encode('ascii') + body)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+    except OSError:
+        return None
+
+    status, _, rest = b''.join(chunks).partition(b'\r\n')
+    if status.split()[1:2] != [b'200']:
+        return None
+    try:
+        reply = json.loads(rest.partition(b'\r\n\r\n')[2])
+    except ValueError:
+        return None
+    return reply if isinstance(reply, dict) and 'results' in reply else None
+
+
+def run_search(query: str, domain: Optional[str], max_results: int, use_daemon: bool = False,
+               field_weights: Optional[Dict[str, float]] = None, fuzzy: bool = False):
+    """執行搜索：use_daemon 時先交給常駐服務，否則在本行程內搜索 (domain='all' 為全域搜索)"""
+    if use_daemon:
+        payload = {
+            'skill': SKILL, 'query': query, 'domain': None if domain == 'all' else domain,
+            'max_results': max_results, 'all': domain == 'all', 'data_dir': str(DATA_DIR),
+        }
+        if field_weights is not None:
+            payload['field_weights'] = field_weights
+        if fuzzy:
+            payload['fuzzy'] = True
+        reply = query_daemon('/search', payload)
+        if reply is not None:
+            return reply['results']
+    if domain == 'all':
+        return search_all(query, max_per_domain=max_results, fuzzy=fuzzy)
+    return search(query, domain=domain, max_results=max_results, field_weights=field_weights,
+                  fuzzy=fuzzy)
+
+
+def run_suggest(prefix: str, domain: Optional[str], limit: int, use_daemon: bool = False) -> List[Dict]:
+    """輸入建議：use_daemon 時先交給常駐服務，否則在本行程內查詢 (domain=None 為所有域)"""
+    if use_daemon:
+        payload = {'skill': SKILL, 'prefix': prefix, 'domain': domain, 'limit': limit,
+                   'data_dir': str(DATA_DIR)}
+        reply = query_daemon('/suggest', payload)
+        if reply is not None:
+            return reply['results']
+    return suggest(prefix, domain, limit)
+
+
+def stream_suggestions(stream: TextIO, out: TextIO, domain: Optional[str], limit: int,
+                       use_daemon: bool = False):
+    """stdin 每行一個前綴，逐行輸出 {"prefix", "suggestions"} 並立即 flush，供輸入框即時提示"""
+    import json
+
+    for line in stream:
+        prefix = line.rstrip('\n')
+        record = {'prefix': prefix, 'suggestions': run_suggest(prefix, domain, limit, use_daemon)}
+        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        out.flush()
+
+
+def build_parser():
+    """完整的參數解析器；常見的單筆查詢由 parse_simple_args() 處理，不必建立它"""
+    import argparse
+
     parser = argparse.ArgumentParser(
         description='台灣金流搜索工具',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -135,24 +334,34 @@ def main():
 範例:
   python search.py "信用卡"                    # 自動偵測域
   python search.py "10100058" --domain error   # 搜索錯誤碼
+  python search.py "金額錯誤" -d error --bm25f               # 以預設 BM25F 欄位權重排序
+  python search.py "金額錯誤" -d error --boost solution=2  # 調整 BM25F 欄位權重
+  python search.py "CheckMacVaule" -d troubleshoot --fuzzy  # 容許識別字拼錯
   python search.py "ECPay" --format json       # JSON 輸出
   python search.py "金額" --domain all         # 全域搜索
+  python search.py --build-index               # 預先建立搜索索引
+  python search.py --batch < queries.jsonl     # JSONL 批次查詢 (stdin → stdout)
+  python search.py "merchantt" --suggest       # 輸入建議 (欄位名、端點、錯誤碼)
+  python search.py --suggest < prefixes.txt    # 逐行前綴 → 逐行 JSONL 建議
+  python search.py "信用卡" --profile          # 各階段耗時 (stderr)
+  python search.py serve                       # 啟動常駐服務 (索引常駐記憶體)
+  python search.py "信用卡" --daemon           # 查詢交給常駐服務
 
 可用域:
   provider, operation, error, field, payment_method, troubleshoot, reasoning, all
         '''
     )
 
-    parser.add_argument('query', type=str, help='搜索查詢')
+    parser.add_argument('query', type=str, nargs='?', help='搜索查詢')
     parser.add_argument(
         '--domain', '-d',
         type=str,
-        choices=list(CSV_CONFIG.keys()) + ['all'],
+        choices=DOMAINS,
         help='搜索域 (不指定則自動偵測)'
     )
     parser.add_argument(
         '--format', '-f',
-        choices=['ascii', 'json'],
+        choices=FORMATS,
         default='ascii',
         help='輸出格式'
     )
@@ -162,19 +371,143 @@ def main():
         default=5,
         help='最大結果數'
     )
+    parser.add_argument(
+        '--build-index',
+        action='store_true',
+        help='預先建立編譯後的搜索索引 (寫入 data/ 旁的 .index/)'
+    )
+
+    parser.add_argument(
+        '--boost',
+        type=parse_field_weights,
+        metavar='COL=W[,COL=W]',
+        help='BM25F 域的欄位權重，覆寫預設值 (例如 code=3,solution=0.5)；隱含 --bm25f'
+    )
+    parser.add_argument(
+        '--bm25f',
+        action='store_true',
+        help='BM25F 域改以預設欄位權重排序 (預設為一般 BM25)'
+    )
+    parser.add_argument(
+        '--fuzzy',
+        action='store_true',
+        help='模糊比對：先將拼錯的英數識別字修正為索引中最接近的詞再搜索'
+    )
+    parser.add_argument(
+        '--suggest',
+        action='store_true',
+        help='輸入建議：列出以查詢開頭的欄位名、端點與代碼；未給查詢時從 stdin 逐行讀取前綴'
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help=f'查詢交給 search.py serve 啟動的常駐服務 (或設定 {DAEMON_ENV}=1)'
+    )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help=f'一律在本行程內搜索，即使指定了 --daemon 或 {DAEMON_ENV}'
+    )
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='批次模式：從 stdin 讀取 JSONL 查詢，逐行輸出 JSONL 結果'
+    )
+    parser.add_argument(
+        '--processes', '-j',
+        type=int,
+        default=None,
+        help='批次模式的子行程數 (大量查詢時使用)'
+    )
+    parser.add_argument(
+        '--profile',
+        nargs='?',
+        const='table',
+        metavar='MODE',
+        help=f'各階段耗時輸出到 stderr：table (預設)、json、cprofile[:路徑]；亦可設定 ${PROFILE_ENV}'
+    )
+    return parser
+
+
+def parser_error(message: str):
+    """以 argparse 的格式回報參數錯誤並結束 (exit code 2)"""
+    build_parser().error(message)
+
+
+def main():
+    # 常駐服務模式：search.py serve [--host H] [--port P] [--skills ...]
+    if sys.argv[1:2] == ['serve']:
+        from server import main as serve
+        serve(sys.argv[2:])
+        return
+
+    # 常見的單筆查詢不經 argparse，見 FAST_OPTIONS
+    args = parse_simple_args(sys.argv[1:], FAST_OPTIONS, FAST_DEFAULTS) or build_parser().parse_args()
+
+    # 分階段計時：--profile 或 TAIWAN_SEARCH_PROFILE。常駐服務內的耗時量不到，一律改為行程內搜索
+    profile = args.profile or os.environ.get(PROFILE_ENV)
+    if profile:
+        try:
+            start_profiling(profile, __file__)
+        except ValueError as e:
+            parser_error(str(e))
+        PROFILER.instrument(sys.modules[__name__], [n for n in globals() if n.startswith('format_')],
+                            'format')
+        args.no_daemon = True
+    # 常駐服務須明確開啟，見 DAEMON_ENV
+    if not (args.daemon or os.environ.get(DAEMON_ENV, '') not in ('', '0')):
+        args.no_daemon = True
+
+    if args.build_index:
+        built = build_all_indexes()
+        print(f'索引已寫入: {INDEX_DIR}')
+        for domain, total in built.items():
+            print(f'  {domain:<16} {total} 筆')
+        return
+
+    if args.batch:
+        if args.domain == 'all':
+            parser_error('批次模式不支援 --domain all')
+        errors = run_batch(sys.stdin, sys.stdout, args.domain, args.max, args.processes)
+        sys.exit(1 if errors else 0)
+
+    if args.suggest:
+        domain = None if args.domain == 'all' else args.domain
+        if domain is not None and 'suggest_cols' not in CSV_CONFIG[domain]:
+            parser_error(f'域 {domain} 不提供輸入建議')
+        if args.query is None:
+            stream_suggestions(sys.stdin, sys.stdout, domain, args.max, not args.no_daemon)
+            return
+        suggestions = run_suggest(args.query, domain, args.max, not args.no_daemon)
+        if args.format == 'json':
+            import json
+            print(json.dumps(suggestions, ensure_ascii=False, indent=2))
+        else:
+            for item in suggestions:
+                print(f"{item['text']}\t{item['domain']}\t{','.join(item['columns'])}")
+        return
 
-    args = parser.parse_args()
+    if not args.query:
+        parser_error('請提供搜索查詢')
 
     # 執行搜索
+    if args.domain == 'all' and (args.boost or args.bm25f):
+        parser_error('--boost/--bm25f 只適用於單域搜索')
     if args.domain == 'all':
-        results = search_all(args.query, max_per_domain=args.max)
+        results = run_search(args.query, 'all', args.max, not args.no_daemon, fuzzy=args.fuzzy)
         if args.format == 'json':
+            import json
             print(json.dumps(results, ensure_ascii=False, indent=2))
         else:
             print(format_all_results_ascii(results))
     else:
-        results = search(args.query, domain=args.domain, max_results=args.max)
+        try:
+            results = run_search(args.query, args.domain, args.max, not args.no_daemon,
+                                 cli_field_weights(args), args.fuzzy)
+        except ValueError as e:
+            parser_error(str(e))
         if args.format == 'json':
+            import json
             print(json.dumps(results, ensure_ascii=False, indent=2))
         else:
             domain = results[0]['_domain'] if results else (args.domain or 'unknown')